@@ -0,0 +1,626 @@
+# -*- coding: utf-8 -*-
+# 本地性能测试：在聚宽之外，用合成的数据加载MaBaseResearch.py，对比各个实现的结果和耗时
+#
+# filters：向量化过滤、买入排序的前k个、滚动均线、盈利状态跟踪 vs 逐个处理（Reference.py中的参考实现），校验结果并对比耗时
+# stages： 在LocalBacktest中回放合成的股票池，对handle_data和开盘前预计算的每个阶段计时，统计p50/p99耗时和内存分配。
+#          各阶段的耗时是包含关系：UniverseIndex.LimitBits包含在OnFilterSelectIntraday中，
+#          买卖处理包含在MarketInfoHandler.Execute中。
+#          没有执行到的阶段（如只在没有开盘前预计算时执行的OnFilterSelect）也列出，样本数为0，并报告NOT SAMPLED；
+#          基线中有样本、这次没有样本的阶段视为回归。
+#          分配数为每个bar中被GC跟踪的对象的净增加数（分配减去释放），计时期间关闭GC。
+#          --save-baseline保存为基线，之后的运行与基线对比，p50或分配数超出基线的比例时报告回归并以非0退出
+#
+# 用法：
+#   python Benchmark.py [filters]
+#   python Benchmark.py stages [--sizes 300,1000,5000] [--frequencies day,minute] [--baseline FILE] [--save-baseline]
+import io
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import datetime
+from timeit import default_timer
+
+import numpy as np
+import pandas as pd
+from enum import Enum
+
+import Reference
+
+STRATEGY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MaBaseResearch.py')
+
+DEF_BENCH_SIZES = (300, 1000, 5000)  # 股票池大小
+DEF_BENCH_REPEAT = 20  # 每个实现重复的次数
+DEF_BENCH_FREQUENCIES = ('day', 'minute')
+DEF_BENCH_RANK_K = 10  # 买入排序读取的个数
+DEF_BENCH_MA_WINDOWS = (5, 20)  # 滚动均线对比的窗口
+DEF_BENCH_MA_DAYS = 8  # 滚动均线逐日回放的交易日数
+DEF_STAGE_DAYS = {'day': 20, 'minute': 2}  # 每种频率回放的交易日数
+DEF_WARMUP_DAYS = 70  # 回放之前的历史，供均线预热
+# stages的基线保存在Benchmark.py所在的目录，与运行时的当前目录无关；耗时与机器有关，不提交到git（见.gitignore）
+DEF_BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+DEF_REGRESSION_RATIO = 1.5  # p50或分配数超过基线的倍数时视为回归
+DEF_REGRESSION_MIN_MS = 0.05  # 小于这个差值的耗时变化视为噪音
+DEF_REGRESSION_MIN_ALLOCS = 100  # 小于这个差值的分配数变化视为噪音
+
+# 各个阶段：(阶段名, 类名, 方法名)，类名为None时是策略的全局函数。
+# 每次调用SCOPES中的函数（每个bar的handle_data，每天开盘前的PrepareDay、RefreshMarketInfo）时，
+# 其中每个阶段的累计耗时记为一个样本。ma_sync、prefetch在开盘前和盘中都会执行，两处的样本合在一起。
+# 选股在股票池属性索引上进行：开盘前universe_select，盘中filter_intraday，涨跌停按bar由limit_bits判断。
+# filter_select、filter_limit只在没有开盘前预计算时执行（FilterLimitStocks由OnFilterSelect调用），正常的回测中没有样本
+STAGES = [
+    ('handle_data', None, 'handle_data'),
+    ('prepare_day', None, 'PrepareDay'),
+    ('market_refresh', None, 'RefreshMarketInfo'),
+    ('universe_index', None, 'LoadUniverseIndex'),
+    ('prefetch', 'CacheHandler', 'Prefetch'),
+    ('ma_sync', 'RollingMaEngine', 'Sync'),
+    ('filter_prepare', 'SecuritiesFilter', 'PrepareDay'),
+    ('universe_select', 'UniverseIndex', 'Select'),
+    ('filter_select', 'SecuritiesFilter', 'OnFilterSelect'),
+    ('filter_intraday', 'SecuritiesFilter', 'OnFilterSelectIntraday'),
+    ('limit_bits', 'UniverseIndex', 'LimitBits'),
+    ('filter_limit', 'SecurityHandler', 'FilterLimitStocks'),
+    ('market_execute', 'MarketInfoHandler', 'Execute'),
+    ('stop_loss', 'CapitalManager', 'StopLoss'),
+    ('bullish', 'CapitalManager', 'OnActionBullishHandle'),
+    ('bearish', 'CapitalManager', 'OnActionBearishHandle'),
+]
+SCOPES = ['handle_data', 'PrepareDay', 'RefreshMarketInfo']
+
+
+# 什么都不做的日志
+class _SilentLog:
+    def debug(self, *msg): pass
+
+    def info(self, *msg): pass
+
+    def warn(self, *msg): pass
+
+    def error(self, *msg): pass
+
+
+# get_current_data()中单支个股的状态
+class _SecurityStatus:
+    def __init__(self, paused, is_st, high_limit, low_limit, day_open):
+        self.paused = paused
+        self.is_st = is_st
+        self.high_limit = high_limit
+        self.low_limit = low_limit
+        self.day_open = day_open
+
+
+# 查询字段，只支持策略用到的valuation.code.in_和==
+class _Field:
+    def __init__(self, name):
+        self.name = name
+
+    def in_(self, values):
+        return set(values)
+
+    def __eq__(self, value):
+        return set([value])
+
+
+class _Valuation:
+    code = _Field('code')
+    market_cap = _Field('market_cap')
+
+
+class _Query:
+    def __init__(self, *fields):
+        self.Fields = [field.name for field in fields]
+        self.Codes = None
+
+    def filter(self, codes):
+        self.Codes = codes
+        return self
+
+
+# 持仓
+class _Position:
+    def __init__(self, security, price, avg_cost):
+        self.security = security
+        self.price = price
+        self.avg_cost = avg_cost
+
+
+# data[security]：当前bar的个股数据
+class _SecurityUnitData:
+    def __init__(self, closes, close, pre_close):
+        self._closes = closes
+        self.close = close
+        self.pre_close = pre_close
+
+    def mavg(self, days, field='close'):
+        return self._closes[-days:].mean()
+
+
+# 合成的股票池：过去的收盘价、市场价、涨跌停价、市值、停牌、ST都是随机生成的
+class SyntheticUniverse:
+    def __init__(self, size, days=60, seed=0):
+        rng = np.random.RandomState(seed)
+        self.Securities = ['%06d.XSHE' % i for i in range(size)]
+        self.Closes = np.cumprod(1 + rng.normal(0.001, 0.02, (days, size)), axis=0) * rng.uniform(3, 100, size)
+        preClose = self.Closes[-1]
+        self.Price = pd.Series(preClose * (1 + rng.uniform(-0.1, 0.1, size)), index=self.Securities)
+        self.Caps = pd.Series(rng.uniform(10, 8000, size), index=self.Securities)
+
+        paused = rng.rand(size) < 0.05
+        st = rng.rand(size) < 0.05
+        self.Status = dict((security, _SecurityStatus(paused[i], st[i], preClose[i] * 1.1, preClose[i] * 0.9,
+                                                      preClose[i])) for i, security in enumerate(self.Securities))
+        self.Data = dict((security, _SecurityUnitData(self.Closes[:, i], self.Price[security], preClose[i])) \
+                         for i, security in enumerate(self.Securities))
+
+
+# 按聚宽的方式加载策略：把API注入到策略的全局空间中执行
+def LoadStrategy(api):
+    namespace = {'Enum': Enum, 'log': _SilentLog()}
+    namespace.update(api)
+    source = io.open(STRATEGY_FILE, encoding='utf-8').read()
+    exec(compile(source, STRATEGY_FILE, 'exec'), namespace)
+    return namespace
+
+
+# 为合成的股票池构造策略用到的聚宽API
+def MakeApi(universe):
+    closeDF = pd.DataFrame(universe.Closes, columns=universe.Securities)
+
+    def get_price(security, end_date=None, fields=None, frequency='1d', count=1):
+        if isinstance(security, list):
+            return {'close': pd.DataFrame([universe.Price.reindex(security).values], columns=security)}
+        return pd.DataFrame({'close': [universe.Price[security]]})
+
+    def get_fundamentals(q, date=None):
+        codes = [code for code in universe.Caps.index if code in q.Codes]
+        df = pd.DataFrame({'code': codes, 'market_cap': universe.Caps[codes].values})
+        return df[q.Fields]
+
+    def history(count, unit='1d', field='close', security_list=None, df=True):
+        return closeDF[security_list].iloc[-count:]
+
+    return {'get_price': get_price, 'get_fundamentals': get_fundamentals, 'history': history,
+            'get_current_data': lambda: universe.Status, 'query': _Query, 'valuation': _Valuation}
+
+
+class _Context:
+    def __init__(self, universe):
+        self.universe = universe
+        self.current_dt = datetime.datetime(2016, 8, 26, 9, 30)
+
+
+# 重复执行func，返回平均耗时（秒）和最后一次的结果
+def TimeIt(func, repeat=DEF_BENCH_REPEAT):
+    result = func()
+    start = time.time()
+    for i in range(repeat):
+        result = func()
+    return (time.time() - start) / repeat, result
+
+
+# 加载策略，并为合成的股票池预取cache
+def _Setup(size):
+    universe = SyntheticUniverse(size)
+    strategy = LoadStrategy(MakeApi(universe))
+    context = _Context(universe.Securities)
+    strategy['CacheHolder'].Prefetch(universe.Securities, context.current_dt)
+    return universe, strategy, context
+
+
+# 对比两个实现的结果和耗时
+# @equal：比较两个结果的函数，默认为==
+def _Compare(name, size, loopFunc, vectorFunc, equal=None, repeat=DEF_BENCH_REPEAT):
+    loopTime, loopResult = TimeIt(loopFunc, repeat)
+    vectorTime, vectorResult = TimeIt(vectorFunc, repeat)
+    if not (equal(loopResult, vectorResult) if equal else loopResult == vectorResult):
+        raise AssertionError('%s result differs from loop at size %d' % (name, size))
+    return (size, loopTime * 1000, vectorTime * 1000, loopTime / vectorTime)
+
+
+_COLUMNS = ['securities', 'loop_ms', 'vectorized_ms', 'speedup']
+
+
+# OnFilterSelect：逐个过滤 vs 向量化，两个实现读取的都是已经预取好的cache
+def BenchFilterSelect(sizes=DEF_BENCH_SIZES):
+    rows = []
+    for size in sizes:
+        universe, strategy, context = _Setup(size)
+
+        # 涨跌停过滤两个实现共用，关掉它，只对比选股本身
+        secFilter = strategy['SecFilter']
+        secFilter._selectFilterOpt.FilterLimitUp = False
+        secFilter._selectFilterOpt.FilterLimitDown = False
+
+        securities = universe.Securities
+        rows.append(_Compare('OnFilterSelect', size,
+                             lambda: Reference.OnFilterSelectByLoop(strategy, secFilter, securities, context, None),
+                             lambda: secFilter.OnFilterSelect(securities, context, None)))
+    return pd.DataFrame(rows, columns=_COLUMNS)
+
+
+# FilterLimitStocks：逐个判断 vs 数组判断，涨跌停价按天缓存，只有第一次调用时读取
+def BenchFilterLimit(sizes=DEF_BENCH_SIZES):
+    rows = []
+    for size in sizes:
+        universe, strategy, context = _Setup(size)
+        handler = strategy['SecurityHandler']
+        option = strategy['SecuritiesSelectionFilterOption'](filterLimitDown=True)
+        securities = universe.Securities
+        rows.append(_Compare('FilterLimitStocks', size,
+                             lambda: Reference.FilterLimitStocksByLoop(strategy, securities, option, context),
+                             lambda: handler.FilterLimitStocks(securities, option, context)))
+    return pd.DataFrame(rows, columns=_COLUMNS)
+
+
+# 开盘前的选股：对整个股票池构造掩码（OnFilterSelectDaily） vs 在当天的股票池属性索引上做位图运算和市值区间查找，
+# 索引每天只建立一次，所有策略实例共用，对比的是建立之后每次选股的耗时
+def BenchUniverseIndex(sizes=DEF_BENCH_SIZES):
+    rows = []
+    for size in sizes:
+        universe, strategy, context = _Setup(size)
+        secFilter = strategy['SecFilter']
+        option = secFilter._selectFilterOpt
+        securities = universe.Securities
+        index = strategy['LoadUniverseIndex'](securities, context)
+        rows.append(_Compare('UniverseIndex', size,
+                             lambda: secFilter.OnFilterSelectDaily(securities, context),
+                             lambda: index.SecuritiesOf(index.Select(option))))
+    return pd.DataFrame(rows, columns=_COLUMNS)
+
+
+# OnFilterOrderIn：逐个调用mavg vs 滚动均线和数组运算
+# 每次调用前清空指标的备忘表，对比的是计算本身，而不是从备忘表读取
+def BenchFilterOrderIn(sizes=DEF_BENCH_SIZES):
+    rows = []
+    for size in sizes:
+        universe, strategy, context = _Setup(size)
+        secFilter = strategy['SecFilter']
+        indicators = strategy['Indicators']
+        securities = universe.Securities
+
+        def Vectorized():
+            indicators.Clear()
+            return secFilter.OnFilterOrderIn(securities, {}, context, universe.Data)
+
+        rows.append(_Compare('OnFilterOrderIn', size,
+                             lambda: Reference.OnFilterOrderInByLoop(strategy, secFilter, securities, {}, context,
+                                                                    universe.Data),
+                             Vectorized))
+    return pd.DataFrame(rows, columns=_COLUMNS)
+
+
+# 买入排序：对所有候选股完整排序 vs 按需分批选出前k个，对比的是买入循环读取前k个的耗时，
+# 分值从指标备忘表读取，两个实现相同
+def BenchRank(sizes=DEF_BENCH_SIZES, k=DEF_BENCH_RANK_K):
+    rows = []
+    for size in sizes:
+        universe, strategy, context = _Setup(size)
+        secFilter = strategy['SecFilter']
+        securities = universe.Securities
+        count = min(k, size)
+
+        def TopK(ranked):
+            return [ranked[i].Security for i in range(count)]
+
+        rows.append(_Compare('RankedCandidates', size,
+                             lambda: TopK(Reference.OnRankByOrderInOptionByLoop(strategy, secFilter, securities,
+                                                                                universe.Data)),
+                             lambda: TopK(secFilter.OnRankByOrderInOption(securities, universe.Data))))
+    return pd.DataFrame(rows, columns=_COLUMNS)
+
+
+# 滚动均线：每天逐个查询历史数据求均值（Reference.GetMarketMaIndexByDay） vs RollingMaEngine增量更新，
+# 在合成的收盘价上逐日回放，两个实现读取的是同一份历史数据。滚动和有浮点误差，按相对误差比较。
+# 收盘价中随机放入NaN（缺失或停牌的bar），部分个股开头为NaN（回放期间上市），均值与pandas一样跳过NaN
+def BenchRollingMa(sizes=DEF_BENCH_SIZES, windows=DEF_BENCH_MA_WINDOWS, days=DEF_BENCH_MA_DAYS, seed=0):
+    rows = []
+    for size in sizes:
+        universe = SyntheticUniverse(size)
+        strategy = LoadStrategy(MakeApi(universe))
+        securities = universe.Securities
+        rng = np.random.RandomState(seed)
+        closes = universe.Closes.copy()
+        closes[rng.rand(*closes.shape) < 0.05] = np.nan
+        listed = rng.randint(len(closes) - days - max(windows), len(closes), size)
+        closes[np.arange(len(closes))[:, None] < listed[None, :]] = np.nan
+        closeDF = pd.DataFrame(closes, columns=securities)
+        closeFrames = dict((security, closeDF[[security]]) for security in securities)
+        current = [0]  # 回放到的交易日，历史数据不包括当天
+
+        def history(count, unit='1d', field='close', security_list=None, df=True):
+            return closeDF[security_list].iloc[max(current[0] - count, 0):current[0]]
+
+        def attribute_history(security, count, unit='1d', fields='close'):
+            return closeFrames[security].iloc[max(current[0] - count, 0):current[0]]
+
+        strategy['history'] = history
+        strategy['attribute_history'] = attribute_history
+        replay = range(len(closeDF) - days + 1, len(closeDF) + 1)
+
+        def Loop():
+            mas = []
+            for day in replay:
+                current[0] = day
+                mas.append([[Reference.GetMarketMaIndexByDay(strategy, security, window, 'close')
+                             for security in securities] for window in windows])
+            return np.array(mas)
+
+        def Vectorized():
+            engine = strategy['RollingMaEngine'](strategy['FetchSecuritiesHistory'], windows)
+            mas = []
+            for day in replay:
+                current[0] = day
+                engine.Sync(securities, day)
+                mas.append([engine.GetMa(securities, window) for window in windows])
+            return np.array(mas)
+
+        rows.append(_Compare('RollingMaEngine', size, Loop, Vectorized,
+                             lambda x, y: np.allclose(x, y, rtol=1e-9, atol=0, equal_nan=True), 1))
+    return pd.DataFrame(rows, columns=_COLUMNS)
+
+
+# 持仓的盈利状态：逐个更新Reference.SecurityProfitStatus vs TrailingStopEngine一次更新所有持仓
+# 每个bar清除已经发出的信号，与OnActionStopLoss的用法相同
+def BenchTrailingStop(sizes=DEF_BENCH_SIZES, bars=20, seed=0):
+    strategy = LoadStrategy(MakeApi(SyntheticUniverse(1)))
+    rows = []
+    for size in sizes:
+        securities = ['%06d.XSHE' % i for i in range(size)]
+        profits = np.cumsum(np.random.RandomState(seed).normal(0.3, 3, (bars, size)), axis=0)
+
+        def Loop():
+            statuses = [Reference.SecurityProfitStatus(strategy, security,
+                                                       Reference.WaterLine(strategy, strategy['DEF_PROFIT_LINE_HIGH'],
+                                                                           False, True),
+                                                       Reference.WaterLine(strategy, strategy['DEF_PROFIT_LINE_LOW'],
+                                                                           True, False))
+                        for security in securities]
+            return [tuple(i for i, status in enumerate(statuses) if status.Update(profits[bar, i], True))
+                    for bar in range(bars)]
+
+        def Vectorized():
+            engine = strategy['TrailingStopEngine'](size)
+            engine.Track(securities)
+            indices = engine.Rows(securities)
+            return [tuple(np.nonzero(engine.Update(indices, profits[bar], True))[0]) for bar in range(bars)]
+
+        rows.append(_Compare('TrailingStopEngine', size, Loop, Vectorized))
+    return pd.DataFrame(rows, columns=_COLUMNS)
+
+
+# 持仓是否卖出：逐个判断（Reference.IsNeedSellOffByLoop） vs NeedSellOffMask一次判断所有持仓
+# 持仓的最新价逐个bar随机变化，覆盖破均线、止损和盈利水位的信号，每个实现有自己的盈利状态跟踪
+def BenchSellOff(sizes=DEF_BENCH_SIZES, bars=20, seed=0):
+    rows = []
+    for size in sizes:
+        universe, strategy, context = _Setup(size)
+        handler = strategy['SecurityHandler']
+        indicators = strategy['Indicators']
+        maDays = strategy['DEF_MA_SAMPLING_DAYS_FOR_SECURITY']
+        threshold = strategy['DEF_CAP_STOPLOSS_THRESHOLD']
+        securities = universe.Securities
+        rng = np.random.RandomState(seed)
+        avgCosts = universe.Price.values * rng.uniform(0.8, 1.2, size)
+        prices = universe.Price.values * np.cumprod(1 + rng.normal(0, 0.03, (bars, size)), axis=0)
+
+        def Replay(sellOff):
+            engine = strategy['TrailingStopEngine'](size)
+            engine.Track(securities)
+            results = []
+            for bar in range(bars):
+                indicators.Clear()
+                positions = [_Position(security, prices[bar, i], avgCosts[i]) for i, security in enumerate(securities)]
+                results.append(sellOff(positions, engine))
+            return results
+
+        def Loop(positions, engine):
+            return tuple(i for i, position in enumerate(positions)
+                         if Reference.IsNeedSellOffByLoop(strategy, position, context, universe.Data, engine, maDays,
+                                                          threshold))
+
+        def Vectorized(positions, engine):
+            return tuple(np.nonzero(handler.NeedSellOffMask(positions, context, engine, maDays, threshold))[0])
+
+        rows.append(_Compare('NeedSellOffMask', size, lambda: Replay(Loop), lambda: Replay(Vectorized)))
+    return pd.DataFrame(rows, columns=_COLUMNS)
+
+
+# 按阶段统计handle_data和开盘前预计算的耗时：替换策略中各阶段的类方法，累计每次调用SCOPES中的函数时每个阶段的耗时和分配数
+# 同一次调用中多次执行的阶段（如FilterLimitStocks）合计为一个样本，没有执行的阶段不计样本
+class StageProfiler:
+    def __init__(self, strategy, stages=STAGES):
+        self.Stages = [stage for stage, owner, name in stages]
+        self.Times = dict((stage, []) for stage in self.Stages)
+        self.Allocs = dict((stage, []) for stage in self.Stages)
+        self._barTimes = {}
+        self._barAllocs = {}
+        self._inScope = False
+        self._install(strategy, stages)
+
+    def _install(self, strategy, stages):
+        for stage, owner, name in stages:
+            if owner is None:
+                wrap = self._wrapScope if name in SCOPES else self._wrap
+                strategy[name] = wrap(stage, strategy[name])
+                continue
+
+            cls = strategy[owner]
+            func = cls.__dict__[name]
+            if isinstance(func, staticmethod):
+                setattr(cls, name, staticmethod(self._wrap(stage, func.__get__(None, cls))))
+            else:
+                setattr(cls, name, self._wrap(stage, func))
+
+    def _wrap(self, stage, func):
+        def Timed(*args, **kwargs):
+            allocs = gc.get_count()[0]
+            start = default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._barTimes[stage] = self._barTimes.get(stage, 0.0) + default_timer() - start
+                self._barAllocs[stage] = self._barAllocs.get(stage, 0) + gc.get_count()[0] - allocs
+
+        return Timed
+
+    # 一次采样的范围（一个bar，或者一次开盘前的预计算）：开始时清空累计，结束时把每个阶段的累计记为一个样本
+    def _wrapScope(self, stage, func):
+        timed = self._wrap(stage, func)
+
+        def Scope(*args, **kwargs):
+            if self._inScope: return timed(*args, **kwargs)
+            self._barTimes.clear()
+            self._barAllocs.clear()
+            self._inScope = True
+            enabled = gc.isenabled()
+            gc.disable()
+            try:
+                return timed(*args, **kwargs)
+            finally:
+                if enabled: gc.enable()
+                self._inScope = False
+                for name, elapsed in self._barTimes.items():
+                    self.Times[name].append(elapsed)
+                    self.Allocs[name].append(self._barAllocs[name])
+
+        return Scope
+
+    # 每个阶段一行：样本数、p50/p99/平均耗时（毫秒）、每个样本的平均分配数，没有样本的阶段样本数为0，其余为NaN
+    def Report(self):
+        rows = []
+        for stage in self.Stages:
+            times = np.array(self.Times[stage]) * 1000
+            if not len(times):
+                rows.append((stage, 0, np.nan, np.nan, np.nan, np.nan))
+                continue
+            rows.append((stage, len(times), np.percentile(times, 50), np.percentile(times, 99), times.mean(),
+                         np.mean(self.Allocs[stage])))
+        return pd.DataFrame(rows, columns=['stage', 'bars', 'p50_ms', 'p99_ms', 'mean_ms', 'allocs_per_bar'])
+
+
+# 在LocalBacktest中回放一个合成的股票池，返回各阶段的统计
+def ProfileStages(size, frequency='day', days=None):
+    from LocalBacktest import Backtest, MakeSyntheticData
+
+    days = days or DEF_STAGE_DAYS[frequency]
+    data = MakeSyntheticData(size, DEF_WARMUP_DAYS + days, withMinute=frequency == 'minute', minuteDays=days)
+    backtest = Backtest(data, data.Dates[DEF_WARMUP_DAYS], frequency=frequency)
+    profiler = StageProfiler(backtest.Strategy)
+    backtest.Run()
+    return profiler.Report()
+
+
+# 所有股票池大小和频率的阶段统计，合并为一张表
+def BenchStages(sizes=DEF_BENCH_SIZES, frequencies=DEF_BENCH_FREQUENCIES):
+    tables = []
+    for frequency in frequencies:
+        for size in sizes:
+            table = ProfileStages(size, frequency)
+            table.insert(0, 'frequency', frequency)
+            table.insert(0, 'securities', size)
+            tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+def _BaselineKey(row):
+    return '%d/%s/%s' % (row['securities'], row['frequency'], row['stage'])
+
+
+# 没有样本的阶段不写进基线
+def SaveBaseline(table, path=DEF_BASELINE_FILE):
+    rows = dict((_BaselineKey(row), {'p50_ms': row['p50_ms'], 'p99_ms': row['p99_ms'],
+                                     'allocs_per_bar': row['allocs_per_bar']})
+                for _, row in table.iterrows() if row['bars'] > 0)
+    with open(path, 'w') as f:
+        json.dump({'python': sys.version.split()[0], 'rows': rows}, f, indent=1, sort_keys=True)
+
+
+# 与基线对比，返回p50相对基线的比例和回归的阶段；基线中没有的行不参与对比，
+# 基线中有样本、这次没有样本的阶段（如工作移到了别的阶段）报告为回归
+def CompareBaseline(table, path=DEF_BASELINE_FILE):
+    with open(path) as f:
+        baseline = json.load(f)['rows']
+
+    ratios = []
+    regressions = []
+    for _, row in table.iterrows():
+        key = _BaselineKey(row)
+        base = baseline.get(key)
+        if base is None:
+            ratios.append(np.nan)
+            continue
+        if row['bars'] == 0:
+            ratios.append(np.nan)
+            regressions.append('%s not sampled, baseline p50 %.3fms' % (key, base['p50_ms']))
+            continue
+
+        ratios.append(row['p50_ms'] / base['p50_ms'] if base['p50_ms'] else np.nan)
+        if row['p50_ms'] > base['p50_ms'] * DEF_REGRESSION_RATIO and \
+                row['p50_ms'] - base['p50_ms'] > DEF_REGRESSION_MIN_MS:
+            regressions.append('%s p50 %.3fms -> %.3fms' % (key, base['p50_ms'], row['p50_ms']))
+        if row['allocs_per_bar'] > base['allocs_per_bar'] * DEF_REGRESSION_RATIO and \
+                row['allocs_per_bar'] - base['allocs_per_bar'] > DEF_REGRESSION_MIN_ALLOCS:
+            regressions.append('%s allocs %.0f -> %.0f' % (key, base['allocs_per_bar'], row['allocs_per_bar']))
+
+    table = table.copy()
+    table['p50_vs_baseline'] = ratios
+    return table, regressions
+
+
+def _ParseList(text, convert=str):
+    return [convert(value) for value in text.split(',') if value]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for MaBaseResearch.py.')
+    parser.add_argument('suite', nargs='?', default='filters', choices=['filters', 'stages'])
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEF_BENCH_SIZES),
+                        help='comma separated universe sizes')
+    parser.add_argument('--frequencies', default=','.join(DEF_BENCH_FREQUENCIES), help='day and/or minute')
+    parser.add_argument('--baseline', default=DEF_BASELINE_FILE, help='baseline file of the stages suite')
+    parser.add_argument('--save-baseline', action='store_true', help='save this run as the new baseline')
+    args = parser.parse_args()
+
+    sizes = _ParseList(args.sizes, int)
+    if args.suite == 'filters':
+        print('OnFilterSelect')
+        print(BenchFilterSelect(sizes).to_string(index=False))
+        print('FilterLimitStocks')
+        print(BenchFilterLimit(sizes).to_string(index=False))
+        print('UniverseIndex')
+        print(BenchUniverseIndex(sizes).to_string(index=False))
+        print('OnFilterOrderIn')
+        print(BenchFilterOrderIn(sizes).to_string(index=False))
+        print('RankedCandidates')
+        print(BenchRank(sizes).to_string(index=False))
+        print('RollingMaEngine')
+        print(BenchRollingMa(sizes).to_string(index=False))
+        print('TrailingStopEngine')
+        print(BenchTrailingStop(sizes).to_string(index=False))
+        print('NeedSellOffMask')
+        print(BenchSellOff(sizes).to_string(index=False))
+        return 0
+
+    table = BenchStages(sizes, _ParseList(args.frequencies))
+    if args.save_baseline:
+        SaveBaseline(table, args.baseline)
+        print(table.to_string(index=False))
+        print('baseline saved to %s' % args.baseline)
+        return 0
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        table, regressions = CompareBaseline(table, args.baseline)
+    print(table.to_string(index=False))
+    for _, row in table[table['bars'] == 0].iterrows():
+        print('NOT SAMPLED %s' % _BaselineKey(row))
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
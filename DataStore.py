@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# 本地行情的二进制列式存储
+# 每个字段保存为一个(交易日 × 个股)的.npy文件，分钟线为(交易日*240 × 个股)，按(日期, 个股)的行列号索引。
+# 读取时用内存映射打开，不解析、不复制数据，按bar读取一行就是对映射文件的切片，
+# 启动时只读取很小的meta.json和交易日列表，耗时不随历史长度增长。
+# 存储目录中同时保存每个交易日的股票池属性索引（停牌、ST位图和按市值排序的列号），
+# 回测时替换策略的LoadUniverseIndex，选股不再逐个读取个股状态和查询市值。
+#
+# 用法：
+#   python DataStore.py --csv DIR --out STORE
+#   python DataStore.py --synthetic 5000 --days 250 [--minute] --out STORE
+#   python DataStore.py --universe-index STORE（为已有的存储目录建立股票池属性索引）
+import os
+import json
+import datetime
+import argparse
+
+import numpy as np
+
+from LocalBacktest import MarketData, LoadCsvData, MakeSyntheticData, DAILY_FIELDS, MINUTE_FIELDS
+
+STORE_VERSION = 1
+META_FILE = 'meta.json'
+UNIVERSE_VERSION = 1
+UNIVERSE_PREFIX = 'universe_'  # 股票池属性索引的文件，由数据派生
+UNIVERSE_META_FILE = UNIVERSE_PREFIX + 'meta.json'
+UNIVERSE_FIELDS = ['paused', 'st', 'cap_order', 'cap_sorted']
+
+
+def _DailyFile(path, field):
+    return os.path.join(path, 'daily_%s.npy' % field)
+
+
+def _MinuteFile(path, field):
+    return os.path.join(path, 'minute_%s.npy' % field)
+
+
+def _UniverseFile(path, field):
+    return os.path.join(path, '%s%s.npy' % (UNIVERSE_PREFIX, field))
+
+
+# 是否是一个存储目录
+def IsStore(path):
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+# 把MarketData写成存储目录
+def WriteStore(data, path):
+    if not os.path.exists(path): os.makedirs(path)
+
+    for field in DAILY_FIELDS:
+        np.save(_DailyFile(path, field), np.ascontiguousarray(data.Daily[field], dtype=np.float64))
+    if data.Minute is not None:
+        for field in MINUTE_FIELDS:
+            np.save(_MinuteFile(path, field), np.ascontiguousarray(data.Minute[field], dtype=np.float64))
+    np.save(os.path.join(path, 'dates.npy'), np.array([date.toordinal() for date in data.Dates], dtype=np.int32))
+
+    meta = {
+        'version': STORE_VERSION,
+        'securities': list(data.Securities),
+        'index_stocks': data.IndexStocks,
+        'industries': data.Industries,
+        'daily_fields': DAILY_FIELDS,
+        'minute_fields': MINUTE_FIELDS if data.Minute is not None else [],
+        'minute_start_day': data.MinuteStartDay,
+    }
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, sort_keys=True)
+    WriteUniverseIndex(BuildUniverseIndex(data), path)
+
+
+# 用内存映射打开存储目录，返回MarketData，所有字段都是只读的numpy.memmap
+def OpenStore(path):
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    if meta['version'] != STORE_VERSION:
+        raise ValueError('unsupported store version %s in %s' % (meta['version'], path))
+
+    dates = [datetime.date.fromordinal(int(ordinal)) for ordinal in np.load(os.path.join(path, 'dates.npy'))]
+    daily = dict((field, np.load(_DailyFile(path, field), mmap_mode='r')) for field in meta['daily_fields'])
+    minute = None
+    if meta['minute_fields']:
+        minute = dict((field, np.load(_MinuteFile(path, field), mmap_mode='r')) for field in meta['minute_fields'])
+    securities = [str(security) for security in meta['securities']]
+    indexStocks = dict((str(index), [str(security) for security in stocks]) \
+                       for index, stocks in meta['index_stocks'].items())
+    industries = dict((str(industry), [str(security) for security in stocks]) \
+                      for industry, stocks in meta.get('industries', {}).items())
+    return MarketData(dates, securities, daily, minute, indexStocks, meta['minute_start_day'], industries)
+
+
+# 按交易日建立股票池属性索引，个股按列号编号：
+#   paused、st：(交易日 × 位图字节)，每天一行按位压缩的停牌、ST
+#   cap_order、cap_sorted：(交易日 × 个股)，每天一行按市值从小到大排列的列号和对应的市值
+# 查询不到市值（NaN）的个股记为-1，与策略的CacheMarketCap一致
+def BuildUniverseIndex(data):
+    daily = data.Daily
+    caps = np.asarray(daily['market_cap'], dtype=np.float64)
+    caps = np.where(np.isnan(caps), -1.0, caps)
+    order = np.argsort(caps, axis=1, kind='mergesort')
+    return {
+        'paused': np.packbits(np.asarray(daily['paused']) != 0, axis=1),
+        'st': np.packbits(np.asarray(daily['is_st']) != 0, axis=1),
+        'cap_order': order.astype(np.int32),
+        'cap_sorted': caps[np.arange(len(caps))[:, None], order],
+    }
+
+
+def WriteUniverseIndex(arrays, path):
+    for field in UNIVERSE_FIELDS:
+        np.save(_UniverseFile(path, field), arrays[field])
+    meta = {'version': UNIVERSE_VERSION, 'shape': list(arrays['cap_order'].shape)}
+    with open(os.path.join(path, UNIVERSE_META_FILE), 'w') as f:
+        json.dump(meta, f, sort_keys=True)
+
+
+# 用内存映射打开存储目录中的股票池属性索引，没有索引或者版本、大小与数据不一致时返回None
+def OpenUniverseIndex(path, data):
+    metaFile = os.path.join(path, UNIVERSE_META_FILE)
+    if not os.path.exists(metaFile): return None
+    with open(metaFile) as f:
+        meta = json.load(f)
+    if meta['version'] != UNIVERSE_VERSION or meta['shape'] != [len(data.Dates), len(data.Securities)]: return None
+    return dict((field, np.load(_UniverseFile(path, field), mmap_mode='r')) for field in UNIVERSE_FIELDS)
+
+
+# 股票池属性索引：存储目录中已经有索引时直接映射，否则建立一次，有存储目录时保存下来，之后的回测直接复用
+def GetUniverseIndex(data, path=None):
+    arrays = OpenUniverseIndex(path, data) if path else None
+    if arrays is None:
+        arrays = BuildUniverseIndex(data)
+        if path: WriteUniverseIndex(arrays, path)
+    return arrays
+
+
+# 把策略的LoadUniverseIndex替换为读取索引数组，结果与策略逐个读取状态、查询市值建立的索引相同。
+# 股票池中有存储里没有的个股时，仍然由策略自己建立
+def InstallUniverseIndex(backtest, arrays):
+    platform = backtest.Platform
+    data = platform.Data
+    strategy = backtest.Strategy
+    universeIndex = strategy['UniverseIndex']
+    build = strategy['LoadUniverseIndex']
+
+    def LoadUniverseIndex(securities, context):
+        securities = list(securities)
+        columns = data.SecurityIndices(securities)
+        if len(columns) == 0 or (columns < 0).any(): return build(securities, context)
+
+        # 索引按列号编号，策略按在股票池中的位置编号：位图取出股票池的列，
+        # 排好序的列号换成位置并去掉股票池以外的个股，不需要重新排序
+        day = platform.DayIndex
+        positions = np.full(len(data.Securities), -1, dtype=np.int64)
+        positions[columns] = np.arange(len(columns))
+        order = positions[arrays['cap_order'][day]]
+        inPool = order >= 0
+        return universeIndex(securities,
+                             np.packbits(np.unpackbits(arrays['paused'][day])[columns]),
+                             np.packbits(np.unpackbits(arrays['st'][day])[columns]),
+                             order[inPool], arrays['cap_sorted'][day][inPool], context.current_dt.date())
+
+    strategy['LoadUniverseIndex'] = LoadUniverseIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert market data to a memory-mapped columnar store.')
+    parser.add_argument('--csv', help='CSV data directory, see LocalBacktest.py')
+    parser.add_argument('--synthetic', type=int, help='write a synthetic universe of this many securities')
+    parser.add_argument('--days', type=int, default=250, help='trading days of synthetic data')
+    parser.add_argument('--minute', action='store_true', help='include synthetic minute bars')
+    parser.add_argument('--out', help='store directory')
+    parser.add_argument('--universe-index', metavar='STORE', help='build the universe index of an existing store')
+    args = parser.parse_args()
+
+    if args.universe_index:
+        data = OpenStore(args.universe_index)
+        WriteUniverseIndex(BuildUniverseIndex(data), args.universe_index)
+        print('universe index of %d days x %d securities written to %s' % (len(data.Dates), len(data.Securities),
+                                                                          args.universe_index))
+        return
+    if not args.out: parser.error('--out is required')
+
+    if args.csv:
+        data = LoadCsvData(args.csv)
+    else:
+        data = MakeSyntheticData(args.synthetic or 300, args.days, withMinute=args.minute)
+    WriteStore(data, args.out)
+    print('%d days x %d securities written to %s' % (len(data.Dates), len(data.Securities), args.out))
+
+
+if __name__ == '__main__':
+    main()
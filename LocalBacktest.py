@@ -0,0 +1,1064 @@
+# -*- coding: utf-8 -*-
+# 本地回测引擎：在聚宽之外运行MaBaseResearch.py
+# 按聚宽的方式把API注入到策略的全局空间中，用本地的日线、分钟线和市值数据，
+# 按天或按分钟回放initialize、run_daily和handle_data，用于性能分析和回归测试。
+#
+# 数据目录的格式（CSV）：
+#   daily.csv：date,code,open,close,high,low,volume[,pre_close,high_limit,low_limit,paused,is_st]
+#              指数（如000001.XSHG）也放在这里；缺少的列按前收盘价计算（涨跌停为前收盘价的±10%）
+#   valuation.csv：date,code,market_cap
+#   minute.csv（按分钟回测时需要）：datetime,code,open,close,high,low,volume，datetime为分钟bar的结束时间
+#   index_stocks.csv（可选）：index,code，get_index_stocks的成分股
+#   industry.csv（可选）：industry,code，get_industry_stocks的成分股，如聚宽一级行业HY001~HY011
+#
+# 与聚宽的约定：
+#   data[security]是上一个单位时间的数据（按天为前一天，按分钟为前一分钟）
+#   history、attribute_history只包括已经结束的交易日，不包括当天
+#   get_price的日线包括当天截至当前时刻的数据（开盘时open=close=开盘价）
+#   市价单按当前价格立即成交，买入按100股取整，T+1，停牌、涨停（买）、跌停（卖）时下单失败
+#   set_subportfolios把初始资金分到多个子账户，下单时用pindex指定子账户，context.portfolio为所有子账户的合计
+#   context.subportfolios的子账户只有聚宽SubPortfolio的字段（available_cash、inout_cash、long_positions等）
+#
+# 用法：
+#   python LocalBacktest.py --data DIR --start 2015-01-05 --end 2016-08-26 [--frequency minute]
+#   python LocalBacktest.py --store STORE（DataStore.py生成的内存映射存储）
+#   python LocalBacktest.py --synthetic 300 --days 120
+#   python LocalBacktest.py --synthetic 300 --api-profile api.csv（按调用位置统计API调用，明细写入api_bars.csv）
+#   python LocalBacktest.py --store STORE --universe-index（选股读取与数据一起保存的股票池属性索引，见DataStore.py）
+#   python LocalBacktest.py --synthetic 4000 --pool all --throughput（全部A股为股票池，报告每秒处理的个股数量）
+import io
+import os
+import re
+import bisect
+import datetime
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from enum import Enum
+
+STRATEGY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MaBaseResearch.py')
+
+DEF_STARTING_CASH = 1000000
+DEF_MARKET_INDEX = '000001.XSHG'
+DEF_POOL_INDEX = '000300.XSHG'
+
+# 交易费用，与聚宽2016年的默认设置一致
+DEF_BUY_COST = 0.0003  # 买入佣金
+DEF_SELL_COST = 0.0013  # 卖出佣金加印花税
+DEF_MIN_COST = 5  # 最低佣金
+
+DAILY_FIELDS = ['open', 'close', 'high', 'low', 'volume', 'pre_close', 'high_limit', 'low_limit', 'paused', 'is_st',
+                'market_cap']
+MINUTE_FIELDS = ['open', 'close', 'high', 'low', 'volume']
+PRICE_FIELDS = ['open', 'close', 'high', 'low', 'volume']
+
+MINUTES_PER_DAY = 240
+
+SYNTHETIC_INDUSTRIES = ['HY%03d' % i for i in range(1, 12)]  # 合成数据的行业：聚宽一级行业，个股按编号轮流分配
+
+
+# 每个交易日的分钟bar结束时间：9:31~11:30，13:01~15:00
+def _SessionMinutes():
+    morning = [datetime.time(9 + (30 + i) // 60, (30 + i) % 60) for i in range(1, 121)]
+    afternoon = [datetime.time(13 + i // 60, i % 60) for i in range(1, 121)]
+    return morning + afternoon
+
+
+SESSION_MINUTES = _SessionMinutes()
+SESSION_MINUTE_SLOTS = dict((t, i) for i, t in enumerate(SESSION_MINUTES))
+
+# 按分钟回测时，handle_data被调用的时刻（每个分钟bar的开始时间）
+SESSION_BAR_STARTS = [(datetime.datetime.combine(datetime.date(2000, 1, 1), t) -
+                       datetime.timedelta(minutes=1)).time() for t in SESSION_MINUTES]
+
+
+# 是否是指数：上交所000开头、深交所399开头
+def IsIndex(security):
+    return (security.startswith('000') and security.endswith('.XSHG')) or \
+           (security.startswith('399') and security.endswith('.XSHE'))
+
+
+def _ToDate(value):
+    if value is None: return None
+    if isinstance(value, datetime.datetime): return value.date()
+    if isinstance(value, datetime.date): return value
+    return pd.Timestamp(value).date()
+
+
+def _ToDatetime(value):
+    if value is None: return None
+    if isinstance(value, datetime.datetime): return value
+    if isinstance(value, datetime.date): return datetime.datetime.combine(value, datetime.time(15, 0))
+    text = str(value)
+    timestamp = pd.Timestamp(text).to_pydatetime()
+    if len(text) <= 10: timestamp = datetime.datetime.combine(timestamp.date(), datetime.time(15, 0))
+    return timestamp
+
+
+# 本地行情数据：日线和市值为(交易日 × 个股)的二维数组，分钟线为(交易日*240 × 个股)的二维数组
+class MarketData:
+    Dates = []  # 交易日，datetime.date
+    Securities = []  # 个股和指数ID
+    Daily = {}  # 字段 -> (交易日 × 个股)
+    Minute = None  # 字段 -> (交易日*240 × 个股)，没有分钟数据时为None
+    MinuteStartDay = 0  # 分钟数据从第几个交易日开始
+    IndexStocks = {}  # 指数 -> 成分股列表
+    Industries = {}  # 行业代码 -> 成分股列表
+
+    def __init__(self, dates, securities, daily, minute=None, indexStocks=None, minuteStartDay=0, industries=None):
+        self.Dates = list(dates)
+        self.Securities = list(securities)
+        self.Daily = daily
+        self.Minute = minute
+        self.MinuteStartDay = minuteStartDay
+        self.IndexStocks = indexStocks or {}
+        self.Industries = industries or {}
+        self._index = dict((security, i) for i, security in enumerate(self.Securities))
+        self._stocks = [security for security in self.Securities if not IsIndex(security)]
+
+    # 个股ID -> 列号，不存在时为-1
+    def SecurityIndex(self, security):
+        return self._index.get(security, -1)
+
+    def SecurityIndices(self, securities):
+        return np.array([self._index.get(security, -1) for security in securities], dtype=np.int64)
+
+    # 不晚于date的最后一个交易日的行号，没有时为-1
+    def DayIndex(self, date):
+        return bisect.bisect_right(self.Dates, _ToDate(date)) - 1
+
+    # 所有股票（不包括指数）
+    def Stocks(self):
+        return self._stocks
+
+    # 第dayIndex个交易日的第minuteIndex个分钟bar在分钟数据中的行号
+    def MinuteRow(self, dayIndex, minuteIndex):
+        return (dayIndex - self.MinuteStartDay) * MINUTES_PER_DAY + minuteIndex
+
+
+# 读取CSV格式的数据目录
+def LoadCsvData(path):
+    daily = pd.read_csv(os.path.join(path, 'daily.csv'), dtype={'code': str})
+    daily['date'] = pd.to_datetime(daily['date']).dt.date
+    dates = sorted(daily['date'].unique())
+    securities = sorted(daily['code'].unique())
+
+    def Pivot(frame, field, rowKey, rows):
+        table = frame.pivot(index=rowKey, columns='code', values=field)
+        return table.reindex(index=rows, columns=securities).values.astype(np.float64)
+
+    fields = {}
+    for field in PRICE_FIELDS:
+        fields[field] = Pivot(daily, field, 'date', dates)
+    # 停牌的日子沿用前一天的收盘价
+    fields['close'] = pd.DataFrame(fields['close']).ffill().values
+    for field in ['open', 'high', 'low']:
+        missing = np.isnan(fields[field])
+        fields[field][missing] = fields['close'][missing]
+    fields['volume'] = np.nan_to_num(fields['volume'])
+
+    previousClose = np.vstack([fields['close'][:1], fields['close'][:-1]])
+    fields['pre_close'] = Pivot(daily, 'pre_close', 'date', dates) if 'pre_close' in daily else previousClose
+    fields['high_limit'] = Pivot(daily, 'high_limit', 'date', dates) if 'high_limit' in daily else \
+        np.round(fields['pre_close'] * 1.1, 2)
+    fields['low_limit'] = Pivot(daily, 'low_limit', 'date', dates) if 'low_limit' in daily else \
+        np.round(fields['pre_close'] * 0.9, 2)
+    fields['paused'] = np.nan_to_num(Pivot(daily, 'paused', 'date', dates)) if 'paused' in daily else \
+        (fields['volume'] == 0).astype(np.float64)
+    fields['is_st'] = np.nan_to_num(Pivot(daily, 'is_st', 'date', dates)) if 'is_st' in daily else \
+        np.zeros_like(fields['close'])
+
+    valuationFile = os.path.join(path, 'valuation.csv')
+    if os.path.exists(valuationFile):
+        valuation = pd.read_csv(valuationFile, dtype={'code': str})
+        valuation['date'] = pd.to_datetime(valuation['date']).dt.date
+        fields['market_cap'] = Pivot(valuation, 'market_cap', 'date', dates)
+    else:
+        fields['market_cap'] = np.full_like(fields['close'], np.nan)
+
+    minute = None
+    minuteFile = os.path.join(path, 'minute.csv')
+    if os.path.exists(minuteFile):
+        frame = pd.read_csv(minuteFile, dtype={'code': str})
+        timestamps = pd.to_datetime(frame['datetime'])
+        dayRows = dict((date, i) for i, date in enumerate(dates))
+        frame['row'] = [dayRows[t.date()] * MINUTES_PER_DAY + SESSION_MINUTE_SLOTS[t.time()] for t in timestamps]
+        rows = np.arange(len(dates) * MINUTES_PER_DAY)
+        minute = {}
+        for field in MINUTE_FIELDS:
+            minute[field] = Pivot(frame, field, 'row', rows)
+        minute['close'] = pd.DataFrame(minute['close']).ffill().values
+        for field in ['open', 'high', 'low']:
+            missing = np.isnan(minute[field])
+            minute[field][missing] = minute['close'][missing]
+        minute['volume'] = np.nan_to_num(minute['volume'])
+
+    indexStocks = {}
+    indexFile = os.path.join(path, 'index_stocks.csv')
+    if os.path.exists(indexFile):
+        for index, group in pd.read_csv(indexFile, dtype={'index': str, 'code': str}).groupby('index'):
+            indexStocks[index] = list(group['code'])
+
+    industries = {}
+    industryFile = os.path.join(path, 'industry.csv')
+    if os.path.exists(industryFile):
+        for industry, group in pd.read_csv(industryFile, dtype={'industry': str, 'code': str}).groupby('industry'):
+            industries[industry] = list(group['code'])
+
+    return MarketData(dates, securities, fields, minute, indexStocks, industries=industries)
+
+
+# 合成行情数据，用于性能测试：size支股票加上大盘指数，所有股票都是000300.XSHG的成分股，按编号轮流分到SYNTHETIC_INDUSTRIES
+# @minuteDays：只为最后minuteDays个交易日生成分钟线，默认为全部交易日
+def MakeSyntheticData(size=300, days=120, start='2015-01-05', withMinute=False, seed=0, minuteDays=None):
+    rng = np.random.RandomState(seed)
+    dates = [timestamp.date() for timestamp in pd.bdate_range(start, periods=days)]
+    stocks = ['%06d.XSHE' % i for i in range(size)]
+    securities = stocks + [DEF_MARKET_INDEX]
+
+    # 个股收盘价：随机游走，涨跌幅限制在±10%
+    returns = np.clip(rng.normal(0.0005, 0.025, (days, size)), -0.1, 0.1)
+    paused = (rng.rand(days, size) < 0.02).astype(np.float64)
+    returns[paused > 0] = 0
+    close = np.round(rng.uniform(3, 60, size) * np.cumprod(1 + returns, axis=0), 2)
+    preClose = np.vstack([close[:1], close[:-1]])
+    openPrice = np.round(preClose * (1 + np.clip(rng.normal(0, 0.01, (days, size)), -0.1, 0.1)), 2)
+    openPrice[paused > 0] = preClose[paused > 0]
+    high = np.maximum(openPrice, close) * (1 + rng.uniform(0, 0.01, (days, size)))
+    low = np.minimum(openPrice, close) * (1 - rng.uniform(0, 0.01, (days, size)))
+    volume = rng.uniform(1e5, 1e7, (days, size)) * (1 - paused)
+    isST = np.tile(rng.rand(size) < 0.03, (days, 1)).astype(np.float64)
+    marketCap = close * rng.uniform(1, 200, size)  # 亿元
+
+    # 大盘指数：所有个股收益的均值
+    indexClose = 3000 * np.cumprod(1 + returns.mean(axis=1) * 3)
+    indexPreClose = np.concatenate([indexClose[:1], indexClose[:-1]])
+
+    def WithIndex(values, indexValues):
+        return np.hstack([values, np.asarray(indexValues, dtype=np.float64).reshape(-1, 1)])
+
+    fields = {
+        'open': WithIndex(openPrice, indexPreClose),
+        'close': WithIndex(close, indexClose),
+        'high': WithIndex(high, np.maximum(indexPreClose, indexClose)),
+        'low': WithIndex(low, np.minimum(indexPreClose, indexClose)),
+        'volume': WithIndex(volume, np.full(days, 1e9)),
+        'pre_close': WithIndex(preClose, indexPreClose),
+        'paused': WithIndex(paused, np.zeros(days)),
+        'is_st': WithIndex(isST, np.zeros(days)),
+        'market_cap': WithIndex(marketCap, np.full(days, np.nan)),
+    }
+    fields['high_limit'] = np.round(fields['pre_close'] * 1.1, 2)
+    fields['low_limit'] = np.round(fields['pre_close'] * 0.9, 2)
+
+    minute = None
+    minuteStartDay = 0
+    if withMinute:
+        minuteDays = min(minuteDays or days, days)
+        minuteStartDay = days - minuteDays
+        dayRows = slice(minuteStartDay, days)
+
+        # 分钟收盘价：从开盘价到收盘价的布朗桥
+        steps = np.linspace(0, 1, MINUTES_PER_DAY + 1)[1:].reshape(1, -1, 1)
+        dailyOpen = fields['open'][dayRows].reshape(minuteDays, 1, -1)
+        dailyClose = fields['close'][dayRows].reshape(minuteDays, 1, -1)
+        noise = np.cumsum(rng.normal(0, 0.001, (minuteDays, MINUTES_PER_DAY, len(securities))), axis=1)
+        noise -= noise[:, -1:, :] * steps
+        minuteClose = dailyOpen + (dailyClose - dailyOpen) * steps + dailyOpen * noise
+        minuteClose = np.clip(minuteClose, fields['low_limit'][dayRows].reshape(minuteDays, 1, -1),
+                              fields['high_limit'][dayRows].reshape(minuteDays, 1, -1))
+        minuteClose = np.round(minuteClose, 2).reshape(minuteDays * MINUTES_PER_DAY, -1)
+        minuteOpen = np.vstack([minuteClose[:1], minuteClose[:-1]])
+        minute = {
+            'open': minuteOpen,
+            'close': minuteClose,
+            'high': np.maximum(minuteOpen, minuteClose),
+            'low': np.minimum(minuteOpen, minuteClose),
+            'volume': np.repeat(fields['volume'][dayRows] / MINUTES_PER_DAY, MINUTES_PER_DAY, axis=0),
+        }
+
+    industries = dict((industry, stocks[i::len(SYNTHETIC_INDUSTRIES)]) \
+                      for i, industry in enumerate(SYNTHETIC_INDUSTRIES))
+    return MarketData(dates, securities, fields, minute, {DEF_POOL_INDEX: stocks}, minuteStartDay, industries)
+
+
+# 策略日志
+class Log:
+    Verbose = False  # 是否打印日志
+
+    def __init__(self, platform, verbose=False):
+        self._platform = platform
+        self.Verbose = verbose
+        self.Count = 0  # 日志条数
+
+    def _write(self, level, msg):
+        self.Count += 1
+        if self.Verbose:
+            print('%s - %s - %s' % (self._platform.Now, level, ' '.join(str(m) for m in msg)))
+
+    def debug(self, *msg):
+        self._write('DEBUG', msg)
+
+    def info(self, *msg):
+        self._write('INFO', msg)
+
+    def warn(self, *msg):
+        self._write('WARNING', msg)
+
+    warning = warn
+
+    def error(self, *msg):
+        self._write('ERROR', msg)
+
+    def set_level(self, *args):
+        pass
+
+
+# 订单状态，与聚宽一致
+class OrderStatus(Enum):
+    open = 0  # 未成交
+    filled = 1  # 部分成交
+    canceled = 2  # 已撤销
+    rejected = 3  # 被拒绝
+    held = 4  # 已成交
+
+
+class MarketOrderStyle:
+    def __init__(self, *args):
+        pass
+
+
+class LimitOrderStyle:
+    def __init__(self, limit_price):
+        self.limit_price = limit_price
+
+
+# 订单
+class Order:
+    def __init__(self, orderId, security, amount, isBuy, price, avgCost, commission, addTime, pindex=0):
+        self.order_id = orderId
+        self.security = security
+        self.amount = amount  # 下单数量
+        self.filled = amount  # 成交数量
+        self.is_buy = isBuy
+        self.price = price  # 成交价
+        self.avg_cost = avgCost  # 成交后的持仓成本
+        self.commission = commission
+        self.add_time = addTime
+        self.pindex = pindex  # 子账户
+        self.status = OrderStatus.held
+
+
+# 持仓
+class Position:
+    def __init__(self, security):
+        self.security = security
+        self.price = 0.0  # 最新价
+        self.avg_cost = 0.0  # 持仓成本
+        self.total_amount = 0
+        self.sellable_amount = 0  # T+1，当天买入的不能卖出
+
+    @property
+    def value(self):
+        return self.price * self.total_amount
+
+
+# 账户
+class Portfolio:
+    def __init__(self, startingCash):
+        self.starting_cash = startingCash
+        self.cash = startingCash
+        self.positions = {}  # 个股ID -> Position
+
+    @property
+    def positions_value(self):
+        return sum(position.value for position in self.positions.values())
+
+    # 持仓占用的资金，按持仓成本计算
+    @property
+    def capital_used(self):
+        return sum(position.avg_cost * position.total_amount for position in self.positions.values())
+
+    @property
+    def portfolio_value(self):
+        return self.cash + self.positions_value
+
+    @property
+    def total_value(self):
+        return self.portfolio_value
+
+    @property
+    def returns(self):
+        return self.portfolio_value / self.starting_cash - 1
+
+
+# context.subportfolios中的子账户：只提供聚宽SubPortfolio的字段，记账仍在对应的Portfolio中
+class SubPortfolio:
+    def __init__(self, portfolio):
+        self._portfolio = portfolio
+
+    inout_cash = property(lambda self: self._portfolio.starting_cash)
+    available_cash = property(lambda self: self._portfolio.cash)
+    long_positions = property(lambda self: self._portfolio.positions)
+    positions_value = property(lambda self: self._portfolio.positions_value)
+    total_value = property(lambda self: self._portfolio.total_value)
+
+
+# set_subportfolios的子账户设置，只支持股票账户
+class SubPortfolioConfig:
+    def __init__(self, cash, type='stock'):
+        self.cash = cash
+        self.type = type
+
+
+# 设置了子账户时的总账户：现金、持仓为所有子账户之和
+class PortfolioGroup:
+    def __init__(self, subportfolios):
+        self.subportfolios = subportfolios
+
+    @property
+    def starting_cash(self):
+        return sum(portfolio.starting_cash for portfolio in self.subportfolios)
+
+    @property
+    def cash(self):
+        return sum(portfolio.cash for portfolio in self.subportfolios)
+
+    # 合并后的持仓，同一支个股在多个子账户中的持仓按数量加权
+    @property
+    def positions(self):
+        positions = {}
+        for portfolio in self.subportfolios:
+            for security, position in portfolio.positions.items():
+                merged = positions.get(security)
+                if merged is None:
+                    merged = positions[security] = Position(security)
+                    merged.price = position.price
+                merged.avg_cost = (merged.avg_cost * merged.total_amount + position.avg_cost * position.total_amount) / \
+                                  (merged.total_amount + position.total_amount)
+                merged.total_amount += position.total_amount
+                merged.sellable_amount += position.sellable_amount
+        return positions
+
+    @property
+    def positions_value(self):
+        return sum(portfolio.positions_value for portfolio in self.subportfolios)
+
+    @property
+    def capital_used(self):
+        return sum(portfolio.capital_used for portfolio in self.subportfolios)
+
+    @property
+    def portfolio_value(self):
+        return self.cash + self.positions_value
+
+    @property
+    def total_value(self):
+        return self.portfolio_value
+
+    @property
+    def returns(self):
+        return self.portfolio_value / self.starting_cash - 1
+
+
+class Context:
+    def __init__(self, portfolio, runParams):
+        self.portfolio = portfolio
+        self.subportfolios = [SubPortfolio(portfolio)]
+        self.run_params = runParams
+        self.current_dt = None
+        self.previous_date = None
+        self.universe = []
+
+
+# data[security]：上一个单位时间的数据
+class SecurityUnitData:
+    def __init__(self, platform, column):
+        self._platform = platform
+        self._column = column
+
+    def _bar(self, field):
+        return self._platform.BarValue(field, self._column)
+
+    open = property(lambda self: self._bar('open'))
+    close = property(lambda self: self._bar('close'))
+    high = property(lambda self: self._bar('high'))
+    low = property(lambda self: self._bar('low'))
+    volume = property(lambda self: self._bar('volume'))
+    pre_close = property(lambda self: self._bar('pre_close'))
+    paused = property(lambda self: bool(self._platform.Data.Daily['paused'][self._platform.DayIndex - 1,
+                                                                             self._column]))
+    price = close
+
+    # 过去days天的每天的平均值，不包括当天
+    def mavg(self, days, field='close'):
+        end = self._platform.DayIndex
+        return self._platform.Data.Daily[field][max(0, end - days):end, self._column].mean()
+
+
+class BarData(dict):
+    def __init__(self, platform):
+        dict.__init__(self)
+        self._platform = platform
+
+    def __missing__(self, security):
+        column = self._platform.Data.SecurityIndex(security)
+        if column < 0: raise KeyError(security)
+        value = SecurityUnitData(self._platform, column)
+        self[security] = value
+        return value
+
+
+# get_current_data()[security]：当前时刻的数据
+class CurrentSecurityData:
+    def __init__(self, platform, column):
+        self._platform = platform
+        self._column = column
+
+    def _today(self, field):
+        return self._platform.Data.Daily[field][self._platform.DayIndex, self._column]
+
+    paused = property(lambda self: bool(self._today('paused')))
+    is_st = property(lambda self: bool(self._today('is_st')))
+    high_limit = property(lambda self: self._today('high_limit'))
+    low_limit = property(lambda self: self._today('low_limit'))
+    # 开盘价在开盘后才知道，开盘前（before_open）为NaN
+    day_open = property(lambda self: self._today('open') if self._platform.Now.time() >= SESSION_BAR_STARTS[0]
+                        else np.nan)
+    last_price = property(lambda self: self._platform.CurrentPrice(self._column))
+
+
+class CurrentData(dict):
+    def __init__(self, platform):
+        dict.__init__(self)
+        self._platform = platform
+
+    def __missing__(self, security):
+        column = self._platform.Data.SecurityIndex(security)
+        if column < 0: raise KeyError(security)
+        value = CurrentSecurityData(self._platform, column)
+        self[security] = value
+        return value
+
+
+# 查询：只支持valuation表，以及策略用到的in_、==过滤
+class _Field:
+    def __init__(self, name):
+        self.name = name
+
+    def in_(self, values):
+        return ('in', self.name, set(values))
+
+    def __eq__(self, value):
+        return ('in', self.name, set([value]))
+
+    def __hash__(self):
+        return hash(self.name)
+
+
+class _Valuation:
+    code = _Field('code')
+    market_cap = _Field('market_cap')
+
+
+class Query:
+    def __init__(self, *fields):
+        self.Fields = [field.name for field in fields]
+        self.Filters = []
+        self.Limit = None
+
+    def filter(self, *conditions):
+        self.Filters.extend(conditions)
+        return self
+
+    def limit(self, count):
+        self.Limit = count
+        return self
+
+    def order_by(self, *args):
+        return self
+
+
+# 聚宽API的本地实现，保存回测的时钟、账户和行情
+class Platform:
+    def __init__(self, data, frequency='day', startingCash=DEF_STARTING_CASH, verbose=False):
+        self.Data = data
+        self.Frequency = frequency
+        self.Portfolio = Portfolio(startingCash)
+        self.Subportfolios = [self.Portfolio]  # 没有设置子账户时只有一个，就是总账户
+        self.Context = Context(self.Portfolio, {'frequency': frequency})
+        self.Log = Log(self, verbose)
+        self.Records = []  # (时间, {名称: 值})
+        self.Orders = []
+        self.Schedules = []  # (时刻, 函数)
+        self.DayIndex = 0  # 当前交易日
+        self.MinuteIndex = 0  # 当天已经结束的分钟bar数量
+        self.Now = None
+        self._minuteMode = frequency == 'minute' and data.Minute is not None
+
+    # 注入到策略全局空间的API
+    def Api(self):
+        return {
+            'log': self.Log, 'Enum': Enum, 'OrderStatus': OrderStatus,
+            'MarketOrderStyle': MarketOrderStyle, 'LimitOrderStyle': LimitOrderStyle,
+            'query': Query, 'valuation': _Valuation,
+            'get_price': self.get_price, 'history': self.history, 'attribute_history': self.attribute_history,
+            'get_fundamentals': self.get_fundamentals, 'get_current_data': self.get_current_data,
+            'get_index_stocks': self.get_index_stocks, 'get_all_securities': self.get_all_securities,
+            'get_industry_stocks': self.get_industry_stocks,
+            'set_universe': self.set_universe, 'run_daily': self.run_daily, 'record': self.record,
+            'set_subportfolios': self.set_subportfolios, 'SubPortfolioConfig': SubPortfolioConfig,
+            'order': self.order, 'order_value': self.order_value,
+            'order_target': self.order_target, 'order_target_value': self.order_target_value,
+            'enable_profile': lambda: None, 'set_benchmark': lambda *args: None,
+            'set_option': lambda *args: None, 'set_order_cost': lambda *args, **kwargs: None,
+        }
+
+    # ------------------------------------------------------------------ 行情
+    def _columns(self, securities):
+        columns = self.Data.SecurityIndices(securities)
+        if (columns < 0).any():
+            raise KeyError('unknown securities: %s' % [s for s, c in zip(securities, columns) if c < 0][:5])
+        return columns
+
+    # 当前价格：按天为开盘价，按分钟为上一分钟的收盘价
+    def CurrentPrice(self, column):
+        if self.MinuteIndex == 0 or not self._minuteMode:
+            return self.Data.Daily['open'][self.DayIndex, column]
+        return self.Data.Minute['close'][self.Data.MinuteRow(self.DayIndex, self.MinuteIndex - 1), column]
+
+    # 上一个单位时间的bar
+    # 按分钟的第一个bar之前，上一个单位时间是前一天
+    def BarValue(self, field, column):
+        if not self._minuteMode or self.MinuteIndex == 0:
+            return self.Data.Daily[field][self.DayIndex - 1, column]
+
+        row = self.Data.MinuteRow(self.DayIndex, self.MinuteIndex - 1)
+        if field == 'pre_close':
+            if self.MinuteIndex == 1: return self.Data.Daily['pre_close'][self.DayIndex, column]
+            return self.Data.Minute['close'][row - 1, column]
+        return self.Data.Minute[field][row, column]
+
+    # 当天截至当前时刻的日线
+    def _partialDay(self, field, columns):
+        daily = self.Data.Daily
+        if field not in PRICE_FIELDS: return daily[field][self.DayIndex, columns]
+        if self.MinuteIndex == 0 or not self._minuteMode:
+            if field == 'volume': return np.zeros(len(columns))
+            return daily['open'][self.DayIndex, columns]
+
+        start = self.Data.MinuteRow(self.DayIndex, 0)
+        rows = slice(start, start + self.MinuteIndex)
+        minute = self.Data.Minute
+        if field == 'open': return daily['open'][self.DayIndex, columns]
+        if field == 'close': return minute['close'][rows.stop - 1, columns]
+        if field == 'high': return minute['high'][rows, columns].max(axis=0)
+        if field == 'low': return minute['low'][rows, columns].min(axis=0)
+        return minute['volume'][rows, columns].sum(axis=0)
+
+    # 日线窗口：行号为[start, end)的已经结束的交易日，includeToday时追加当天截至当前的数据
+    def _dailyWindow(self, field, columns, start, end, includeToday):
+        if field not in self.Data.Daily: raise ValueError('field not supported: %s' % field)
+        values = self.Data.Daily[field][start:end][:, columns]
+        dates = self.Data.Dates[start:end]
+        if includeToday:
+            values = np.vstack([values, self._partialDay(field, columns).reshape(1, -1)])
+            dates = dates + [self.Data.Dates[self.DayIndex]]
+        return values, pd.to_datetime(dates)
+
+    # 分钟线窗口：当前时刻之前已经结束的count个分钟bar
+    def _minuteWindow(self, field, columns, count):
+        if self.Data.Minute is None: raise ValueError('minute data not loaded')
+        end = self.Data.MinuteRow(self.DayIndex, self.MinuteIndex)
+        start = max(0, end - count)
+        values = self.Data.Minute[field][start:end][:, columns]
+        times = [datetime.datetime.combine(self.Data.Dates[self.Data.MinuteStartDay + row // MINUTES_PER_DAY],
+                                           SESSION_MINUTES[row % MINUTES_PER_DAY]) for row in range(start, end)]
+        return values, pd.to_datetime(times)
+
+    def _window(self, field, columns, count, unit, endDt=None, startDt=None):
+        if unit in ('1m', 'minute'):
+            return self._minuteWindow(field, columns, count)
+
+        # 不能取到当前时刻之后的数据
+        endDt = min(_ToDatetime(endDt), self.Now) if endDt is not None else self.Now
+        endDay = self.Data.DayIndex(endDt)
+        includeToday = endDay == self.DayIndex and endDt.date() == self.Data.Dates[self.DayIndex]
+        end = endDay if includeToday else endDay + 1
+        if startDt is not None:
+            start = self.Data.DayIndex(_ToDate(startDt) - datetime.timedelta(days=1)) + 1
+        else:
+            start = max(0, end - (count - (1 if includeToday else 0)))
+        return self._dailyWindow(field, columns, start, end, includeToday)
+
+    def get_price(self, security, start_date=None, end_date=None, frequency='daily', fields=None,
+                  skip_paused=False, fq='pre', count=None):
+        unit = '1m' if frequency in ('1m', 'minute') else '1d'
+        fields = [fields] if isinstance(fields, str) else (fields or PRICE_FIELDS)
+        if count is None and start_date is None: count = 1
+        securities = security if isinstance(security, (list, tuple)) else [security]
+        columns = self._columns(securities)
+
+        frames = {}
+        for field in fields:
+            values, index = self._window(field, columns, count, unit, end_date, start_date)
+            frames[field] = pd.DataFrame(values, index=index, columns=securities)
+
+        if isinstance(security, (list, tuple)):
+            return frames  # 聚宽返回pandas.Panel，按字段取出的仍然是(时间 × 个股)的DataFrame
+        return pd.DataFrame(dict((field, frames[field][security]) for field in fields), columns=fields)
+
+    def history(self, count, unit='1d', field='avg', security_list=None, df=True, skip_paused=False, fq='pre'):
+        securities = list(security_list) if security_list is not None else list(self.Context.universe)
+        values, index = self._historyWindow(field, self._columns(securities), count, unit)
+        if df: return pd.DataFrame(values, index=index, columns=securities)
+        return dict((security, values[:, i]) for i, security in enumerate(securities))
+
+    def attribute_history(self, security, count, unit='1d', fields=PRICE_FIELDS, skip_paused=True, df=True,
+                          fq='pre'):
+        fields = [fields] if isinstance(fields, str) else list(fields)
+        columns = self._columns([security])
+        frames = {}
+        index = None
+        for field in fields:
+            values, index = self._historyWindow(field, columns, count, unit)
+            frames[field] = values[:, 0]
+        if df: return pd.DataFrame(frames, index=index, columns=fields)
+        return frames
+
+    # history、attribute_history：不包括当天
+    def _historyWindow(self, field, columns, count, unit):
+        if unit in ('1m', 'minute'):
+            return self._minuteWindow(field, columns, count)
+        return self._dailyWindow(field, columns, max(0, self.DayIndex - count), self.DayIndex, False)
+
+    def get_fundamentals(self, query_object, date=None, statDate=None):
+        day = self.Data.DayIndex(date) if date is not None else self.DayIndex - 1
+        codes = None
+        for operator, name, values in query_object.Filters:
+            if name == 'code': codes = set(values) if codes is None else codes & values
+        if codes is None:
+            securities = self.Data.Stocks()
+        else:
+            # 按代码过滤时只取这些个股的列，顺序与Stocks()一致，分批查询的耗时不随全市场个股数增长
+            columns = sorted(column for column in self.Data.SecurityIndices(list(codes)) if column >= 0)
+            securities = [self.Data.Securities[column] for column in columns]
+            securities = [security for security in securities if not IsIndex(security)]
+
+        # 先用数组去掉没有市值的个股再建DataFrame，每次查询只建一次
+        securities = np.array(securities, dtype=object)
+        caps = np.asarray(self.Data.Daily['market_cap'][day, self.Data.SecurityIndices(securities)], dtype=np.float64) \
+            if len(securities) else np.zeros(0)
+        valid = ~np.isnan(caps)
+        securities, caps = securities[valid], caps[valid]
+        if query_object.Limit is not None: securities, caps = securities[:query_object.Limit], caps[:query_object.Limit]
+        values = {'code': securities, 'market_cap': caps}
+        return pd.DataFrame(OrderedDict((field, values[field]) for field in query_object.Fields))
+
+    def get_current_data(self):
+        return CurrentData(self)
+
+    def get_index_stocks(self, index_symbol, date=None):
+        if index_symbol in self.Data.IndexStocks: return list(self.Data.IndexStocks[index_symbol])
+        return self.Data.Stocks()
+
+    def get_industry_stocks(self, industry_code, date=None):
+        return list(self.Data.Industries.get(industry_code, []))
+
+    def get_all_securities(self, types=['stock'], date=None):
+        return pd.DataFrame(index=self.Data.Stocks())
+
+    def set_universe(self, securities):
+        self.Context.universe = list(securities)
+
+    # 把总账户分为多个子账户，子账户的资金之和必须等于初始资金，只能在下单之前设置
+    def set_subportfolios(self, configs):
+        if self.Orders: raise RuntimeError('set_subportfolios must be called before any order')
+        if abs(sum(config.cash for config in configs) - self.Portfolio.starting_cash) > 0.01:
+            raise ValueError('subportfolio cash does not add up to the starting cash')
+        self.Subportfolios = [Portfolio(config.cash) for config in configs]
+        self.Portfolio = PortfolioGroup(self.Subportfolios)
+        self.Context.portfolio = self.Portfolio
+        self.Context.subportfolios = [SubPortfolio(portfolio) for portfolio in self.Subportfolios]
+
+    def run_daily(self, func, time='every_bar', reference_security=None):
+        self.Schedules.append((time, func))
+
+    def record(self, **kwargs):
+        self.Records.append((self.Now, kwargs))
+
+    # ------------------------------------------------------------------ 交易
+    # @pindex：下单的子账户
+    def order(self, security, amount, style=None, pindex=0):
+        column = self.Data.SecurityIndex(security)
+        if column < 0 or amount == 0: return None
+        if self.Data.Daily['paused'][self.DayIndex, column]:
+            self.Log.warn('order failed, security paused:', security)
+            return None
+
+        price = self.CurrentPrice(column)
+        portfolio = self.Subportfolios[pindex]
+        position = portfolio.positions.get(security)
+        if amount > 0:
+            if price >= self.Data.Daily['high_limit'][self.DayIndex, column]:
+                self.Log.warn('order failed, security limit up:', security)
+                return None
+            amount = int(amount) // 100 * 100
+            while amount > 0 and amount * price * (1 + DEF_BUY_COST) > portfolio.cash:
+                amount -= 100
+            if amount <= 0: return None
+
+            value = amount * price
+            commission = max(value * DEF_BUY_COST, DEF_MIN_COST)
+            if not position:
+                position = Position(security)
+                portfolio.positions[security] = position
+            position.avg_cost = (position.avg_cost * position.total_amount + value) / (position.total_amount + amount)
+            position.total_amount += amount
+            position.price = price
+            portfolio.cash -= value + commission
+        else:
+            if not position: return None
+            if price <= self.Data.Daily['low_limit'][self.DayIndex, column]:
+                self.Log.warn('order failed, security limit down:', security)
+                return None
+            amount = min(-int(amount), position.sellable_amount)
+            if amount < position.sellable_amount: amount = amount // 100 * 100
+            if amount <= 0: return None
+
+            value = amount * price
+            commission = max(value * DEF_SELL_COST, DEF_MIN_COST)
+            position.total_amount -= amount
+            position.sellable_amount -= amount
+            position.price = price
+            portfolio.cash += value - commission
+            amount = -amount
+
+        order = Order(len(self.Orders) + 1, security, abs(amount), amount > 0, price, position.avg_cost, commission,
+                      self.Now, pindex)
+        if position.total_amount == 0: del portfolio.positions[security]
+        self.Orders.append(order)
+        return order
+
+    def order_value(self, security, value, style=None, pindex=0):
+        column = self.Data.SecurityIndex(security)
+        if column < 0: return None
+        return self.order(security, int(value / self.CurrentPrice(column)), style, pindex)
+
+    def order_target(self, security, amount, style=None, pindex=0):
+        position = self.Subportfolios[pindex].positions.get(security)
+        return self.order(security, amount - (position.total_amount if position else 0), style, pindex)
+
+    def order_target_value(self, security, value, style=None, pindex=0):
+        column = self.Data.SecurityIndex(security)
+        if column < 0: return None
+        return self.order_target(security, int(value / self.CurrentPrice(column)), style, pindex)
+
+    # ------------------------------------------------------------------ 时钟
+    def SetClock(self, dayIndex, minuteIndex, now):
+        self.DayIndex = dayIndex
+        self.MinuteIndex = minuteIndex
+        self.Now = now
+        self.Context.current_dt = now
+        self.Context.previous_date = self.Data.Dates[dayIndex - 1] if dayIndex > 0 else None
+
+    # 用当前价格更新持仓的最新价
+    def UpdatePositionPrices(self):
+        for portfolio in self.Subportfolios:
+            for security, position in portfolio.positions.items():
+                position.price = self.CurrentPrice(self.Data.SecurityIndex(security))
+
+    # 收盘：持仓按收盘价计算，当天买入的股票第二天可以卖出
+    def CloseDay(self):
+        for portfolio in self.Subportfolios:
+            for security, position in portfolio.positions.items():
+                position.price = self.Data.Daily['close'][self.DayIndex, self.Data.SecurityIndex(security)]
+                position.sellable_amount = position.total_amount
+
+
+# 替换策略源码中顶层的常量赋值，函数的默认参数、类属性也会使用新的值
+def OverrideConstants(source, constants):
+    for name, value in (constants or {}).items():
+        pattern = re.compile(r'^%s\s*=.*$' % re.escape(name), re.MULTILINE)
+        if not pattern.search(source): raise KeyError('constant not found in strategy: %s' % name)
+        source = pattern.sub(lambda match: '%s = %r' % (name, value), source, count=1)
+    return source
+
+
+# 回测结果
+class BacktestResult:
+    def __init__(self, daily, records, orders, logCount, subportfolios=None):
+        self.Daily = daily  # 每天收盘后的账户
+        self.Records = records  # record()记录的数据
+        self.Orders = orders
+        self.LogCount = logCount
+        self.Subportfolios = subportfolios or []  # 设置了子账户时，每个子账户的结果
+        self.Summary = self._summary()
+
+    def _summary(self):
+        values = self.Daily['portfolio_value'].values
+        if len(values) == 0: return {}
+        returns = np.diff(np.concatenate([[self.Daily['starting_cash'].values[0]], values])) / \
+                  np.concatenate([[self.Daily['starting_cash'].values[0]], values[:-1]])
+        totalReturns = values[-1] / self.Daily['starting_cash'].values[0] - 1
+        peak = np.maximum.accumulate(np.concatenate([[self.Daily['starting_cash'].values[0]], values]))
+        drawdown = 1 - np.concatenate([[self.Daily['starting_cash'].values[0]], values]) / peak
+        volatility = returns.std() * np.sqrt(250)
+        return {
+            'days': len(values),
+            'total_returns': totalReturns,
+            'annual_returns': (1 + totalReturns) ** (250.0 / len(values)) - 1,
+            'max_drawdown': drawdown.max(),
+            'volatility': volatility,
+            'sharpe': returns.mean() * 250 / volatility if volatility > 0 else 0.0,
+            'orders': len(self.Orders),
+        }
+
+
+# 回测引擎
+class Backtest:
+    def __init__(self, data, startDate=None, endDate=None, frequency='day', startingCash=DEF_STARTING_CASH,
+                 strategyFile=STRATEGY_FILE, verbose=False, api=None, constants=None):
+        if frequency == 'minute' and data.Minute is None:
+            raise ValueError('minute frequency needs minute data')
+
+        self.Platform = Platform(data, frequency, startingCash, verbose)
+        self.StrategyFile = strategyFile
+        self.Strategy = self.LoadStrategy(api, constants)
+
+        # 第一个交易日之前至少保留一天，data[security]需要前一天的数据
+        start = max(1, data.DayIndex(startDate) if startDate else 1)
+        if startDate and data.Dates[start] < _ToDate(startDate): start += 1
+        if frequency == 'minute': start = max(start, data.MinuteStartDay)
+        end = data.DayIndex(endDate) if endDate else len(data.Dates) - 1
+        self.DayIndices = list(range(start, end + 1))
+
+    # 按聚宽的方式加载策略：把API注入到策略的全局空间中执行
+    # @api：替换或增加的API
+    # @constants：替换策略中的全局常量，如{'DEF_NOISE_AVOID': 2}
+    def LoadStrategy(self, api=None, constants=None):
+        namespace = self.Platform.Api()
+        if api: namespace.update(api)
+        source = OverrideConstants(io.open(self.StrategyFile, encoding='utf-8').read(), constants)
+        exec(compile(source, self.StrategyFile, 'exec'), namespace)
+        return namespace
+
+    # 执行time时刻的定时任务
+    def _runSchedules(self, time):
+        for scheduleTime, func in self.Platform.Schedules:
+            if scheduleTime == time: func(self.Platform.Context)
+
+    # 回放一个交易日
+    def RunDay(self, dayIndex):
+        platform = self.Platform
+        context = platform.Context
+        strategy = self.Strategy
+        date = platform.Data.Dates[dayIndex]
+
+        platform.SetClock(dayIndex, 0, datetime.datetime.combine(date, datetime.time(9, 0)))
+        if 'before_trading_start' in strategy: strategy['before_trading_start'](context)
+        self._runSchedules('before_open')
+
+        handleData = strategy.get('handle_data')
+        bars = SESSION_BAR_STARTS if self.Platform.Frequency == 'minute' else [datetime.time(9, 30)]
+        for minuteIndex, barTime in enumerate(bars):
+            platform.SetClock(dayIndex, minuteIndex, datetime.datetime.combine(date, barTime))
+            platform.UpdatePositionPrices()
+            if minuteIndex == 0: self._runSchedules('open')
+            self._runSchedules(barTime.strftime('%H:%M'))
+            self._runSchedules('every_bar')
+            if handleData: handleData(context, BarData(platform))
+
+        platform.SetClock(dayIndex, len(bars), datetime.datetime.combine(date, datetime.time(15, 30)))
+        platform.CloseDay()
+        self._runSchedules('after_close')
+        if 'after_trading_end' in strategy: strategy['after_trading_end'](context)
+
+    def Run(self):
+        platform = self.Platform
+        platform.SetClock(self.DayIndices[0], 0,
+                          datetime.datetime.combine(platform.Data.Dates[self.DayIndices[0]], datetime.time(9, 0)))
+        self.Strategy['initialize'](platform.Context)
+
+        rows = []
+        subRows = []
+        for dayIndex in self.DayIndices:
+            self.RunDay(dayIndex)
+            date = platform.Data.Dates[dayIndex]
+            rows.append(self._dailyRow(date, platform.Portfolio))
+            subRows.append([self._dailyRow(date, portfolio) for portfolio in platform.Subportfolios])
+
+        records = pd.DataFrame([dict(values, time=time) for time, values in platform.Records])
+        subportfolios = []
+        if len(platform.Subportfolios) > 1:
+            for pindex in range(len(platform.Subportfolios)):
+                orders = [order for order in platform.Orders if order.pindex == pindex]
+                subportfolios.append(BacktestResult(self._dailyFrame([row[pindex] for row in subRows]), records,
+                                                    orders, platform.Log.Count))
+        return BacktestResult(self._dailyFrame(rows), records, platform.Orders, platform.Log.Count, subportfolios)
+
+    def _dailyRow(self, date, portfolio):
+        return (date, portfolio.portfolio_value, portfolio.cash, portfolio.positions_value, len(portfolio.positions),
+                portfolio.starting_cash)
+
+    def _dailyFrame(self, rows):
+        return pd.DataFrame(rows, columns=['date', 'portfolio_value', 'cash', 'positions_value', 'positions',
+                                           'starting_cash']).set_index('date')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run MaBaseResearch.py against local data.')
+    parser.add_argument('--data', help='data directory (CSV)')
+    parser.add_argument('--store', help='memory-mapped store written by DataStore.py')
+    parser.add_argument('--synthetic', type=int, help='use a synthetic universe of this many securities')
+    parser.add_argument('--days', type=int, default=120, help='trading days of synthetic data')
+    parser.add_argument('--start', help='start date')
+    parser.add_argument('--end', help='end date')
+    parser.add_argument('--frequency', default='day', choices=['day', 'minute'])
+    parser.add_argument('--cash', type=float, default=DEF_STARTING_CASH)
+    parser.add_argument('--verbose', action='store_true', help='print strategy logs')
+    parser.add_argument('--api-profile', help='enable the strategy API profiler and write its report to this CSV')
+    parser.add_argument('--pool', help="security pool of the strategy: an index code, or 'all' for every stock")
+    parser.add_argument('--chunk-size', type=int, help='securities per batched data call over the whole pool')
+    parser.add_argument('--throughput', action='store_true', help='print securities per second of each stage')
+    parser.add_argument('--universe-index', action='store_true',
+                        help='serve the daily universe index from the store (built on first use), see DataStore.py')
+    args = parser.parse_args()
+
+    if args.store:
+        from DataStore import OpenStore
+        data = OpenStore(args.store)
+    elif args.data:
+        data = LoadCsvData(args.data)
+    else:
+        data = MakeSyntheticData(args.synthetic or 300, args.days, withMinute=args.frequency == 'minute')
+
+    constants = {}
+    if args.api_profile: constants['Enable_ApiProfile'] = True
+    if args.pool: constants['DEF_SECURITY_POOL'] = args.pool
+    if args.chunk_size: constants['DEF_UNIVERSE_CHUNK_SIZE'] = args.chunk_size
+    backtest = Backtest(data, args.start, args.end, args.frequency, args.cash, verbose=args.verbose,
+                        constants=constants)
+    if args.universe_index:
+        from DataStore import GetUniverseIndex, InstallUniverseIndex
+        InstallUniverseIndex(backtest, GetUniverseIndex(data, args.store))
+    result = backtest.Run()
+    for key in sorted(result.Summary.keys()):
+        print('%-16s %s' % (key, result.Summary[key]))
+    if args.throughput:
+        print(backtest.Strategy['Throughput'].Report().to_string(index=False))
+
+    if args.api_profile:
+        profiler = backtest.Strategy['ApiProfilerHolder']
+        report = profiler.Report()
+        report.to_csv(args.api_profile, index=False)
+        root, ext = os.path.splitext(args.api_profile)
+        profiler.BarReport().to_csv(root + '_bars' + (ext or '.csv'), index=False)
+        print(report.to_string(index=False))
+        print(backtest.Strategy['Indicators'].Report().to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,70 @@
 # https://github.com/xfw5/Market-Research/blob/master/MaBaseResearch.py
 # 修改记录：
+# -2026-10-18
+# 1.每个bar开始时批量预取整个股票池的市场价和市值，逐个查询只作为cache未命中时的补充
+#   GetCurrentPrice统一读取close字段，与批量预取的数据保持一致
+# 2.Cache不再每个bar清空，每个字段按各自的有效期失效：市值按交易日，价格按bar。
+#   Cache有容量上限，按LRU淘汰，并统计命中、未命中和淘汰次数
+# 3.Cache改为列式存储：个股ID映射到行号，价格、市值等字段各为一列NumPy数组，支持按行号数组批量读写，
+#   去掉CacheInfo
+# 4.OnFilterSelect改为向量化实现：对整个股票池构造停牌、ST、市值区间的掩码，一次合并。
+#   原有的逐个过滤移到Reference.py（OnFilterSelectByLoop），Benchmark.py用来校验结果和对比性能
+# 5.OnFilterOrderIn改为向量化实现：每个bar对候选股批量计算均线、均线带和涨跌幅（均线由6中的滚动均线引擎提供），
+#   涨跌幅同时提供给OnRankByOrderInOption排序使用。原有实现移到Reference.py（OnFilterOrderInByLoop）
+# 6.添加滚动均线引擎RollingMaEngine：环形缓冲区 + 每个窗口一个滚动和，每天O(1)增量更新个股和大盘的均线，
+#   一次历史查询预热，同一序列上的所有均线窗口共用一个缓冲区。每个位置记录是否为有效值，
+#   均线与pandas的mean()一样跳过窗口内的NaN（缺失或停牌的bar）。原来每天查询历史求均值的GetMarketMaIndexByDay
+#   移到Reference.py，Benchmark.py用来校验
+# 7.添加本地回测引擎LocalBacktest.py，用本地数据在聚宽之外回放initialize和handle_data
+# 8.添加DataStore.py，把本地行情保存为按(日期, 个股)索引的二进制列式存储，回测时内存映射读取
+# 9.全局的过滤规则、资金管理和市场信息处理统一由SetupStrategy创建，MarketInfoHandler不再每个bar重新创建。
+#   添加ParamSweep.py，在本地多进程并行扫描策略参数
+# 10.Benchmark.py添加stages测试：按handle_data的各个阶段统计每个bar的p50/p99耗时和内存分配，
+#   覆盖300/1000/5000支股票的日线和分钟线回测，保存基线并报告回归
+# 11.添加ApiProfiler（Enable_ApiProfile开关）：按调用位置统计每个bar的数据和下单API调用次数、耗时、
+#   返回行数和cache命中率，LocalBacktest.py --api-profile导出整个回测的报告
+# 12.PD和Debug_On改为分模块的日志级别（LOG_MODULE_LEVELS）：低于级别的日志不格式化参数，
+#   日志先进入环形缓冲区，每个bar结束时批量输出，每个调用位置可以抽样和限流。
+#   逐个持仓、逐个个股的日志（IsNeedSellOff、WaterLine.Update、OnActionStopLossByPosition等）改为Debug级别，
+#   其他日志按原来PD的级别0/1/2对应Info/Warn/Error
+# 13.添加OrderPlan：OnActionBullishHandle和OnActionStopLossByPosition读取一次账户，按估算的成交计划出达到期望仓位
+#   所需的全部订单，批量提交后对账一次，不再每个订单之后重新读取账户；去掉循环中的positions.remove。
+#   对账后的仓位仍未达到要求时继续计划下一轮（最多DEF_ORDER_PLAN_ROUNDS轮），与原来按实际仓位判断的循环一致
+# 14.添加本地账本PortfolioLedger：每个bar与平台账户同步一次并报告偏差，之后按成交增量更新，
+#   UpdateCapital和OrderPlan从账本读取现金、已用资金和持仓，不再每个订单之后读取context.portfolio
+# 15.添加TrailingStopEngine：所有持仓的最高、最低盈利水位按列存为数组，每个bar一次数组运算更新水位、
+#   触发和信号，语义与原来的WaterLine、SecurityProfitStatus相同（包括水位的移动步长和Reset）。
+#   OnActionStopLoss用NeedSellOffMask一次判断所有持仓。WaterLine、SecurityProfitStatus和逐个判断的IsNeedSellOff
+#   移到Reference.py（IsNeedSellOffByLoop），Benchmark.py用来校验
+# 16.FilterLimitStocks改为向量化实现：LimitMask对当前价、涨跌停价、开盘价数组一次判断。
+#   涨跌停价和开盘价作为按交易日失效的cache字段，按分钟回测时每天只读取一次。
+#   原有实现移到Reference.py（FilterLimitStocksByLoop）
+# 17.添加开盘前的每日预计算PrepareDay：按停牌、ST、市值选出当天的候选股，预取涨跌停价，同步个股均线。
+#   盘中只为候选股、持仓和大盘指数预取当前价，只按当前价过滤涨跌停。开盘价开盘后才确定，在第一个盘中bar读取
+# 18.添加StrategyInstance和AddStrategy：一次回测中运行多个策略实例，每个实例有自己的过滤规则、资金管理、
+#   市场信息处理和子账户（pindex），共用cache、个股均线和大盘信息，每个bar只预取一次行情。
+#   子账户的字段由SubPortfolioAccount换成聚宽SubPortfolio的字段名
+# 19.添加指标备忘表IndicatorTable（Indicators）：声明式的均线ma(n)、data字段bar(field)、涨跌幅change_pct和持仓盈亏flow，
+#   每个(个股, bar)最多计算一次，OnFilterOrderIn、OnRankByOrderInOption、NeedSellOffMask和各个策略实例共用，
+#   统计每个指标的计算和复用次数。去掉SecuritiesFilter中记录涨跌幅的_changePercent
+# 20.添加股票池属性索引UniverseIndex：每个交易日建立一次停牌、ST的位图和按市值排序的数组，所有策略实例共用，
+#   选股变为位图的与运算加一次市值区间的二分查找；涨停、跌停位图每个bar只为所有实例的候选股判断一次。
+#   LoadUniverseIndex可以在本地回测中替换为读取DataStore.py与数据一起保存的索引
+# 21.去掉GetIndustryOrder，添加行业索引IndustryIndex（IndustryHolder）：在initialize中用get_industry_stocks加载，
+#   按间隔重新查询，成分股有变化时才重建。选股可以只选或者去掉某些行业（industries、excludeIndustries），
+#   资金管理可以限制每个行业的持仓数量（stocksPerIndustry）
+# 22.股票池可以是全部A股（DEF_SECURITY_POOL = 'all'）：对整个股票池的状态读取、市值和行情查询、均线预热
+#   按DEF_UNIVERSE_CHUNK_SIZE分批调用数据API，每次调用的数据量有上限，均线引擎把每批历史数据直接写入缓冲区，
+#   不合并整个股票池的DataFrame。股票池按当天的日期查询，
+#   每隔DEF_SECURITY_POOL_REFRESH_DAYS个交易日开盘前重新查询（SecurityPool），跟上新股上市、退市和指数成分股调整。
+#   添加吞吐量统计ThroughputMeter（Throughput），报告开盘前预计算和每个bar每秒处理的个股数量
+#   （每个bar按实际处理的候选股和持仓计）。盘中判断涨跌停时只为接近涨跌停价的个股读取开盘价。
+#   每个bar的耗时随当天候选股的数量增长，而不是随股票池：全部A股的候选股约为沪深300的十倍时，每个bar的耗时也约为十倍，
+#   要与沪深300的耗时相当，需要用市值、行业条件把候选股收紧到相近的数量
+# 23.OnRankByOrderInOption改为返回RankedCandidates：在(个股, 分值)数组上按需分批选出前k个（argpartition），
+#   排序结果与原来的两段排序相同，耗时随买入循环读取的个数增长。分值可以是指标备忘表中的任意指标
+#   （rankIndicator、rankParam）。原有实现移到Reference.py（OnRankByOrderInOptionByLoop）
+#
 # -2016-8-26
 # 1.去掉isBullish的判断，调整TryHoldingOnPosition
 # 2.添加宏开关来控制是否开启多条记录线的绘制
@@ -45,14 +110,44 @@
 # 1.某个时间点，获取到的个股的数据跟交易软件里看到的数据不一样，而且差距很大，但有些时间段又是正确
 #  例如平安银行2016-6-1的数据不一致，2016-7-13的数据一致
 
+import sys
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
 # 性能分析，如果不需要，请屏蔽该行
 # enable_profile()
 
 # 聚宽画线机制有点问题，开启不同记录线的实时绘制，会导致所有的线都画不出来。
 Enable_RealTime_MultiRecode = False
 
-# 调试信息开关
-Debug_On = True
+# 日志级别，级别越高，信息越明显
+LOG_DEBUG = 0
+LOG_INFO = 1
+LOG_WARN = 2
+LOG_ERROR = 3
+LOG_OFF = 4
+
+# 每个模块的日志级别，低于该级别的日志直接丢弃，不会格式化参数（替代原来的Debug_On开关）
+DEF_LOG_LEVEL = LOG_INFO  # 没有单独设置级别的模块
+LOG_MODULE_LEVELS = {
+    'Cache': LOG_INFO,
+    'Market': LOG_INFO,
+    'Filter': LOG_INFO,
+    'Security': LOG_INFO,  # 个股卖出条件，每个持仓每个bar都会输出，调试时改为LOG_DEBUG
+    'Profit': LOG_INFO,  # 盈利水位
+    'Capital': LOG_INFO,
+    'Order': LOG_INFO,
+    'Profile': LOG_INFO,
+}
+DEF_LOG_BUFFER_SIZE = 256  # 日志缓冲区的条数，满了或者每个bar结束时批量输出
+DEF_LOG_RATE_LIMIT = 50  # 每个调用位置每个bar最多输出多少条，0为不限制
+DEF_LOG_SAMPLE_EVERY = 1  # 每个调用位置每N条只输出一条，1为全部输出
+
+# API调用统计开关，开启后按调用位置统计每个bar的数据和下单API调用，每次调用有少量额外开销
+Enable_ApiProfile = False
 
 # 防止噪声阈值
 DEF_NOISE_AVOID = 1
@@ -64,6 +159,8 @@ DEF_FILTER_LIMIT_DOWN = False  # 是否过滤跌停
 DEF_LIMIT_TOLERANCE_PRECENT = 0.01  # 涨跌停容忍度
 DEF_MARKET_CAP_MIN = 0  # 最低市值
 DEF_MARKET_CAP_MAX = 5000  # 最高市值
+DEF_FILTER_INDUSTRIES = None  # 只选这些行业的个股（行业代码的列表），None为不限制
+DEF_EXCLUDE_INDUSTRIES = None  # 去掉这些行业的个股，None为不去掉
 
 # 默认买入策略值
 DEF_FILTER_HOLDING_SECURITIES = True  # 是否过滤已经持有的个股
@@ -74,12 +171,21 @@ DEF_CHANGE_PERCENT_HIGH = 11  # 最高涨幅
 # 期望买入涨幅点，优先买入该涨幅点至最高涨幅点之间的个股，
 # 如果不足，使用该涨幅点至其次最低涨幅之间的个股来补充。
 DEF_CHANGE_PERCENT_DESIRE = 5
+# 买入排序的分值：指标备忘表中的指标名和参数，如('bar', 'volume')，默认按涨跌幅排序。
+# 按其他指标排序时，ChangePercentDesire为期望的指标值
+DEF_RANK_INDICATOR = 'change_pct'
+DEF_RANK_PARAM = None
+# 买入排序每次选出多少支个股，买入循环读取到时才选出下一批
+DEF_RANK_BATCH_SIZE = 8
 
 # 默认资金管理策略值
 DEF_CAP_TOTAL_SHARE = 10  # 资金总共分为几份
 DEF_CAP_SHARE_PER_STOCK = 1  # 每支股票配多少份
 DEF_CAP_STOPLOSS_THRESHOLD = 5  # 个股止损阀值
 DEF_TOTAL_OPENING_POSITION_PER_DAY = 2  # 每次开仓的数量，按多少支个股来衡量
+DEF_CAP_STOCKS_PER_INDUSTRY = 0  # 每个行业最多持有几支个股，0为不限制
+DEF_LEDGER_DRIFT_TOLERANCE = 0.001  # 本地账本与平台账户的偏差超过总资产的这个比例时报告
+DEF_ORDER_PLAN_ROUNDS = 3  # 批量下单后按账户重新读取的仓位仍未达到要求时，最多再计划几轮
 
 # 默认盈利点信号值
 DEF_PROFIT_LINE_HIGH = 8  # 最高盈利点
@@ -100,123 +206,338 @@ DEF_POSITION_IF_MMA_FALLINGDOWN_LINE2 = 0.0  # 跌破第二条均线，保持仓
 # 仓位误差的容忍阀值
 POSITION_TOLERANCE = 0.05
 
+# Cache最多缓存的个股数量，全市场约4000支，留出余量
+DEF_CACHE_CAPACITY = 6000
+
+# 股票池：指数代码，'all'为全部A股（约4000支）
+DEF_SECURITY_POOL = '000300.XSHG'
+# 对整个股票池的处理分批进行，每批最多多少支个股：状态读取、市值和行情查询、均线预热都按批调用数据API，
+# 每次调用返回的数据和临时对象不超过一批的大小
+DEF_UNIVERSE_CHUNK_SIZE = 1000
+DEF_SECURITY_POOL_REFRESH_DAYS = 20  # 每隔多少个交易日按当天重新查询一次股票池（新股上市、退市、指数成分股调整）
+
+# 行业索引：聚宽一级行业，属于多个行业的个股归到列表中靠前的行业
+DEF_INDUSTRY_CODES = ['HY001', 'HY002', 'HY003', 'HY004', 'HY005', 'HY006', 'HY007', 'HY008', 'HY009', 'HY010',
+                      'HY011']
+DEF_INDUSTRY_REFRESH_DAYS = 20  # 每隔多少个交易日重新查询一次行业成分股，成分股有变化时才重建索引
+
+
+# 日志缓冲区
+# 日志先以(级别, 模块, 参数)的形式放进环形缓冲区，缓冲区满了或者bar结束时，相同级别的连续日志合并为一次log调用输出，
+# 参数到输出时才格式化。每个调用位置（函数名和行号）可以按DEF_LOG_SAMPLE_EVERY抽样、按DEF_LOG_RATE_LIMIT限流，
+# 被丢弃的条数在bar结束时汇总输出一次。错误日志立即输出
+class LogBuffer:
+    def __init__(self, size=DEF_LOG_BUFFER_SIZE, rateLimit=DEF_LOG_RATE_LIMIT, sampleEvery=DEF_LOG_SAMPLE_EVERY):
+        self.Size = size
+        self.RateLimit = rateLimit
+        self.SampleEvery = sampleEvery
+        self.Written = 0  # 输出的条数
+        self.Suppressed = 0  # 抽样、限流丢弃的条数
+
+        self._buffer = deque(maxlen=size)
+        self._siteCounts = {}  # 调用位置 -> 总条数，用于抽样
+        self._siteBarCounts = {}  # 调用位置 -> 本bar的条数，用于限流
+        self._barSuppressed = 0
+
+    # 由Logger调用，depth为调用位置相对于本函数的栈深度
+    def Write(self, level, module, msg, depth=2):
+        frame = sys._getframe(depth)
+        site = (frame.f_code.co_name, frame.f_lineno)
+
+        count = self._siteCounts.get(site, 0) + 1
+        self._siteCounts[site] = count
+        barCount = self._siteBarCounts.get(site, 0) + 1
+        self._siteBarCounts[site] = barCount
+        if (self.SampleEvery > 1 and (count - 1) % self.SampleEvery) or \
+                (self.RateLimit and barCount > self.RateLimit):
+            self._barSuppressed += 1
+            return
 
-# 调试信息的级别，级别越高，信息越明显
-def PD(level, *msg):
-    if Debug_On:
-        if level == 0:
-            log.info(*msg)
-        elif level == 1:
-            log.warn(*msg)
-        elif level == 2:
-            log.error(*msg)
+        self._buffer.append((level, module, msg))
+        if len(self._buffer) >= self.Size or level >= LOG_ERROR: self.Flush()
+
+    # 批量输出缓冲区中的日志
+    def Flush(self):
+        lines = []
+        lastLevel = None
+        while self._buffer:
+            level, module, msg = self._buffer.popleft()
+            if level != lastLevel and lines:
+                self._emit(lastLevel, lines)
+                lines = []
+            lastLevel = level
+            lines.append('[' + module + ']' + ' '.join(str(m) for m in msg))
+        if lines: self._emit(lastLevel, lines)
+
+    def _emit(self, level, lines):
+        self.Written += len(lines)
+        text = '\n'.join(lines)
+        if level == LOG_DEBUG:
+            log.debug(text)
+        elif level == LOG_INFO:
+            log.info(text)
+        elif level == LOG_WARN:
+            log.warn(text)
+        else:
+            log.error(text)
 
+    # 每个bar结束时调用：汇总本bar丢弃的日志，输出缓冲区，重置限流计数
+    def EndBar(self):
+        if self._barSuppressed:
+            self.Suppressed += self._barSuppressed
+            self._buffer.append((LOG_INFO, 'Log', ('suppressed', self._barSuppressed, 'messages by sampling or rate limit')))
+            self._barSuppressed = 0
+        self.Flush()
+        self._siteBarCounts.clear()
 
-# 滑动条函数，返回一个处于min和max之间的数。
-def Clamp(value, min, max):
-    if value < min:
-        return min
-    elif value > max:
-        return max
-    return value
 
+# 全局日志缓冲区
+LogHub = LogBuffer()
 
-# 判断输入值（inputValue）是否在测量值（measure）可以容忍的误差（tolerance）之内
-def IsHit(inputValue, measure, tolerance):
-    return abs(inputValue - measure) <= tolerance
 
+# 模块日志，级别由LOG_MODULE_LEVELS设置。参数与log.info相同，输出时以空格连接；
+# 需要额外计算的参数，先用IsEnabled判断
+class Logger:
+    def __init__(self, module):
+        self.Module = module
+        self.Level = LOG_MODULE_LEVELS.get(module, DEF_LOG_LEVEL)
 
-# Cache类型
-class CacheType(Enum):
-    Price = 0
-    MarketCap = 1
+    def SetLevel(self, level):
+        self.Level = level
 
+    def IsEnabled(self, level):
+        return level >= self.Level
 
-# Cache信息
-class CacheInfo:
-    Security = ''  # 个股ID
-    MakretCap = None  # 个股市值
-    CurrentPrice = None  # 个股当前市场价
+    def Debug(self, *msg):
+        if self.Level <= LOG_DEBUG: LogHub.Write(LOG_DEBUG, self.Module, msg)
 
-    def __init__(self, security, marketCap=None, currentPrice=None):
-        self.Security = security
-        self.MarketCap = marketCap
-        self.CurrentPrice = currentPrice
+    def Info(self, *msg):
+        if self.Level <= LOG_INFO: LogHub.Write(LOG_INFO, self.Module, msg)
 
-    # 读取Cache
-    def GetCache(self, security, cacheType):
-        if cacheType == CacheType.Price:
-            return self.GetCurrentPrice()
-        elif cacheType == CacheType.MarketCap:
-            return self.GetMakretCap()
-        else:
-            PD(2, 'cache type not support!')
+    def Warn(self, *msg):
+        if self.Level <= LOG_WARN: LogHub.Write(LOG_WARN, self.Module, msg)
 
-            # 更新Cache
+    def Error(self, *msg):
+        if self.Level <= LOG_ERROR: LogHub.Write(LOG_ERROR, self.Module, msg)
 
-    def Update(self, cacheType, value):
-        if cacheType == CacheType.Price:
-            self.UpdateCurrentPrice(value)
-        elif cacheType == CacheType.MarketCap:
-            self.UpdateMarketCap(value)
-        else:
-            PD(1, "Cache type only support price and market cap!")
 
-            # 更新市值
+CacheLog = Logger('Cache')
+MarketLog = Logger('Market')
+FilterLog = Logger('Filter')
+SecurityLog = Logger('Security')
+ProfitLog = Logger('Profit')
+CapitalLog = Logger('Capital')
+OrderLog = Logger('Order')
+ProfileLog = Logger('Profile')
 
-    def UpdateMarketCap(self, marketCap):
-        self.MarketCap = marketCap
 
-    # 更新当前市场价
-    def UpdateCurrentPrice(self, price):
-        self.CurrentPrice = price
+# 滑动条函数，返回一个处于min和max之间的数。
+def Clamp(value, min, max):
+    if value < min:
+        return min
+    elif value > max:
+        return max
+    return value
 
-    # 读取市值
-    def GetMakretCap(self):
-        return self.MarketCap
 
-    # 读取当前市场价
-    def GetCurrentPrice(self):
-        return self.CurrentPrice
+# 判断输入值（inputValue）是否在测量值（measure）可以容忍的误差（tolerance）之内
+def IsHit(inputValue, measure, tolerance):
+    return abs(inputValue - measure) <= tolerance
 
 
-# Cache处理
-class CacheHandler:
-    Cache = {}  # Cache内容，是一个字典，key为个股ID，value为CacheInfo
+# 把个股列表按size分批，每批是一个列表
+def Chunks(securities, size=DEF_UNIVERSE_CHUNK_SIZE):
+    for start in range(0, len(securities), size):
+        yield securities[start:start + size]
 
-    def __init__(self):
-        self.Cache = {}
+
+# Cache类型，每个类型对应列式Cache中的一列
+class CacheType(Enum):
+    Price = 0
+    MarketCap = 1
+    HighLimit = 2  # 涨停价
+    LowLimit = 3  # 跌停价
+    DayOpen = 4  # 当天开盘价
+
+
+# 每个Cache字段的有效key，由当前bar的时间计算得到，key改变时该字段失效
+# 基本面数据（市值）按交易日失效，价格按bar失效
+# 新增字段只需要在CacheType和这里各加一项
+CacheValidKeys = {
+    CacheType.Price: lambda currentDt: currentDt,
+    CacheType.MarketCap: lambda currentDt: currentDt.date(),
+    # 涨跌停价、开盘价在一个交易日内不变，按分钟回测时每天只读取一次
+    CacheType.HighLimit: lambda currentDt: currentDt.date(),
+    CacheType.LowLimit: lambda currentDt: currentDt.date(),
+    CacheType.DayOpen: lambda currentDt: currentDt.date(),
+}
+
+
+# Cache处理：列式存储
+# 个股ID映射到行号，每个字段是一列连续的NumPy数组，没有缓存的值为NaN。
+# 每列另外记录写入时的版本号，字段的有效key每改变一次，版本号加1，版本号不一致的值视为过期。
+# 过滤器可以按行号数组批量读写一整列，不需要为每支个股创建Python对象
+class CacheHandler:
+    Capacity = DEF_CACHE_CAPACITY  # 最多缓存多少支个股，超过时淘汰最久没有访问的个股
+
+    # 统计信息
+    Hits = 0  # 命中次数
+    Misses = 0  # 没有命中（包括过期）的次数
+    Evictions = 0  # 淘汰次数
+
+    def __init__(self, capacity=DEF_CACHE_CAPACITY):
+        self.Capacity = capacity
+        self.Hits = 0
+        self.Misses = 0
+        self.Evictions = 0
+
+        self._index = {}  # 个股ID -> 行号
+        self._securities = np.empty(capacity, dtype=object)  # 行号 -> 个股ID
+        self._lastAccess = np.zeros(capacity, dtype=np.int64)  # 每行最近一次访问的时钟，用于LRU淘汰
+        self._clock = 0
+        self._free = list(range(capacity - 1, -1, -1))  # 空闲的行号
+
+        self._columns = {}  # CacheType -> 值
+        self._versions = {}  # CacheType -> 每行写入时的版本号
+        self._currentVersion = {}  # CacheType -> 当前版本号
+        self._validKeys = {}  # CacheType -> 当前有效key
+        for cacheType in CacheValidKeys.keys():
+            self.AddField(cacheType)
+
+    # 添加一列
+    def AddField(self, cacheType):
+        if cacheType in self._columns: return
+        self._columns[cacheType] = np.full(self.Capacity, np.nan)
+        self._versions[cacheType] = np.full(self.Capacity, -1, dtype=np.int64)
+        self._currentVersion[cacheType] = 0
+        self._validKeys[cacheType] = None
+
+    # 每个bar开始时调用，按照当前时间刷新所有字段的有效key，不再需要每次清空cache
+    def Refresh(self, currentDt):
+        self._clock += 1
+        for cacheType, validKeyFunc in CacheValidKeys.items():
+            validKey = validKeyFunc(currentDt)
+            if validKey != self._validKeys[cacheType]:
+                self._validKeys[cacheType] = validKey
+                self._currentVersion[cacheType] += 1
+
+    # 当前缓存的个股数量
+    def Size(self):
+        return len(self._index)
+
+    # 个股ID -> 行号数组，没有缓存的个股为-1
+    # @create：为没有缓存的个股分配行号，容量不够时淘汰最久没有访问的个股
+    def GetIndices(self, securities, create=False):
+        indices = np.fromiter((self._index.get(security, -1) for security in securities), \
+                              dtype=np.int64, count=len(securities))
+        if create:
+            self._lastAccess[indices[indices >= 0]] = self._clock  # 本次请求的个股不会被淘汰
+            for i in np.nonzero(indices < 0)[0]:
+                indices[i] = self._allocate(securities[i])
+        return indices
+
+    # 按行号批量读取一列，过期、没有缓存的值为NaN
+    def GetColumn(self, cacheType, indices):
+        values = np.full(len(indices), np.nan)
+        valid = self._validMask(cacheType, indices)
+        rows = indices[valid]
+        values[valid] = self._columns[cacheType][rows]
+        self._lastAccess[rows] = self._clock
+
+        hits = int(valid.sum())
+        self.Hits += hits
+        self.Misses += len(indices) - hits
+        return values
+
+    # 按行号批量写入一列，行号为-1的值忽略
+    # NaN（没有数据）的版本号记为过期，读取时计为没有命中，不计入命中率
+    def SetColumn(self, cacheType, indices, values):
+        valid = indices >= 0
+        rows = indices[valid]
+        values = np.asarray(values, dtype=np.float64)[valid]
+        self._columns[cacheType][rows] = values
+        self._versions[cacheType][rows] = np.where(values == values, self._currentVersion[cacheType], -1)
+        self._lastAccess[rows] = self._clock
 
     # 根据个股ID，读取Cache
     def GetCache(self, security, cacheType):
-        info = self.Cache.get(security)
-        if info:
-            return info.GetCache(security, cacheType)
-        else:
-            return None
-
-            # 添加或更新Cache
+        value = self.GetColumn(cacheType, self.GetIndices([security]))[0]
+        if value != value: return None  # NaN
+        return value
 
+    # 添加或更新Cache
     def AddCache(self, security, cacheType, value):
-        info = self.Cache.get(security)
-        if not info:
-            info = CacheInfo(security)
-            info.Update(cacheType, value)
-            self.Cache[security] = info
-        else:
-            info.Update(cacheType, value)
-
-            # Cache多支个股的当前市场价
-
+        self.SetColumn(cacheType, self.GetIndices([security], True), [value])
+
+    # 行号对应的值是否有效
+    def _validMask(self, cacheType, indices):
+        valid = indices >= 0
+        valid[valid] = self._versions[cacheType][indices[valid]] == self._currentVersion[cacheType]
+        return valid
+
+    # 为个股分配一行
+    def _allocate(self, security):
+        if not self._free: self._evict()
+        if not self._free: return -1  # 所有行都在本次请求中使用，无法再分配
+
+        row = self._free.pop()
+        self._index[security] = row
+        self._securities[row] = security
+        self._lastAccess[row] = self._clock
+        for cacheType in self._columns.keys():
+            self._versions[cacheType][row] = -1
+        return row
+
+    # 淘汰最久没有访问的个股，一次淘汰1/8的容量，避免逐行淘汰
+    def _evict(self):
+        rows = np.fromiter(self._index.values(), dtype=np.int64, count=len(self._index))
+        rows = rows[self._lastAccess[rows] < self._clock]
+        if len(rows) == 0: return
+
+        count = min(len(rows), max(1, self.Capacity // 8))
+        if count < len(rows):
+            rows = rows[np.argpartition(self._lastAccess[rows], count - 1)[:count]]
+        for row in rows:
+            del self._index[self._securities[row]]
+            self._securities[row] = None
+            self._free.append(row)
+        self.Evictions += len(rows)
+
+    # 找出字段已经过期或者没有缓存的个股
+    def _missing(self, securities, cacheType):
+        valid = self._validMask(cacheType, self.GetIndices(securities))
+        return [security for security, isValid in zip(securities, valid) if not isValid]
+
+    # Cache多支个股的当前市场价
     def CacheCurrentPrice(self, securities, currentDate):
         panel = get_price(securities, end_date=currentDate, fields=['close'], frequency='1d', count=1)
         closePD = panel['close']
-        for security in securities:
-            price = closePD[security][0]  # 获取个股对应的价格
-            self.AddCache(security, CacheType.Price, price)  # 写进cache中
+        # 没有数据的个股为NaN，不会写进cache，留给GetCurrentPrice逐个查询
+        prices = closePD.reindex(columns=securities).values[-1]
+        self.SetColumn(CacheType.Price, self.GetIndices(securities, True), prices)
 
-            # Cache多支个股的市值
+    # Cache多支个股的涨停价、跌停价，开盘前已经确定，返回(涨停价, 跌停价)两个数组
+    def CacheLimitPrices(self, securities):
+        currentData = get_current_data()
+        count = len(securities)
+        statuses = [currentData[security] for security in securities]
+        highLimits = np.fromiter((status.high_limit for status in statuses), dtype=np.float64, count=count)
+        lowLimits = np.fromiter((status.low_limit for status in statuses), dtype=np.float64, count=count)
+
+        indices = self.GetIndices(securities, True)
+        self.SetColumn(CacheType.HighLimit, indices, highLimits)
+        self.SetColumn(CacheType.LowLimit, indices, lowLimits)
+        return highLimits, lowLimits
+
+    # Cache多支个股当天的开盘价：开盘后才确定，只能在盘中读取，开盘前读到的值不能缓存一整天
+    def CacheDayOpens(self, securities):
+        currentData = get_current_data()
+        dayOpens = np.fromiter((currentData[security].day_open for security in securities), dtype=np.float64,
+                               count=len(securities))
+        self.SetColumn(CacheType.DayOpen, self.GetIndices(securities, True), dayOpens)
+        return dayOpens
 
+    # Cache多支个股的市值
     def CacheMarketCap(self, securities, currentDate):
         q = query(
             valuation.code, valuation.market_cap
@@ -224,12 +545,528 @@ class CacheHandler:
             valuation.code.in_(securities)
         )
 
+        # 查询不到市值的个股，与GetCurrentMarketCapDir保持一致，记为-1，避免再逐个查询
+        # 按代码查表写入，分批查询时每批都要写一次，不用按标签赋值的Series
         df = get_fundamentals(q, currentDate)
-        if not df.empty:
-            for oneline in df.values:
-                security = oneline[0]
-                cap = oneline[1]
-                self.AddCache(security, CacheType.MakretCap, cap)
+        rows = dict(zip(df['code'].values, df['market_cap'].values)) if not df.empty else {}
+        caps = np.fromiter((rows.get(security, -1.0) for security in securities), np.float64, len(securities))
+        self.SetColumn(CacheType.MarketCap, self.GetIndices(securities, True), caps)
+
+    # 每个bar开始时，批量预取已经过期的字段：价格每个bar预取一次，市值每个交易日只预取一次
+    # 逐个查询（GetCurrentPrice、GetCurrentMarketCap）只作为cache没有命中时的补充，如大盘指数、已调出股票池的持仓
+    def Prefetch(self, securities, currentDt):
+        self.Refresh(currentDt)
+        if not securities: return
+        securities = list(securities)
+
+        for chunk in Chunks(self._missing(securities, CacheType.Price)):
+            self.CacheCurrentPrice(chunk, currentDt)
+
+        currentDate = currentDt.strftime("%Y-%m-%d")
+        for chunk in Chunks(self._missing(securities, CacheType.MarketCap)):
+            self.CacheMarketCap(chunk, currentDate)
+
+    # 打印统计信息
+    def PrintInfo(self):
+        total = self.Hits + self.Misses
+        hitRatio = float(self.Hits) / total if total > 0 else 0.0
+        CacheLog.Info('size:', self.Size(), 'hits:', self.Hits, 'misses:', self.Misses, \
+           'evictions:', self.Evictions, 'hit ratio:', hitRatio)
+
+
+# 滚动均线引擎
+# 用一个环形缓冲区保存每个序列（个股或指数）最近N天的收盘价，N为最长的均线窗口。
+# 同一个序列上的所有均线窗口共用这个缓冲区，每个窗口只维护一个滚动和与有效值的个数，
+# 每天新增一个bar时，每个序列每个窗口的更新都是O(1)，增加一条均线几乎没有额外开销。
+# 缺失或停牌的bar（NaN）不计入滚动和与个数，与pandas的mean()一样跳过NaN，窗口内没有有效值时均线为NaN。
+# 第一次使用时用一次历史数据查询预热，之后每天只查询最近两天的收盘价。
+# 历史数据按DEF_UNIVERSE_CHUNK_SIZE分批查询，每批直接写入缓冲区，不合并成整个股票池的DataFrame。
+class RollingMaEngine:
+    Windows = []  # 均线窗口，按天计算
+
+    def __init__(self, fetchHistory, windows):
+        self._fetchHistory = fetchHistory  # 函数(securities, count)，返回(日期 × 个股)的收盘价DataFrame，不包括当天，每次最多一批个股
+        self.Windows = sorted(set(windows))
+        self._length = max(self.Windows)  # 环形缓冲区的长度
+        self._index = {}  # 个股ID -> 列号
+        self._securities = []  # 列号 -> 个股ID
+        self._buffer = np.zeros((self._length, 0))  # 环形缓冲区，没有数据和NaN的位置为0
+        self._valid = np.zeros((self._length, 0), dtype=np.int8)  # 缓冲区每个位置是否有有效值（1/0）
+        self._sums = dict((window, np.zeros(0)) for window in self.Windows)  # 每个窗口的滚动和
+        self._counts = dict((window, np.zeros(0, dtype=np.int64)) for window in self.Windows)  # 每个窗口的有效值个数
+        self._head = 0  # 下一个bar写入的位置
+        self._lastDate = None  # 缓冲区中最后一个bar的日期
+        self._syncKey = None  # 上一次同步的key，同一个key只同步一次
+        self._pushes = 0  # 上一次重新求和之后写入的bar数量
+
+    # 同步到最新的bar，每天只需要调用一次，@syncKey相同时跳过，只为新增的个股预热
+    def Sync(self, securities, syncKey=None):
+        if syncKey == None or syncKey != self._syncKey:
+            self._syncKey = syncKey
+            if self._securities:
+                dates, values = self._fetch(self._securities, 2)
+                if self._lastDate in dates:
+                    # 只写入lastDate之后的bar
+                    for row in range(dates.index(self._lastDate) + 1, len(dates)):
+                        self._push(values[row], dates[row])
+                else:
+                    # 中间有缺失，重新预热
+                    self._warmUp(list(self._securities), True)
+        self._track(securities)
+
+    # 多支个股的window日均线，与data[security].mavg(window, 'close')一致
+    def GetMa(self, securities, window):
+        self._track(securities)
+        if window not in self._sums: self.AddWindow(window)
+
+        columns = np.fromiter((self._index[security] for security in securities), dtype=np.int64,
+                              count=len(securities))
+        counts = self._counts[window][columns].astype(np.float64)
+        counts[counts == 0] = np.nan
+        return self._sums[window][columns] / counts
+
+    # 添加一个均线窗口，不超过缓冲区长度时直接从缓冲区求和，否则加长缓冲区并重新预热
+    def AddWindow(self, window):
+        if window in self._sums: return
+        self.Windows = sorted(self.Windows + [window])
+        if window > self._length:
+            self._length = window
+            self._sums[window] = np.zeros(len(self._securities))
+            self._counts[window] = np.zeros(len(self._securities), dtype=np.int64)
+            self._warmUp(list(self._securities), True)
+        else:
+            self._sums[window] = self._sum(window, self._buffer)
+            self._counts[window] = self._sum(window, self._valid)
+
+    # 为还没有跟踪的个股分配列并预热
+    def _track(self, securities):
+        newSecurities = [security for security in securities if security not in self._index]
+        if newSecurities: self._warmUp(newSecurities, False)
+
+    # 分批查询多支个股过去count天的收盘价，每批写入(日期 × 个股)的数组，日期以第一批为准
+    # 返回(日期列表, 数组)，任一时刻只保留一批的DataFrame
+    def _fetch(self, securities, count):
+        dates = None
+        values = None
+        offset = 0
+        for chunk in Chunks(list(securities)):
+            df = self._fetchHistory(chunk, count)
+            if dates is None:
+                dates = list(df.index)[-count:]
+                values = np.empty((len(dates), len(securities)))
+            values[:, offset:offset + len(chunk)] = df.reindex(index=dates, columns=chunk).values
+            offset += len(chunk)
+        if dates is None: return [], np.zeros((0, len(securities)))
+        return dates, values
+
+    # 用历史数据查询预热
+    # @reset：清空缓冲区，所有列重新预热
+    def _warmUp(self, securities, reset):
+        dates, values = self._fetch(securities, self._length)
+        lastDate = dates[-1] if dates else None
+
+        if reset:
+            self._index = {}
+            self._securities = []
+            self._buffer = np.zeros((self._length, 0))
+            self._valid = np.zeros((self._length, 0), dtype=np.int8)
+            self._head = 0
+        elif self._securities and lastDate != self._lastDate:
+            # 新个股的数据与缓冲区没有对齐，说明还没有同步到最新的bar，全部重新预热
+            return self._warmUp(list(self._securities) + securities, True)
+        self._lastDate = lastDate
+
+        start = len(self._securities)
+        for security in securities:
+            self._index[security] = len(self._securities)
+            self._securities.append(security)
+
+        # 按时间顺序写入，最后一个bar位于head的前一个位置
+        block = np.zeros((self._length, len(securities)))
+        validBlock = np.zeros((self._length, len(securities)), dtype=np.int8)
+        rows = (self._head - len(values) + np.arange(len(values))) % self._length
+        valid = ~np.isnan(values)
+        block[rows] = np.where(valid, values, 0.0)
+        validBlock[rows] = valid
+        if reset:
+            self._buffer = block
+            self._valid = validBlock
+        else:
+            self._buffer = np.hstack([self._buffer, block])
+            self._valid = np.hstack([self._valid, validBlock])
+
+        columns = np.arange(start, len(self._securities))
+        for window in self._sums.keys():
+            self._sums[window] = np.concatenate([self._sums[window][:start],
+                                                 self._sum(window, self._buffer, columns)])
+            self._counts[window] = np.concatenate([self._counts[window][:start],
+                                                   self._sum(window, self._valid, columns)])
+
+    # 写入一个新的bar，每个窗口减去离开窗口的值和个数，加上新值，NaN按0计入、不计个数
+    def _push(self, values, date):
+        values = np.asarray(values, dtype=np.float64)
+        valid = (~np.isnan(values)).astype(np.int8)
+        values = np.where(valid, values, 0.0)
+        for window, sums in self._sums.items():
+            leaving = (self._head - window) % self._length
+            sums += values - self._buffer[leaving]
+            self._counts[window] += valid - self._valid[leaving]
+        self._buffer[self._head] = values
+        self._valid[self._head] = valid
+        self._head = (self._head + 1) % self._length
+        self._lastDate = date
+
+        # 定期重新求和，避免浮点误差累积
+        self._pushes += 1
+        if self._pushes >= self._length:
+            self._pushes = 0
+            for window in self._sums.keys():
+                self._sums[window] = self._sum(window, self._buffer)
+
+    # 对缓冲区（收盘价或有效值标记）最近window个bar求和
+    def _sum(self, window, buffer, columns=None):
+        rows = (self._head - 1 - np.arange(window)) % self._length
+        if columns is None: return buffer[rows].sum(axis=0)
+        return buffer[rows][:, columns].sum(axis=0)
+
+
+# 滚动均线引擎的数据源：多支个股过去count天的收盘价，引擎每次传入一批个股
+def FetchSecuritiesHistory(securities, count):
+    return history(count, unit='1d', field='close', security_list=list(securities), df=True)
+
+
+# 滚动均线引擎的数据源：指数过去count天的收盘价
+def FetchIndexHistory(securities, count):
+    return pd.DataFrame(dict((security, attribute_history(security, count, '1d', 'close')['close']) \
+                             for security in securities))
+
+
+# 指标的备忘表：声明每个指标的计算函数，每个指标对每个对象（个股，或(子账户, 个股)）每个bar最多计算一次，
+# 之后同一个bar内的所有调用者（买入筛选、排序、止损，多个策略实例）都从备忘表读取。
+# 按天有效的指标（如日均线，不包括当天）一个交易日只计算一次。
+# Computed、Reused按指标统计计算和复用的次数
+class IndicatorTable:
+    def __init__(self):
+        self._indicators = {}  # 名称 -> (计算函数, 是否按天有效, 是否依赖持仓)
+        self._memos = {}  # (名称, 参数) -> {对象: 值}
+        self._barKey = None
+        self._dayKey = None
+        self.Computed = {}  # 名称 -> 计算的次数（按对象计）
+        self.Reused = {}  # 名称 -> 从备忘表读取的次数（按对象计）
+
+    # 声明指标
+    # @compute：函数(对象列表, source, 参数)，返回与对象列表对齐的数组
+    # @daily：值在一个交易日内不变
+    # @positional：依赖持仓，成交后需要Invalidate
+    def Declare(self, name, compute, daily=False, positional=False):
+        self._indicators[name] = (compute, daily, positional)
+        self.Computed.setdefault(name, 0)
+        self.Reused.setdefault(name, 0)
+
+    # 每个bar开始时调用：清空按bar有效的指标，交易日变化时清空所有指标
+    def BeginBar(self, currentDt):
+        day = currentDt.date()
+        for (name, param) in list(self._memos.keys()):
+            if day != self._dayKey or not self._indicators[name][1]:
+                del self._memos[(name, param)]
+        self._barKey = currentDt
+        self._dayKey = day
+
+    # 清空备忘表
+    def Clear(self):
+        self._memos = {}
+        self._barKey = None
+        self._dayKey = None
+
+    # 成交后，依赖持仓的指标重新计算：去掉对象的行号，下次读取时重新计算并追加
+    def Invalidate(self, key):
+        for (name, param), memo in self._memos.items():
+            if self._indicators[name][2]: memo[0].pop(key, None)
+
+    # 取出对象列表的指标值，没有计算过的对象一次批量计算
+    # 备忘表为[对象 -> 行号, 值数组]，读取时按行号数组一次取出，不为每个对象创建Python对象
+    # @keys：对象的列表
+    # @source：计算需要的数据，如data、持仓
+    def Get(self, name, keys, source=None, param=None):
+        memo = self._memos.get((name, param))
+        if memo is None:
+            memo = self._memos[(name, param)] = [{}, np.zeros(0)]
+        index = memo[0]
+
+        if not index and keys:
+            # 这个bar第一次读取：没有重复的对象时，直接按对象列表计算，不需要逐个查找
+            index.update(zip(keys, range(len(keys))))
+            if len(index) == len(keys):
+                memo[1] = np.asarray(self._indicators[name][0](list(keys), source, param), dtype=np.float64)
+                self.Computed[name] += len(keys)
+                return memo[1].copy()
+            index.clear()
+
+        # 每个对象只查找一次行号，没有计算过的为-1
+        rows = np.fromiter((index.get(key, -1) for key in keys), dtype=np.int64, count=len(keys))
+        missing = np.nonzero(rows < 0)[0]
+        computed = 0
+        if len(missing) > 0:
+            # 去掉重复的对象，按顺序分配行号
+            row = len(memo[1])
+            unique = []
+            for i in missing:
+                key = keys[i]
+                keyRow = index.get(key)
+                if keyRow is None:
+                    keyRow = index[key] = row
+                    row += 1
+                    unique.append(key)
+                rows[i] = keyRow
+            compute = self._indicators[name][0]
+            memo[1] = np.concatenate([memo[1], np.asarray(compute(unique, source, param), dtype=np.float64)])
+            computed = len(unique)
+        self.Computed[name] += computed
+        self.Reused[name] += len(keys) - computed
+        return memo[1][rows]
+
+    # 每个指标的计算、复用次数
+    def Report(self):
+        rows = [(name, self.Computed[name], self.Reused[name]) for name in sorted(self._indicators.keys())]
+        report = pd.DataFrame(rows, columns=['indicator', 'computed', 'reused'])
+        total = report['computed'] + report['reused']
+        report['reuse_ratio'] = report['reused'] / total.where(total > 0)
+        return report
+
+    def PrintInfo(self):
+        for name in sorted(self._indicators.keys()):
+            ProfileLog.Info('indicator', name, 'computed:', self.Computed[name], 'reused:', self.Reused[name])
+
+
+# 指标：日均线，参数为天数，不包括当天，由滚动均线引擎计算
+def ComputeMa(securities, source, days):
+    return SecurityMaEngine.GetMa(securities, days)
+
+
+# 指标：data中的字段，参数为字段名，如close、pre_close
+def ComputeBarField(securities, data, field):
+    return np.array([getattr(data[security], field) for security in securities], dtype=np.float64)
+
+
+# 指标：涨跌幅的百分比，source为data，由bar指标的close、pre_close计算
+def ComputeChangePercent(securities, data, param):
+    currentPrices = Indicators.Get('bar', securities, data, 'close')
+    prePrices = Indicators.Get('bar', securities, data, 'pre_close')
+    return (currentPrices - prePrices) / prePrices * 100
+
+
+# 指标：持仓按最新价相对持仓成本的盈亏百分比，对象为(子账户, 个股)，source为个股ID -> 持仓
+def ComputeFlow(keys, positions, param):
+    holdings = [positions[security] for pindex, security in keys]
+    prices = np.array([position.price for position in holdings], dtype=np.float64)
+    avgCosts = np.array([position.avg_cost for position in holdings], dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (prices - avgCosts) / avgCosts * 100
+
+
+# 每个交易日的股票池属性索引
+# 个股按在股票池中的位置编号，停牌、ST、涨停、跌停各为一个按位压缩的位图（np.packbits），
+# 市值从小到大排序保存一份，市值区间用二分查找得到排序后的一段编号。
+# 选股变为几次位图的与运算加一次区间切片：停牌、ST、市值每天只建立一次，所有策略实例共用；
+# 涨停、跌停取决于当前价，每个bar只为所有实例当天的候选股判断一次
+class UniverseIndex:
+    # @pausedBits、stBits：停牌、ST的位图
+    # @capOrder：有市值的个股编号，按市值从小到大排列，没有市值（NaN）的个股不在其中
+    # @sortedCaps：与capOrder对齐的市值
+    def __init__(self, securities, pausedBits, stBits, capOrder, sortedCaps, date=None):
+        self.Securities = list(securities)
+        self.Date = date
+        self.Paused = pausedBits
+        self.ST = stBits
+        self._capOrder = np.asarray(capOrder, dtype=np.int64)
+        self._sortedCaps = np.asarray(sortedCaps, dtype=np.float64)
+        # 没有市值的个股，与OnFilterSelectDaily的NaN处理一致，不会被市值区间过滤掉
+        self._noCap = ~self.Bits(self._capOrder)
+
+        self.Industries = None  # 与股票池对齐的行业编号（IndustryIndex），-1为不属于任何行业，没有行业索引时为None
+        self._candidates = self.Bits([])  # 所有策略实例当天的候选股
+        self._limitKey = None
+        self._limits = {}  # 涨跌停容忍度 -> (涨停位图, 跌停位图)，按bar有效
+
+    # 由与securities对齐的停牌、ST、市值数组建立索引
+    @staticmethod
+    def Build(securities, paused, st, caps, date=None):
+        caps = np.asarray(caps, dtype=np.float64)
+        capOrder = np.argsort(caps, kind='mergesort')  # NaN排在最后
+        capOrder = capOrder[:len(caps) - int(np.isnan(caps).sum())]
+        return UniverseIndex(securities, np.packbits(paused), np.packbits(st), capOrder, caps[capOrder], date)
+
+    # 编号数组 -> 位图
+    def Bits(self, ids):
+        mask = np.zeros(len(self.Securities), dtype=bool)
+        mask[ids] = True
+        return np.packbits(mask)
+
+    # 位图 -> 编号数组，从小到大
+    def Ids(self, bits):
+        return np.nonzero(np.unpackbits(bits)[:len(self.Securities)])[0]
+
+    # 位图 -> 个股列表，顺序与股票池一致
+    def SecuritiesOf(self, bits):
+        securities = self.Securities
+        return [securities[i] for i in self.Ids(bits)]
+
+    # 市值在[low, high]之间的个股位图
+    def CapRange(self, low, high):
+        start = np.searchsorted(self._sortedCaps, low, 'left')
+        end = np.searchsorted(self._sortedCaps, high, 'right')
+        return self.Bits(self._capOrder[start:end]) | self._noCap
+
+    # 设置与股票池对齐的行业编号
+    def SetIndustries(self, industries):
+        self.Industries = np.asarray(industries, dtype=np.int64)
+
+    # 属于industryIds中任一行业的个股位图
+    def IndustryBits(self, industryIds):
+        return np.packbits(np.in1d(self.Industries, industryIds))
+
+    # 按停牌、ST、市值、行业选出当天的候选股位图，并记入所有实例的候选股
+    def Select(self, filterOption):
+        bits = ~self.Paused
+        if filterOption.Filter_ST: bits &= ~self.ST
+        bits &= self.CapRange(filterOption.MarketCapitalMin, filterOption.MarketCapitalMax)
+        if filterOption.Industries:
+            bits &= self.IndustryBits(IndustryHolder.CodeIds(filterOption.Industries))
+        if filterOption.ExcludeIndustries:
+            bits &= ~self.IndustryBits(IndustryHolder.CodeIds(filterOption.ExcludeIndustries))
+        self._candidates |= bits
+        self._limitKey = None  # 候选股变化后重新判断涨跌停
+        return bits
+
+    # 当前bar的涨停、跌停位图，只对当天的候选股判断，每个bar每种容忍度只计算一次
+    # 判断与SecurityHandler.LimitMask一致：NaN不会被判断为涨停或跌停
+    def LimitBits(self, tolerance, currentDt):
+        if self._limitKey != currentDt:
+            self._limitKey = currentDt
+            self._limits = {}
+        limits = self._limits.get(tolerance)
+        if limits is None:
+            ids = self.Ids(self._candidates)
+            securities = [self.Securities[i] for i in ids]
+            prices = GetCurrentPrices(securities, currentDt)
+            highLimits, lowLimits = GetHighLowLimits(securities)
+            # 开盘价在跌停价和涨停价之间，容忍度不超过max(涨停价, 跌停价) * tolerance，
+            # 离涨跌停价比这更远的个股不会被判断为涨停或跌停，只为其余的个股读取开盘价
+            bound = np.maximum(highLimits * tolerance, lowLimits * tolerance)
+            near = np.nonzero(~((highLimits - prices >= bound) & (prices - lowLimits >= bound)))[0]
+            dayOpens = np.full(len(securities), np.nan)
+            if len(near) > 0: dayOpens[near] = GetDayOpens([securities[i] for i in near])
+            tolerances = dayOpens * tolerance
+            count = len(self.Securities)
+            limitUp = np.zeros(count, dtype=bool)
+            limitDown = np.zeros(count, dtype=bool)
+            # 没有读取开盘价的个股容忍度为NaN，比较结果为False
+            with np.errstate(invalid='ignore'):
+                limitUp[ids] = (prices >= highLimits) | (highLimits - prices < tolerances)
+                limitDown[ids] = (prices <= lowLimits) | (prices - lowLimits < tolerances)
+            limits = self._limits[tolerance] = (np.packbits(limitUp), np.packbits(limitDown))
+        return limits
+
+    # 盘中筛选：从候选股位图中去掉当前涨停、跌停的个股，返回个股列表
+    def SelectIntraday(self, bits, filterOption, currentDt):
+        if filterOption.FilterLimitUp or filterOption.FilterLimitDown:
+            limitUp, limitDown = self.LimitBits(filterOption.LimitToleranceInPercentage, currentDt)
+            if filterOption.FilterLimitUp: bits = bits & ~limitUp
+            if filterOption.FilterLimitDown: bits = bits & ~limitDown
+        return self.SecuritiesOf(bits)
+
+
+# 行业索引
+# 每个行业的成分股为frozenset，个股 -> 行业编号为字典，判断个股属于哪个行业、是否属于某个行业都是常数时间。
+# 在initialize中查询一次所有行业的成分股，之后每隔RefreshDays个交易日重新查询，成分股有变化时才重建（Version加1）。
+# 股票池上的行业过滤由UniverseIndex的行业编号数组做位图运算
+class IndustryIndex:
+    Codes = []  # 行业代码，行业编号为在列表中的位置
+    RefreshDays = DEF_INDUSTRY_REFRESH_DAYS
+    Loaded = False  # 是否查询过成分股
+    Version = 0  # 成分股每变化一次加1
+    Queries = 0  # 查询成分股的次数（按行业计）
+
+    def __init__(self, codes=DEF_INDUSTRY_CODES, refreshDays=DEF_INDUSTRY_REFRESH_DAYS):
+        self.Codes = list(codes)
+        self.RefreshDays = refreshDays
+        self.Loaded = False
+        self.Version = 0
+        self.Queries = 0
+        self._codeIds = dict((code, i) for i, code in enumerate(self.Codes))
+        self._members = {}  # 行业代码 -> frozenset(个股ID)
+        self._industryOf = {}  # 个股ID -> 行业编号
+        self._days = 0  # 距离上次查询的交易日数
+
+    # 每个交易日开盘前调用：没有查询过或者到了刷新的间隔时重新查询，返回成分股是否有变化
+    def Refresh(self, currentDt):
+        if self.Loaded:
+            self._days += 1
+            if self._days < self.RefreshDays: return False
+        self._days = 0
+        return self.Load(currentDt.strftime("%Y-%m-%d"))
+
+    # 查询所有行业的成分股，有变化时重建个股 -> 行业编号的字典，返回是否有变化
+    def Load(self, date=None):
+        members = dict((code, frozenset(get_industry_stocks(code, date=date))) for code in self.Codes)
+        self.Queries += len(self.Codes)
+        self.Loaded = True
+        if members == self._members: return False
+
+        industryOf = {}
+        for industryId in range(len(self.Codes) - 1, -1, -1):
+            for security in members[self.Codes[industryId]]:
+                industryOf[security] = industryId
+        self._members = members
+        self._industryOf = industryOf
+        self.Version += 1
+        FilterLog.Info('industry index version', self.Version, 'securities:', len(industryOf))
+        return True
+
+    # 个股所属的行业代码，不属于任何行业时为None
+    def IndustryOf(self, security):
+        industryId = self._industryOf.get(security)
+        return None if industryId is None else self.Codes[industryId]
+
+    # 个股是否属于行业
+    def Contains(self, code, security):
+        return security in self._members.get(code, ())
+
+    # 行业的成分股
+    def Members(self, code):
+        return self._members.get(code, frozenset())
+
+    # 行业代码的列表 -> 行业编号的列表，不在索引中的代码忽略
+    def CodeIds(self, codes):
+        return [self._codeIds[code] for code in codes if code in self._codeIds]
+
+    # 与securities对齐的行业编号数组，不属于任何行业的个股为-1
+    def Ids(self, securities):
+        industryOf = self._industryOf
+        return np.fromiter((industryOf.get(security, -1) for security in securities), dtype=np.int64,
+                           count=len(securities))
+
+    # 按行业筛选的掩码：属于industries中任一行业（None为不限制），并且不属于excludeIndustries
+    def Mask(self, securities, industries=None, excludeIndustries=None):
+        ids = self.Ids(securities)
+        mask = np.ones(len(securities), dtype=bool)
+        if industries: mask &= np.in1d(ids, self.CodeIds(industries))
+        if excludeIndustries: mask &= ~np.in1d(ids, self.CodeIds(excludeIndustries))
+        return mask
+
+    # 每个行业的个股数量：行业代码 -> 数量，不属于任何行业的个股不计
+    def Counts(self, securities):
+        counts = {}
+        for security in securities:
+            code = self.IndustryOf(security)
+            if code is not None: counts[code] = counts.get(code, 0) + 1
+        return counts
+
+
+# 行业代码的列表，也可以是用|分隔的字符串（如参数扫描中的HY001|HY008），None为不限制
+def IndustryList(value):
+    if isinstance(value, basestring): return [code for code in value.split('|') if code]
+    return value
 
 
 # 选股策略
@@ -243,15 +1080,21 @@ class SecuritiesSelectionFilterOption:
     MarketCapitalMin = DEF_MARKET_CAP_MIN  # 市值下限
     MarketCapitalMax = DEF_MARKET_CAP_MAX  # 市值上限
 
+    Industries = DEF_FILTER_INDUSTRIES  # 只选这些行业的个股
+    ExcludeIndustries = DEF_EXCLUDE_INDUSTRIES  # 去掉这些行业的个股
+
     def __init__(self, filter_ST=DEF_FILTER_ST, filterLimitUp=DEF_FILTER_LIMIT_UP, \
                  filterLimitDown=DEF_FILTER_LIMIT_DOWN, toleranceInPercentage=DEF_LIMIT_TOLERANCE_PRECENT, \
-                 marketCapitalMin=DEF_MARKET_CAP_MIN, marketCapitalMax=DEF_MARKET_CAP_MAX):
+                 marketCapitalMin=DEF_MARKET_CAP_MIN, marketCapitalMax=DEF_MARKET_CAP_MAX, \
+                 industries=DEF_FILTER_INDUSTRIES, excludeIndustries=DEF_EXCLUDE_INDUSTRIES):
         self.Filter_ST = filter_ST
         self.FilterLimitUp = filterLimitUp
         self.FilterLimitDown = filterLimitDown
         self.LimitToleranceInPercentage = toleranceInPercentage
         self.MarketCapitalMin = marketCapitalMin
         self.MarketCapitalMax = marketCapitalMax
+        self.Industries = IndustryList(industries)
+        self.ExcludeIndustries = IndustryList(excludeIndustries)
 
 
 # 买入策略
@@ -265,15 +1108,21 @@ class SecuritiesOrderInFilterOption:
     ChangePercentHigh = DEF_CHANGE_PERCENT_HIGH  # 涨幅上限
     ChangePercentDesire = DEF_CHANGE_PERCENT_DESIRE  # 希望买进的涨幅点
 
+    RankIndicator = DEF_RANK_INDICATOR  # 排序的分值指标
+    RankParam = DEF_RANK_PARAM  # 分值指标的参数
+
     def __init__(self, filterHoldingSecurities=DEF_FILTER_HOLDING_SECURITIES,
                  maSamplingDays=DEF_MA_SAMPLING_DAYS_FOR_SECURITY_BUY, \
                  changePercentLow=DEF_CHANGE_PERCENT_LOW, changePercentHigh=DEF_CHANGE_PERCENT_HIGH,
-                 changePercentDesire=DEF_CHANGE_PERCENT_DESIRE):
+                 changePercentDesire=DEF_CHANGE_PERCENT_DESIRE, rankIndicator=DEF_RANK_INDICATOR,
+                 rankParam=DEF_RANK_PARAM):
         self.FilterHoldingSecurities = filterHoldingSecurities
         self.MaSamplingDays = maSamplingDays
         self.ChangePercentLow = changePercentLow
         self.ChangePercentHigh = changePercentHigh
         self.ChangePercentDesire = changePercentDesire
+        self.RankIndicator = rankIndicator
+        self.RankParam = rankParam
 
 
 # 资金管理策略
@@ -283,103 +1132,161 @@ class CapitalManagerOption:
     StopLossThreshold = DEF_CAP_STOPLOSS_THRESHOLD  # 个股止损阀值
     MaSamplingDaysForStock = DEF_MA_SAMPLING_DAYS_FOR_SECURITY  # 个股均线采样时间
     TotalOpenPositionPerDay = DEF_TOTAL_OPENING_POSITION_PER_DAY  # 每天最大开仓的数量
+    StocksPerIndustry = DEF_CAP_STOCKS_PER_INDUSTRY  # 每个行业最多持有几支个股
 
     def __init__(self, totalShare=DEF_CAP_TOTAL_SHARE, sharesPerStock=DEF_CAP_SHARE_PER_STOCK,
                  stopLossThreshold=DEF_CAP_STOPLOSS_THRESHOLD, \
                  maSamplingDaysForStock=DEF_MA_SAMPLING_DAYS_FOR_SECURITY,
-                 totalOpenPositionPerDay=DEF_TOTAL_OPENING_POSITION_PER_DAY):
+                 totalOpenPositionPerDay=DEF_TOTAL_OPENING_POSITION_PER_DAY,
+                 stocksPerIndustry=DEF_CAP_STOCKS_PER_INDUSTRY):
         self.TotalShare = totalShare
         self.SharesPerStock = sharesPerStock
         self.StopLossThreshold = stopLossThreshold
         self.MaSamplingDaysForStock = maSamplingDaysForStock
         self.TotalOpenPositionPerDay = totalOpenPositionPerDay
-
-
-# 水位,一般用来设置个股的上涨或下跌的警告线
-class WaterLine:
-    Line = DEF_WATER_LINE  # 设置的目标水位15
-    IsReverse = False  # 是否反转，默认为False，表示高于设置的水位时，IsHit状态为True，否则低于水位时，才设置IsHit状态
-
-    Active = False  # 激活状态
-    IsHit = False  # 水位是否超过设置的Line
-    HighestHit = Line  # 历史最高水位，辅助信息，用来跟踪某段时间内最高或最低的水位
-
-    def __init__(self, line, isReverse, active):
-        self.Line = line
-        self.IsReverse = isReverse
-        self.IsHit = False
-        self.Active = active
-        self.HighestHit = self.Line
-
-    def Reset(self, active=False):  # 重置水位
-        self.IsHit = False
-        self.Active = active
-        self.HighestHit = self.Line
-
-    def Update(self, security, newLine):  # 更新水位
-        if self.Active:
-            self.IsHit = self.__isHitWithLine(newLine)
-            if self.IsHit or self.IsReverse:
-                PD(2, security, 'WaterLine Hit:', self.Line, 'LowlineReverseFlag', self.IsReverse)
-                self.__updateHighestHitLine(newLine)
-
-    def __isHitWithLine(self, line):  # 私有函数，测试水位是否溢出
-        if self.IsReverse:
-            return line < self.Line
-        else:
-            return line > self.Line
-
-    def __updateHighestHitLine(self, line):  # 私有函数，测试历史最高水位是否需要更新
-        if self.IsReverse:
-            if line < self.HighestHit and line > (self.Line + DEF_WATER_LINE_MOVE_STEP):
-                self.HighestHit = line
-                self.Line = line - DEF_WATER_LINE_MOVE_STEP
-        else:
-            if line > self.HighestHit:
-                self.HighestHit = line
-                self.Line = line
-
-
-# 个股盈利状态跟踪
-class SecurityProfitStatus:
-    Security = ''  # 个股ID
-
-    HighLimitLine = WaterLine(DEF_PROFIT_LINE_HIGH, False, True)  # 设置个股盈利最高水位，默认开启
-    LowLimitLine = WaterLine(DEF_PROFIT_LINE_LOW, True, False)  # 设置个股盈利最低水位，默认关闭
-
-    # 当个股盈利到达最高水位后，如果盈利下跌到设置的最低值，发出该信号。
-    _signalRaised = False
-
-    def __init__(self, security, highLine, lowLine):
-        self.Security = security
-        self.HighLimitLine = highLine
-        self.LowLimitLine = lowLine
-
-    # 更新盈利状态
+        self.StocksPerIndustry = stocksPerIndustry
+
+
+# 一组水位线：与Reference.py中WaterLine的语义相同，每个属性是一个数组，一行对应一条水位线
+# 一次数组运算更新多行，IsReverse按行设置，水位的移动步长为DEF_WATER_LINE_MOVE_STEP
+class WaterLineArray:
+    def __init__(self, capacity):
+        self.Line = np.zeros(capacity)
+        self.HighestHit = np.zeros(capacity)
+        self.IsReverse = np.zeros(capacity, dtype=bool)
+        self.Active = np.zeros(capacity, dtype=bool)
+        self.IsHit = np.zeros(capacity, dtype=bool)
+
+    # 扩大容量，已有的行不变
+    def Grow(self, capacity):
+        for name in ('Line', 'HighestHit', 'IsReverse', 'Active', 'IsHit'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    # 初始化一行，与WaterLine的构造函数相同
+    def Init(self, row, line, isReverse, active):
+        self.Line[row] = line
+        self.IsReverse[row] = isReverse
+        self.IsHit[row] = False
+        self.Active[row] = active
+        self.HighestHit[row] = line
+
+    # 重置多行，与WaterLine.Reset相同：最高水位重置为当前的水位，水位本身不变
+    def Reset(self, rows, active=False):
+        self.IsHit[rows] = False
+        self.Active[rows] = active
+        self.HighestHit[rows] = self.Line[rows]
+
+    # 更新多行，与WaterLine.Update相同，rows不能重复
+    def Update(self, rows, values):
+        active = self.Active[rows]
+        reverse = self.IsReverse[rows]
+        line = self.Line[rows]
+        hit = np.where(reverse, values < line, values > line)
+        self.IsHit[rows[active]] = hit[active]
+
+        # 水位溢出（反转的水位不需要溢出）时，跟踪历史最高水位，并移动水位
+        update = active & (hit | reverse)
+        highest = self.HighestHit[rows]
+        reverseMove = update & reverse & (values < highest) & (values > line + DEF_WATER_LINE_MOVE_STEP)
+        move = update & ~reverse & (values > highest)
+        moved = reverseMove | move
+        self.HighestHit[rows[moved]] = values[moved]
+        self.Line[rows[reverseMove]] = values[reverseMove] - DEF_WATER_LINE_MOVE_STEP
+        self.Line[rows[move]] = values[move]
+        return update
+
+
+# 持仓的盈利状态跟踪：与Reference.py中SecurityProfitStatus的语义相同，所有持仓的最高、最低水位各存为一个WaterLineArray，
+# 每个bar对所有需要检查的持仓做一次数组运算，不再为每支持仓创建对象、逐个调用
+class TrailingStopEngine:
+    def __init__(self, capacity=16):
+        self.HighLimitLines = WaterLineArray(capacity)  # 最高盈利水位，默认开启
+        self.LowLimitLines = WaterLineArray(capacity)  # 最低盈利水位，默认关闭，反转
+        self.SignalRaised = np.zeros(capacity, dtype=bool)
+        self._index = {}  # 个股ID -> 行号
+        self._securities = np.empty(capacity, dtype=object)  # 行号 -> 个股ID
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def Size(self):
+        return len(self._index)
+
+    def Has(self, security):
+        return security in self._index
+
+    # 个股ID -> 行号数组，没有跟踪的个股为-1
+    def Rows(self, securities):
+        return np.fromiter((self._index.get(security, -1) for security in securities), dtype=np.int64,
+                           count=len(securities))
+
+    # 跟踪securities中新增的个股，不在securities中的个股不再跟踪（与原来的ActiveProfitMonitor相同）
+    def Track(self, securities):
+        if not isinstance(securities, (dict, set)): securities = set(securities)
+        for security in securities:
+            if security not in self._index: self._add(security)
+        for security in [security for security in self._index.keys() if security not in securities]:
+            row = self._index.pop(security)
+            self._securities[row] = None
+            self._free.append(row)
+
+    def _add(self, security):
+        if not self._free:
+            capacity = len(self.SignalRaised)
+            self.HighLimitLines.Grow(capacity * 2)
+            self.LowLimitLines.Grow(capacity * 2)
+            signalRaised = np.zeros(capacity * 2, dtype=bool)
+            signalRaised[:capacity] = self.SignalRaised
+            self.SignalRaised = signalRaised
+            securities = np.empty(capacity * 2, dtype=object)
+            securities[:capacity] = self._securities
+            self._securities = securities
+            self._free = list(range(capacity * 2 - 1, capacity - 1, -1))
+
+        row = self._free.pop()
+        self._index[security] = row
+        self._securities[row] = security
+        self.HighLimitLines.Init(row, DEF_PROFIT_LINE_HIGH, False, True)
+        self.LowLimitLines.Init(row, DEF_PROFIT_LINE_LOW, True, False)
+        self.SignalRaised[row] = False
+
+    # 更新多行的盈利状态，返回每行是否发出信号，与SecurityProfitStatus.Update相同
     # @clearStatusIfRaised：是否清除报警信号当触发设置的水位线时
-    def Update(self, profit, clearStatusIfRaised=False):
-        self.HighLimitLine.Update(self.Security, profit)  # 更新最高水位状态
-        if self.HighLimitLine.IsHit:  # 如果最高水位触发
-            self.LowLimitLine.Active = True  # 开启最低水位的监视
+    def Update(self, rows, profits, clearStatusIfRaised=False):
+        rows = np.asarray(rows, dtype=np.int64)
+        profits = np.asarray(profits, dtype=np.float64)
+        high = self.HighLimitLines
+        low = self.LowLimitLines
 
-        self.LowLimitLine.Update(self.Security, profit)  # 更新最低水位（前提：开启）
+        highUpdated = high.Update(rows, profits)  # 更新最高水位状态
+        low.Active[rows[high.IsHit[rows]]] = True  # 如果最高水位触发，开启最低水位的监视
+        lowUpdated = low.Update(rows, profits)  # 更新最低水位（前提：开启）
 
         # 当盈利值突破最高水位之后，再次下跌至最低水位之间之下，触发该信号
-        self._signalRaised = not self.HighLimitLine.IsHit and self.LowLimitLine.IsHit
-        raised = self._signalRaised
-        if self._signalRaised:
-            PD(2, 'Security Profit signal raised:', self.Security)
-            if clearStatusIfRaised: self.ClearStatus()
+        raised = ~high.IsHit[rows] & low.IsHit[rows]
+        self.SignalRaised[rows] = raised
+
+        if ProfitLog.IsEnabled(LOG_DEBUG):
+            for i in np.nonzero(highUpdated | lowUpdated)[0]:
+                ProfitLog.Debug(self._securities[rows[i]], 'WaterLine Hit:', high.Line[rows[i]], low.Line[rows[i]])
+        if raised.any():
+            ProfitLog.Info('Security Profit signal raised:', list(self._securities[rows[raised]]))
+            if clearStatusIfRaised: self.ClearStatus(rows[raised])
         return raised
 
-    def IsSignalRaisedUp(self, isClear):
-        raised = self._signalRaised
-        if isClear: self.ClearStatus()
+    # 与SecurityProfitStatus.IsSignalRaisedUp相同
+    def IsSignalRaisedUp(self, security, isClear):
+        row = self._index.get(security)
+        if row is None: return False
+        raised = bool(self.SignalRaised[row])
+        if isClear: self.ClearStatus([row])
         return raised
 
-    def ClearStatus(self):
-        self.HighLimitLine.Reset(True)  # 默认开启最高水位
-        self.LowLimitLine.Reset(False)  # 默认关闭最低水位
+    def ClearStatus(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        self.HighLimitLines.Reset(rows, True)  # 默认开启最高水位
+        self.LowLimitLines.Reset(rows, False)  # 默认关闭最低水位
 
 
 # 自定义的个股排名信息
@@ -395,7 +1302,64 @@ class OrderRankInfo:
     def PrintList(rankList):
         if type(rankList) == list:
             for info in rankList:
-                PD(0, info.Security, info.Flow)
+                FilterLog.Debug(info.Security, info.Flow)
+
+
+# 候选股的排名：分值不低于measure的一段从低到高，低于measure的一段从高到低，两段依次排列，分值相同时保持原来的顺序，
+# 与Reference.py中OnRankByOrderInOptionByLoop的稳定排序结果相同。分值为NaN的个股（如前收盘价为0）排在最后，
+# 原来的cmp排序中它们的位置取决于比较的次序。
+# 不对所有候选股排序：按下标读取到还没有排好的位置时，才用argpartition从剩余的个股中选出下一批（batchSize支），
+# 只对这一批排序，买入循环只读取前几个时，耗时随读取的个数增长，而不是随候选股的数量。
+# 按下标读取返回OrderRankInfo，与原来返回的列表用法相同
+class RankedCandidates:
+    def __init__(self, securities, scores, measure, batchSize=DEF_RANK_BATCH_SIZE):
+        self.Securities = list(securities)
+        self.Scores = np.asarray(scores, dtype=np.float64)
+        self.BatchSize = max(int(batchSize), 1)
+
+        valid = ~np.isnan(self.Scores)
+        flows = valid.copy()
+        flows[valid] = self.Scores[valid] >= measure
+        losses = valid & ~flows
+        # 每一段：(剩余个股的下标（原来的顺序）, 升序的排序键)
+        self._segments = [(np.nonzero(flows)[0], self.Scores[flows]),
+                          (np.nonzero(losses)[0], -self.Scores[losses]),
+                          (np.nonzero(~valid)[0], np.zeros(np.count_nonzero(~valid)))]
+        self._order = []  # 已经排好的个股下标
+
+    def __len__(self):
+        return len(self.Securities)
+
+    def __getitem__(self, i):
+        if i < 0: i += len(self.Securities)
+        if i < 0 or i >= len(self.Securities): raise IndexError(i)
+        while i >= len(self._order): self._RankNext()
+        row = self._order[i]
+        return OrderRankInfo(self.Scores[row], self.Securities[row])
+
+    def __iter__(self):
+        for i in range(len(self.Securities)):
+            yield self[i]
+
+    # 已经排好的个数
+    def Ranked(self):
+        return len(self._order)
+
+    # 从当前段的剩余个股中选出排序键最小的一批，排序后追加到已经排好的下标后面
+    def _RankNext(self):
+        while len(self._segments[0][0]) == 0: self._segments.pop(0)
+        rows, keys = self._segments[0]
+        count = self.BatchSize
+        if len(rows) <= count:
+            chosen = np.ones(len(rows), dtype=bool)
+        else:
+            # 第count小的键值之前的全部选中，与它相等的按原来的顺序补足count个
+            kth = np.partition(keys, count - 1)[count - 1]
+            chosen = keys < kth
+            chosen[np.nonzero(keys == kth)[0][:count - np.count_nonzero(chosen)]] = True
+        order = np.lexsort((rows[chosen], keys[chosen]))
+        self._order.extend(rows[chosen][order])
+        self._segments[0] = (rows[~chosen], keys[~chosen])
 
 
 # 选股处理（包括选股、买入、卖出）
@@ -403,88 +1367,112 @@ class SecuritiesFilter:
     _selectFilterOpt = SecuritiesSelectionFilterOption()  # 选股
     _orderInFilterOpt = SecuritiesOrderInFilterOption()  # 买入
 
+    _dayCandidates = None  # 开盘前选出的当天候选股
+    _dayBits = None  # 当天候选股在股票池属性索引中的位图
+    _dayUniverse = None  # 当天的股票池属性索引
+    _dayDate = None  # 候选股所属的交易日
+
     def __init__(self, selectFilterOption, orderInFilterOption):
         self._selectFilterOpt = selectFilterOption
         self._orderInFilterOpt = orderInFilterOption
-
-    # 筛选目标个股
+        self._dayCandidates = None
+        self._dayBits = None
+        self._dayUniverse = None
+        self._dayDate = None
+
+    # 开盘前选出当天的候选股：停牌、ST、市值在一个交易日内不变，每天只在股票池属性索引上筛选一次。
+    # 同时预取候选股的涨跌停价，盘中只需要按当前价过滤涨跌停；开盘价开盘后才确定，在第一个盘中bar读取
+    # @universe：当天的股票池属性索引（UniverseIndex）
+    def PrepareDay(self, universe, context):
+        self._dayUniverse = universe
+        self._dayBits = universe.Select(self._selectFilterOpt)
+        self._dayCandidates = universe.SecuritiesOf(self._dayBits)
+        self._dayDate = context.current_dt.date()
+        if self._dayCandidates and (self._selectFilterOpt.FilterLimitUp or self._selectFilterOpt.FilterLimitDown):
+            GetHighLowLimits(self._dayCandidates)
+
+    # 当天的候选股，没有为当天做过PrepareDay时返回None
+    def GetDayCandidates(self, currentDt):
+        if self._dayDate != currentDt.date(): return None
+        return self._dayCandidates
+
+    # 盘中筛选：在当天的候选股位图中，按当前价去掉涨停、跌停的个股，需要先为当天做过PrepareDay
+    def OnFilterSelectIntraday(self, context, data):
+        return self._dayUniverse.SelectIntraday(self._dayBits, self._selectFilterOpt, context.current_dt)
+
+    # 筛选目标个股：先按一个交易日内不变的条件筛选，再根据当前价过滤涨跌停
     def OnFilterSelect(self, securities, context, data):
+        target_securities = self.OnFilterSelectDaily(securities, context)
+
+        # 根据策略决定是否去掉涨停、跌停的个股
+        return SecurityHandler.FilterLimitStocks(target_securities, self._selectFilterOpt, context)
+
+    # 按停牌、ST、市值筛选：对整个股票池构造布尔掩码，一次合并
+    def OnFilterSelectDaily(self, securities, context):
         currrentDate = context.current_dt.strftime("%Y-%m-%d")
-        target_securities = []
+        securities = list(securities)
+        count = len(securities)
+        if count <= 0: return []
 
         currentData = get_current_data()
-        for security in securities:
-            securityStatus = currentData[security]
+        statuses = [currentData[security] for security in securities]
 
-            # 过滤掉停牌的个股
-            if securityStatus.paused: continue
+        # 过滤掉停牌的个股
+        selected = ~np.fromiter((status.paused for status in statuses), dtype=bool, count=count)
 
-            # 如果是ST牌，过滤掉
-            if self._selectFilterOpt.Filter_ST and securityStatus.is_st: continue
+        # 如果是ST牌，过滤掉
+        if self._selectFilterOpt.Filter_ST:
+            selected &= ~np.fromiter((status.is_st for status in statuses), dtype=bool, count=count)
 
-            # 如果市值低于marketCapMin，过滤掉
-            # 如果市值高于marketCapMax，过滤掉
-            currentMarketCap = GetCurrentMarketCap(security, currrentDate)
-            if currentMarketCap < self._selectFilterOpt.MarketCapitalMin or \
-                            currentMarketCap > self._selectFilterOpt.MarketCapitalMax: continue
+        # 如果市值低于marketCapMin，过滤掉
+        # 如果市值高于marketCapMax，过滤掉
+        # 用取反的写法，使NaN的处理与逐个过滤的版本一致
+        caps = GetCurrentMarketCaps(securities, currrentDate)
+        selected &= ~((caps < self._selectFilterOpt.MarketCapitalMin) | (caps > self._selectFilterOpt.MarketCapitalMax))
 
-            target_securities.append(security)
+        # 如果不属于选定的行业，或者属于去掉的行业，过滤掉
+        if self._selectFilterOpt.Industries or self._selectFilterOpt.ExcludeIndustries:
+            selected &= IndustryHolder.Mask(securities, self._selectFilterOpt.Industries,
+                                            self._selectFilterOpt.ExcludeIndustries)
 
-        # 根据策略决定是否去掉涨停、跌停的个股
-        target_securities = SecurityHandler.FilterLimitStocks(target_securities, self._selectFilterOpt, context)
-        return target_securities
+        return [security for security, isSelected in zip(securities, selected) if isSelected]
 
-    # 筛选符合买入策略的个股
+    # 筛选符合买入策略的个股：一次取出所有候选股的当前价、涨跌幅和滚动均线，用数组运算判断均线带和涨跌幅
     def OnFilterOrderIn(self, securities, holdingSecurities, context, data):
-        target_securities = []
+        securities = list(securities)
+        if len(securities) <= 0: return []
 
-        for security in securities:
-            securityData = data[security]
-            currentPrice = securityData.close
-            prePrice = securityData.pre_close
-
-            # 涨跌幅
-            changePercentage = (currentPrice - prePrice) / prePrice * 100
+        currentPrices = Indicators.Get('bar', securities, data, 'close')
 
-            # 均线
-            ma = securityData.mavg(self._orderInFilterOpt.MaSamplingDays, 'close')
+        # 涨跌幅，同一个bar内OnRankByOrderInOption从备忘表读取
+        changePercentages = Indicators.Get('change_pct', securities, data)
 
-            # 如果当前价格低于MA日均线或高于均线过多，过滤掉
-            if currentPrice < ma or currentPrice > ma * 1.1: continue
-            # PD(0, '[IsNeedbuy]currentPrice:',currentPrice,'More then Ma[', self._orderInFilterOpt.MaSamplingDays, ']:', security,ma)
+        # 均线
+        mas = SecurityHandler.GetMovingAverages(securities, self._orderInFilterOpt.MaSamplingDays)
 
-            # 如果涨幅低于或者高于ChangePercentLow/High， 过滤掉
-            if changePercentage < self._orderInFilterOpt.ChangePercentLow or \
-                            changePercentage > self._orderInFilterOpt.ChangePercentHigh: continue
-            # PD(0, 'stock',security,'ChangePercent', changePercentage)
+        # 如果当前价格低于MA日均线或高于均线过多，过滤掉
+        # 如果涨幅低于或者高于ChangePercentLow/High， 过滤掉
+        # 用取反的写法，使NaN的处理与逐个过滤的版本一致
+        selected = ~((currentPrices < mas) | (currentPrices > mas * 1.1))
+        selected &= ~((changePercentages < self._orderInFilterOpt.ChangePercentLow) | \
+                      (changePercentages > self._orderInFilterOpt.ChangePercentHigh))
 
-            target_securities.append(security)
+        target_securities = [security for security, isSelected in zip(securities, selected) if isSelected]
 
         if self._orderInFilterOpt.FilterHoldingSecurities:
             target_securities = SecurityHandler.FilterHoldingStocks(target_securities, holdingSecurities)
         return target_securities
 
-    # 根据期望的涨幅点对所有符合条件的待买入的个股排序
+    # 根据期望的涨幅点对所有符合条件的待买入的个股排名：分值由选项中的指标给出（默认为涨跌幅），
+    # 返回按需分批排序的RankedCandidates
     def OnRankByOrderInOption(self, securities, data, measure=None):
         if securities and len(securities) > 0:
             if measure == None: measure = self._orderInFilterOpt.ChangePercentDesire
 
-            flowList = []
-            lossList = []
-            for security in securities:
-                flow = SecurityHandler.GetChangePercent(security, data)
-                if flow >= measure:
-                    flowList.append(OrderRankInfo(flow, security))
-                else:
-                    lossList.append(OrderRankInfo(flow, security))
-
-            # 高于测量值：从低到高排序(如：0, 1，2...)
-            flowList.sort(lambda x, y: cmp(x.Flow, y.Flow), reverse=False)
-            # 低于测量值：从高到低(如：-1, -2, -3...)
-            lossList.sort(lambda x, y: cmp(x.Flow, y.Flow), reverse=True)
-            flowList.extend(lossList)
-
-            return flowList
+            # 同一个bar内，OnFilterOrderIn已经算过的涨跌幅从备忘表读取
+            scores = Indicators.Get(self._orderInFilterOpt.RankIndicator, list(securities), data,
+                                    self._orderInFilterOpt.RankParam)
+            return RankedCandidates(securities, scores, measure)
 
 
 # 大盘信息
@@ -497,6 +1485,7 @@ class MarketInfo:
 
     _current_price = 0  # 大盘当前市场价
     _market_index = DEF_MARKET_INDEX  # 大盘指数ID
+    _maEngine = None  # 大盘的滚动均线
 
     # 初始化函数，类似C++的构造函数，当声明该类时，自动被调用
     def __init__(self, marketIndex=DEF_MARKET_INDEX, maSamplingDays_1=DEF_MARKET_MA_SAMPLING_DAYS_1, \
@@ -506,10 +1495,15 @@ class MarketInfo:
             self._market_index = marketIndex
             self.MA_SAMPLING_DAYS_1 = maSamplingDays_1
             self.MA_SAMPLING_DAYS_2 = maSamplingDays_2
+            self._maEngine = RollingMaEngine(FetchIndexHistory, [maSamplingDays_1, maSamplingDays_2])
+
+    # 大盘指数ID
+    def GetMarketIndex(self):
+        return self._market_index
 
     # 打印调试信息
     def PrintInfo(self):
-        PD(0, '[Market]current price:', self._current_price, 'Ma', self.MA_SAMPLING_DAYS_1, ':', \
+        MarketLog.Info('current price:', self._current_price, 'Ma', self.MA_SAMPLING_DAYS_1, ':', \
            self.Ma_1, 'Ma', self.MA_SAMPLING_DAYS_2, ':', self.Ma_2)
 
     # 实时获取当前大盘市场价
@@ -517,38 +1511,47 @@ class MarketInfo:
         self._current_price = GetCurrentPrice(self._market_index, context.current_dt)
         return self._current_price
 
-    # 更新日均线，按天调度
+    # 更新日均线，按天调度。两条均线共用一个滚动均线引擎，第一次预热之后，每天只增量更新
     def RefreshMa(self):
-        self.Ma_1 = GetMarketMaIndexByDay(self._market_index, self.MA_SAMPLING_DAYS_1, 'close')
-        self.Ma_2 = GetMarketMaIndexByDay(self._market_index, self.MA_SAMPLING_DAYS_2, 'close')
+        self._maEngine.Sync([self._market_index])
+        self.Ma_1 = self._maEngine.GetMa([self._market_index], self.MA_SAMPLING_DAYS_1)[0]
+        self.Ma_2 = self._maEngine.GetMa([self._market_index], self.MA_SAMPLING_DAYS_2)[0]
 
 
 # 个股操作
 class SecurityHandler:
-    # 个股是否符合卖出条件
+    # 多个持仓是否符合卖出条件，与逐个判断（Reference.py中的IsNeedSellOffByLoop）的结果相同，返回布尔数组
+    # 破均线、止损用向量运算判断，其余的持仓一次更新盈利状态
     @staticmethod
-    def IsNeedSellOff(position, context, data, profitHolder, MaSamplingDays, stopLossThreshold):
-        security = data[position.security]
-        current_price = GetCurrentPrice(position.security, context.current_dt)
-        if not current_price: current_price = position.price
-        Ma = security.mavg(MaSamplingDays, 'close')
-        flow = (position.price - position.avg_cost) / position.avg_cost * 100  # ？？为什么不用current_price来算？
-
-        if current_price < Ma and flow > DEF_NOISE_AVOID:  # 破均线并且过滤均线太近造成今天买明天卖的噪声干扰
-            PD(0, '[IsNeedSellOff] Less then Ma[', MaSamplingDays, ']:', position.security, \
-               'currentPrice', current_price, 'position.price', position.price, 'costPrice', position.avg_cost, 'Ma',
-               Ma)
-            return True
-
-        if flow < 0 and -flow >= stopLossThreshold:
-            PD(0, '[IsNeedSellOff] Stop loss hit:', flow, position.security)
-            return True
-
-        profitStatus = profitHolder.get(position.security)
-        if profitStatus:
-            return profitStatus.Update(flow, True)  # 更新盈利状态
-
-        return False
+    # @portfolioIndex：持仓所在的子账户，盈亏从备忘表读取时区分不同子账户的同一支个股
+    def NeedSellOffMask(positions, context, profitHolder, MaSamplingDays, stopLossThreshold, portfolioIndex=0):
+        securities = [position.security for position in positions]
+        if not securities: return np.zeros(0, dtype=bool)
+
+        prices = GetCurrentPrices(securities, context.current_dt)
+        positionPrices = np.array([position.price for position in positions], dtype=np.float64)
+        avgCosts = np.array([position.avg_cost for position in positions], dtype=np.float64)
+        prices = np.where(prices == 0, positionPrices, prices)  # 没有当前价，使用持仓的最新价
+        Ma = SecurityHandler.GetMovingAverages(securities, MaSamplingDays)
+        flow = Indicators.Get('flow', [(portfolioIndex, security) for security in securities],
+                              dict((position.security, position) for position in positions))
+
+        # 破均线并且过滤均线太近造成今天买明天卖的噪声干扰
+        belowMa = (prices < Ma) & (flow > DEF_NOISE_AVOID)
+        stopLoss = ~belowMa & (flow < 0) & (-flow >= stopLossThreshold)
+        if SecurityLog.IsEnabled(LOG_DEBUG):
+            for i in np.nonzero(belowMa)[0]:
+                SecurityLog.Debug('[IsNeedSellOff] Less then Ma[', MaSamplingDays, ']:', securities[i], 'currentPrice',
+                                  prices[i], 'position.price', positionPrices[i], 'costPrice', avgCosts[i], 'Ma', Ma[i])
+            for i in np.nonzero(stopLoss)[0]:
+                SecurityLog.Debug('[IsNeedSellOff] Stop loss hit:', flow[i], securities[i])
+
+        sellOff = belowMa | stopLoss
+        rows = profitHolder.Rows(securities)
+        check = ~sellOff & (rows >= 0)
+        if check.any():
+            sellOff[check] = profitHolder.Update(rows[check], flow[check], True)  # 更新盈利状态
+        return sellOff
 
     # 个股是否符合买入条件
     @staticmethod
@@ -564,18 +1567,20 @@ class SecurityHandler:
     @staticmethod
     def ClampOrderValue(data, security, desireValue, cash, flow=10):  # flow用来做什么？只加20没有用的，甚至会导致交易失败
         if cash < desireValue:
-            PD(2, 'Cash no enough: ', cash, ' Desire order: ', desireValue)
+            CapitalLog.Error('Cash no enough: ', cash, ' Desire order: ', desireValue)
             return desireValue
 
         oneDeal = SecurityHandler.GetOrderCurrentValue(data, security, 100 + flow)
         return Clamp(desireValue, oneDeal, cash)
 
+    # 多支个股的days日均线，与data[security].mavg(days, 'close')一致，由滚动均线引擎增量计算，每天每支个股只计算一次
+    @staticmethod
+    def GetMovingAverages(securities, days):
+        return Indicators.Get('ma', securities, None, days)
+
     @staticmethod
     def GetChangePercent(security, data):
-        securityData = data[security]
-        currentPrice = securityData.close
-        prePrice = securityData.pre_close
-        return (currentPrice - prePrice) / prePrice * 100
+        return Indicators.Get('change_pct', [security], data)[0]
 
     # 过滤掉已经持有的股票
     @staticmethod
@@ -587,41 +1592,39 @@ class SecurityHandler:
                 filterResults.append(stock)
 
         # if len(targetSecurities) != len(filterResults):
-        #     PD(0, 'before holding filter:', targetSecurities)
-        #     PD(0, 'after holding filter:', filterResults)
+        #     FilterLog.Debug('before holding filter:', targetSecurities)
+        #     FilterLog.Debug('after holding filter:', filterResults)
 
         return filterResults
 
-    # 过滤掉涨停、跌停的个股
+    # 涨停、跌停的判断：输入对齐的当前价、涨停价、跌停价、开盘价数组，返回保留的掩码
+    # 用取反的写法，使NaN的处理与逐个过滤的版本一致（NaN不会被过滤掉）
     @staticmethod
-    def FilterLimitStocks(targetSecurities, filterOption, context):
-        if not filterOption.FilterLimitUp and not filterOption.FilterLimitDown: return targetSecurities
-
-        filterResults = []
-        cd = get_current_data()
-
-        for stock in targetSecurities:
-            currentPrice = GetCurrentPrice(stock, context.current_dt)
-            high_limit = cd[stock].high_limit
-            low_limit = cd[stock].low_limit
+    def LimitMask(prices, highLimits, lowLimits, dayOpens, filterOption):
+        # 设置涨停（跌停）与当前价格之间的允许波动阀值，为当天开盘价的0.01
+        tolerances = dayOpens * filterOption.LimitToleranceInPercentage
+        keep = np.ones(len(prices), dtype=bool)
 
-            # 设置涨停（跌停）与当前价格之间的允许波动阀值，为当天开盘价的0.01
-            tolerance = cd[stock].day_open * filterOption.LimitToleranceInPercentage
+        # 高于涨停或接近涨停容忍度，过滤掉
+        if filterOption.FilterLimitUp:
+            keep &= ~((prices >= highLimits) | (highLimits - prices < tolerances))
 
-            # 高于涨停或接近涨停容忍度，过滤掉
-            if filterOption.FilterLimitUp:
-                if currentPrice >= high_limit or high_limit - currentPrice < tolerance: continue
+        # 低于跌停或接近跌停容忍度，过滤掉
+        if filterOption.FilterLimitDown:
+            keep &= ~((prices <= lowLimits) | (prices - lowLimits < tolerances))
+        return keep
 
-            # 低于跌停或接近跌停容忍度，过滤掉
-            if filterOption.FilterLimitDown:
-                if currentPrice <= low_limit or currentPrice - low_limit < tolerance: continue
-
-            filterResults.append(stock)
+    # 过滤掉涨停、跌停的个股：当前价按bar批量读取，涨跌停价和开盘价按天缓存
+    @staticmethod
+    def FilterLimitStocks(targetSecurities, filterOption, context):
+        if not filterOption.FilterLimitUp and not filterOption.FilterLimitDown: return targetSecurities
+        securities = list(targetSecurities)
+        if not securities: return []
 
-        # if len(targetSecurities) != len(filterResults):
-        #     PD(0, 'before limit filter:', targetSecurities)
-        #     PD(0, 'after limit filter:', filterResults)
-        return filterResults
+        prices = GetCurrentPrices(securities, context.current_dt)
+        highLimits, lowLimits, dayOpens = GetLimitPrices(securities)
+        keep = SecurityHandler.LimitMask(prices, highLimits, lowLimits, dayOpens, filterOption)
+        return [security for security, isKept in zip(securities, keep) if isKept]
 
     # 记录交易、下单信息
     @staticmethod
@@ -632,48 +1635,190 @@ class SecurityHandler:
         else:
             record(title=orderStatus.amount)
 
-        log.info(msg, '[' + orderStatus.security + ']:', orderStatus.status, \
-                 ' mount:', orderStatus.amount, 'Price:', orderStatus.price, 'avg_cost:', orderStatus.avg_cost)
+        OrderLog.Info(msg, '[' + orderStatus.security + ']:', orderStatus.status, \
+                      ' mount:', orderStatus.amount, 'Price:', orderStatus.price, 'avg_cost:', orderStatus.avg_cost)
+
+
+# 本地账本
+# 每个bar开始时与平台账户同步一次，之后按订单的成交增量更新现金、已用资金（按持仓成本）和每支持仓，
+# 仓位水平、持仓盈亏都是O(1)读取，不需要每个订单之后重新读取context.portfolio。
+# 同步时与平台账户对比，偏差超过DEF_LEDGER_DRIFT_TOLERANCE时记录并报告（如未立即成交的订单、没有计入的费用）
+class PortfolioLedger:
+    Cash = 0.0
+    CapitalUsed = 0.0  # 持仓成本
+    MarketValue = 0.0  # 持仓市值
+
+    def __init__(self):
+        self.Cash = 0.0
+        self.CapitalUsed = 0.0
+        self.MarketValue = 0.0
+        self.Drifts = []  # (时间, 现金偏差, 已用资金偏差, 持仓数量不一致的个股数)
+        self._holdings = {}  # 个股ID -> [持仓数量, 可卖出数量, 持仓成本, 最新价]
+        self._synced = False
+
+    # 与平台账户同步，返回同步前的偏差是否超出容忍度
+    def Sync(self, portfolio, currentDt=None):
+        holdings = {}
+        marketValue = 0.0
+        for position in portfolio.positions.values():
+            holdings[position.security] = [position.total_amount, position.sellable_amount, position.avg_cost,
+                                           position.price]
+            marketValue += position.price * position.total_amount
+
+        drifted = False
+        if self._synced:
+            cashDrift = portfolio.cash - self.Cash
+            usedDrift = portfolio.capital_used - self.CapitalUsed
+            amountDrift = len(set(holdings.keys()) ^ set(self._holdings.keys())) + \
+                          sum(1 for security, holding in holdings.items() \
+                              if security in self._holdings and self._holdings[security][0] != holding[0])
+            tolerance = DEF_LEDGER_DRIFT_TOLERANCE * (portfolio.cash + marketValue)
+            if abs(cashDrift) > tolerance or abs(usedDrift) > tolerance or amountDrift:
+                drifted = True
+                self.Drifts.append((currentDt, cashDrift, usedDrift, amountDrift))
+                CapitalLog.Warn('Ledger drift, cash:', cashDrift, 'used:', usedDrift, 'holdings:', amountDrift)
+
+        self.Cash = portfolio.cash
+        self.CapitalUsed = portfolio.capital_used
+        self.MarketValue = marketValue
+        self._holdings = holdings
+        self._synced = True
+        return drifted
+
+    # 按订单的成交更新账本
+    def ApplyFill(self, order):
+        if not order or not order.filled: return
+        commission = getattr(order, 'commission', 0.0) or 0.0
+        value = order.filled * order.price
+        holding = self._holdings.get(order.security)
+
+        if order.is_buy:
+            if holding is None:
+                holding = self._holdings[order.security] = [0, 0, 0.0, order.price]
+            holding[2] = (holding[2] * holding[0] + value) / (holding[0] + order.filled)
+            holding[0] += order.filled
+            holding[3] = order.price
+            self.Cash -= value + commission
+            self.CapitalUsed += value
+            self.MarketValue += value
+        elif holding is not None:
+            holding[0] -= order.filled
+            holding[1] -= order.filled
+            self.Cash += value - commission
+            self.CapitalUsed -= holding[2] * order.filled
+            self.MarketValue -= holding[3] * order.filled
+            if holding[0] <= 0: del self._holdings[order.security]
+
+    # 仓位水平：已用资金 / (已用资金 + 现金)
+    def Position(self):
+        total = self.CapitalUsed + self.Cash
+        return self.CapitalUsed / total if total > 0 else 0.0
+
+    # 总资产，持仓按最近一次同步或成交的价格计算
+    def PortfolioValue(self):
+        return self.Cash + self.MarketValue
+
+    # 持仓数量，没有持仓为0
+    def Amount(self, security):
+        holding = self._holdings.get(security)
+        return holding[0] if holding else 0
+
+    # 持仓盈亏的百分比，没有持仓为None
+    def Profit(self, security):
+        holding = self._holdings.get(security)
+        if not holding or not holding[2]: return None
+        return (holding[3] - holding[2]) / holding[2] * 100
+
+
+# 批量下单计划
+# 从账本读取一次现金和已用资金，按估算的成交逐个更新仓位，计算出达到期望仓位所需的全部订单，再一次提交。
+# 估算的成交按100股取整，不包括交易费用，实际仓位以提交后重新读取的账户为准
+class OrderPlan:
+    def __init__(self, ledger, portfolioIndex=0):
+        self.Cash = ledger.Cash
+        self.CapitalUsed = ledger.CapitalUsed
+        self._ledger = ledger
+        self._pindex = portfolioIndex  # 下单的子账户
+        self._orders = []  # (个股ID, 目标金额或None)，None表示清仓
+
+    # 估算的仓位
+    def Position(self):
+        total = self.CapitalUsed + self.Cash
+        return self.CapitalUsed / total if total > 0 else 0.0
+
+    def Count(self):
+        return len(self._orders)
+
+    # 计划买入个股，使个股的持仓金额达到value
+    def Buy(self, security, value, price):
+        self._orders.append((security, value))
+        if not price or price != price: return  # 没有价格，无法估算
+
+        amount = min(int(value / price) - self._ledger.Amount(security), int(self.Cash / price)) // 100 * 100
+        if amount > 0:
+            self.CapitalUsed += amount * price
+            self.Cash -= amount * price
+
+    # 计划清仓个股，只有可卖出的部分（T+1）会成交
+    def SellOff(self, position):
+        self._orders.append((position.security, None))
+        self.CapitalUsed -= position.avg_cost * position.sellable_amount
+        self.Cash += position.price * position.sellable_amount
+
+    # 提交所有订单，返回[(个股ID, 订单)]，下单失败的订单为None
+    def Submit(self):
+        results = []
+        for security, value in self._orders:
+            if value is None:
+                results.append((security, order_target(security, 0, MarketOrderStyle(), pindex=self._pindex)))
+            else:
+                results.append((security, order_target_value(security, value, MarketOrderStyle(),
+                                                             pindex=self._pindex)))
+        self._orders = []
+        return results
 
 
 # 资金管理
 class CapitalManager:
     CMOption = CapitalManagerOption()
-    ProfitHolder = {}
+    ProfitHolder = TrailingStopEngine()  # 持仓的盈利状态
     _securitiesFilter = SecuritiesFilter('', '')  # 策略过滤器
 
     _currentCapitalPosition = 0.0  # 当前仓位
+    Ledger = PortfolioLedger()  # 本地账本
+    PortfolioIndex = 0  # 下单的子账户，多个策略实例时每个实例一个
 
-    def __init__(self, managerOption, securitiesFilter):
+    def __init__(self, managerOption, securitiesFilter, portfolioIndex=0):
+        self.Ledger = PortfolioLedger()
+        self.ProfitHolder = TrailingStopEngine()
+        self.PortfolioIndex = portfolioIndex
         if isinstance(managerOption, CapitalManagerOption) and \
                 isinstance(securitiesFilter, SecuritiesFilter):
             self.CMOption = managerOption
             self._securitiesFilter = securitiesFilter
 
-    # 更新仓位
+    # 每个bar开始时，本地账本与平台账户同步一次
+    def SyncLedger(self, context):
+        self.Ledger.Sync(context.portfolio, context.current_dt)
+        self.UpdateCapital(context)
+
+    # 更新仓位，从本地账本读取
     def UpdateCapital(self, context):
-        cash = context.portfolio.cash
-        capital_used = context.portfolio.capital_used
-        portfolio_value = context.portfolio.portfolio_value
-        self._currentCapitalPosition = capital_used / (capital_used + cash)
+        ledger = self.Ledger
+        self._currentCapitalPosition = ledger.Position()
 
-        PD(0, 'portfolio: ', portfolio_value, 'Current cash:', cash, 'used:', capital_used, 'position: ',
-           self._currentCapitalPosition)
+        CapitalLog.Debug('portfolio: ', ledger.PortfolioValue(), 'Current cash:', ledger.Cash, 'used:',
+                         ledger.CapitalUsed, 'position: ', self._currentCapitalPosition)
+
+    # 记录订单，并把成交计入本地账本
+    def RecordOrder(self, title, orderStatus):
+        self.Ledger.ApplyFill(orderStatus)
+        Indicators.Invalidate((self.PortfolioIndex, orderStatus.security))
+        SecurityHandler.RecordOrder(title, title, orderStatus)
 
     # 打开盈利监视器
     def ActiveProfitMonitor(self, positions):
-        for position in positions.values():
-            security = position.security
-            profitStatus = self.ProfitHolder.get(security)
-            if not profitStatus:
-                profitStatus = SecurityProfitStatus(security, \
-                                                    WaterLine(DEF_PROFIT_LINE_HIGH, False, True),
-                                                    WaterLine(DEF_PROFIT_LINE_LOW, True, False))
-                self.ProfitHolder[security] = profitStatus
-
-        for security in self.ProfitHolder.keys():
-            if not positions.has_key(security):
-                del self.ProfitHolder[security]
+        self.ProfitHolder.Track(positions)
 
     # 检测是否有股票需要止损
     def StopLoss(self, context, data):
@@ -694,12 +1839,13 @@ class CapitalManager:
             self.OnActionBullishHandle(context, data, desirePosition)  # 牛市
 
         if not IsHit(self._currentCapitalPosition, desirePosition, POSITION_TOLERANCE):
-            PD(2, 'Try holding position FAILED, desire:', desirePosition, 'current:', self._currentCapitalPosition)
+            CapitalLog.Error('Try holding position FAILED, desire:', desirePosition, 'current:',
+                             self._currentCapitalPosition)
 
     # 看涨，
     # @desirePosition：希望保持的仓位水平
     def OnActionBullishHandle(self, context, data, desirePosition):
-        PD(1, 'Bullish: try holding position on: ', desirePosition)
+        CapitalLog.Info('Bullish: try holding position on: ', desirePosition)
 
         # 获取当前持有的股票
         currentHoldingStocks = len(context.portfolio.positions.values())
@@ -708,7 +1854,7 @@ class CapitalManager:
 
         # # 如果开仓的个股已经达到上限
         # if availShare == 0:
-        #     PD(2, 'Full opening position.')
+        #     CapitalLog.Warn('Full opening position.')
         #     self.UpdateCapital(context)
         #     return
 
@@ -718,14 +1864,14 @@ class CapitalManager:
         # 取得符合买进条件的所有个股
         stocks = context.target_securities
         if len(stocks) <= 0:
-            PD(1, 'No target stocks buy!!!!! ')
+            CapitalLog.Info('No target stocks buy!!!!! ')
             return
 
         # 计算应该需要补多少仓
         fillingPosition = desirePosition - self._currentCapitalPosition
         # 计算该次补仓所需要的资金
         desireTotalOrderCash = (
-                                   context.portfolio.capital_used + context.portfolio.cash) / self.CMOption.TotalShare * fillingPosition  # 这里应该不对
+                                   self.Ledger.CapitalUsed + self.Ledger.Cash) / self.CMOption.TotalShare * fillingPosition  # 这里应该不对
         # 计算每股的平均资金
         orderCashPerStock = desireTotalOrderCash / fillingPosition * self.CMOption.SharesPerStock  # 这里也不对，不是只能开仓两只，是只能开仓两成
 
@@ -734,42 +1880,64 @@ class CapitalManager:
 
         # 如果没有符合条件的个股，直接返回
         if len(backupSecurities) <= 0:
-            PD(1, 'No target stocks buy at the end!!!!! ')
+            CapitalLog.Info('No target stocks buy at the end!!!!! ')
             return
 
         # 按照期望的涨幅排序：小->大
         targetSecurities = self._securitiesFilter.OnRankByOrderInOption(backupSecurities, data)
-        # PD(0, 'Backup order in stocks:')
+        # FilterLog.Debug('Backup order in stocks:')
         # OrderRankInfo.PrintList(targetSecurities)
 
         openPositionCount = 0
-        # 从备选股中，开仓
-        for info in targetSecurities:
-            security = info.Security
-            # 如果达到或接近仓位水平
-            if IsHit(self._currentCapitalPosition, desirePosition, POSITION_TOLERANCE): break
-            # 如果达到开仓数量，而仓位还没有满足要求
-            if openPositionCount >= self.CMOption.TotalOpenPositionPerDay:  # ？？这里没有break，跟原有的策略本意不同
-                PD(1, 'Opening position has reached max setting, but capital position still under require:',
-                   self._currentCapitalPosition)
-
-            # 按照当前市场价，计算下单的金额
-            finalValue = SecurityHandler.ClampOrderValue(data, security, orderCashPerStock, context.portfolio.cash)
-            orderStatus = order_target_value(security, finalValue, MarketOrderStyle())
-            if orderStatus:
-                SecurityHandler.RecordOrder('OpenPosition', 'OpenPosition', orderStatus)
+        # 排名按需分批进行，只有读取到的个股才参与排序
+        candidates = targetSecurities
+        start = 0
+        # 每个行业的持仓上限
+        industryCap = self.CMOption.StocksPerIndustry
+        # 从备选股中，开仓：每一轮先按一次读取的账户计划好所有订单，再批量提交，提交后对账一次。
+        # 对账后的仓位仍未达到要求时（订单失败、手续费和成交价与计划的偏差），从下一个备选股开始再计划一轮
+        for i in range(DEF_ORDER_PLAN_ROUNDS):
+            plan = OrderPlan(self.Ledger, self.PortfolioIndex)
+            # 每一轮按账户中的持仓重新统计每个行业的个股数量，计划买入的个股计入它的行业
+            industryCounts = IndustryHolder.Counts(context.portfolio.positions.keys()) if industryCap > 0 else None
+            while start < len(candidates):
+                # 如果达到或接近仓位水平
+                if IsHit(plan.Position(), desirePosition, POSITION_TOLERANCE): break
+                # 如果达到开仓数量，而仓位还没有满足要求
+                if openPositionCount + plan.Count() >= self.CMOption.TotalOpenPositionPerDay:  # ？？这里没有break，跟原有的策略本意不同
+                    CapitalLog.Debug('Opening position has reached max setting, but capital position still under require:',
+                                     plan.Position())
+
+                security = candidates[start].Security
+                start += 1
+                # 如果个股所属的行业已经达到持仓上限，跳过
+                if industryCounts is not None:
+                    industry = IndustryHolder.IndustryOf(security)
+                    if industry is not None:
+                        if industryCounts.get(industry, 0) >= industryCap: continue
+                        industryCounts[industry] = industryCounts.get(industry, 0) + 1
+                # 按照当前市场价，计算下单的金额
+                finalValue = SecurityHandler.ClampOrderValue(data, security, orderCashPerStock, plan.Cash)
+                plan.Buy(security, finalValue, GetCurrentPrice(security, context.current_dt))
+
+            for security, orderStatus in plan.Submit():
+                if not orderStatus: continue
+                self.RecordOrder('OpenPosition', orderStatus)
                 # 如果下单成功，增加开仓计数器，以保证每天的开仓数量
                 if orderStatus.status == OrderStatus.held:
                     openPositionCount = openPositionCount + 1
-                    PD(0, 'Open new position,new positions:', openPositionCount)
-                self.UpdateCapital(context)
+                    CapitalLog.Debug('Open new position,new positions:', openPositionCount)
 
-                # 更新盈利状态跟踪器
+            # 整批订单的成交已经计入账本，更新一次仓位
+            self.UpdateCapital(context)
+            if start >= len(candidates) or IsHit(self._currentCapitalPosition, desirePosition, POSITION_TOLERANCE): break
+
+        # 更新盈利状态跟踪器
         self.ActiveProfitMonitor(context.portfolio.positions)
 
     # 看跌
     def OnActionBearishHandle(self, context, data, position):
-        PD(1, 'Bearish: try cutdown position on: ', position)
+        CapitalLog.Info('Bearish: try cutdown position on: ', position)
 
         self.UpdateCapital(context)
         positions = context.portfolio.positions.values()
@@ -782,43 +1950,55 @@ class CapitalManager:
         # 在保证仓位水平的前提下，卖掉需要止损的股票
         self.OnActionStopLoss(positions, context, data)
 
-    # 根据期望的仓位平仓
+    # 根据期望的仓位平仓：按顺序计划清仓，直到估算的仓位达到要求，批量提交后对账一次。
+    # 已经计划清仓的持仓从positions中去掉，剩下的留给OnActionStopLoss
     def OnActionStopLossByPosition(self, positions, context, data, stopLossPoint):
-        while not IsHit(self._currentCapitalPosition, stopLossPoint, POSITION_TOLERANCE) and len(positions) > 0:
-            position = positions[0]
-            PD(2, position.total_amount, position.sellable_amount, position.price, position.avg_cost, position.security)
-            orderStatus = order_target(position.security, 0, MarketOrderStyle())
-            if orderStatus:
-                SecurityHandler.RecordOrder('StopLossByPosition', 'StopLossByPosition', orderStatus)
+        count = 0
+        for i in range(DEF_ORDER_PLAN_ROUNDS):
+            if IsHit(self._currentCapitalPosition, stopLossPoint, POSITION_TOLERANCE) or count >= len(positions): break
+
+            plan = OrderPlan(self.Ledger, self.PortfolioIndex)
+            while count < len(positions) and not IsHit(plan.Position(), stopLossPoint, POSITION_TOLERANCE):
+                position = positions[count]
+                CapitalLog.Debug(position.total_amount, position.sellable_amount, position.price, position.avg_cost,
+                                 position.security)
+                plan.SellOff(position)
+                count += 1
+
+            for security, orderStatus in plan.Submit():
+                if orderStatus:
+                    self.RecordOrder('StopLossByPosition', orderStatus)
 
-            positions.remove(position)
+            # 整批订单的成交已经计入账本，更新一次仓位，仍未达到止损仓位时再计划一轮
             self.UpdateCapital(context)
 
+        del positions[:count]
+
     # 平掉所有需要止损的个股
     def OnActionStopLoss(self, positions, context, data):
-        PD(0, 'OnActionStopLoss！！！')
+        CapitalLog.Debug('OnActionStopLoss！！！')
 
-        # for k, v in self.ProfitHolder.items():
-        # PD(2, k, v.Security, v.HighLimitLine.IsReverse, \
-        # v.LowLimitLine.IsReverse, v.LowLimitLine.Active, \
-        # v.HighLimitLine, v.LowLimitLine)
+        # holder = self.ProfitHolder
+        # ProfitLog.Debug(holder.Size(), holder.HighLimitLines.Line, holder.LowLimitLines.Active, \
+        # holder.LowLimitLines.Line)
 
         # for position in positions:
-        # PD(1, position.security)
+        # CapitalLog.Debug(position.security)
 
-        for position in positions:
-            if SecurityHandler.IsNeedSellOff(position, context, data, self.ProfitHolder, \
-                                             self.CMOption.MaSamplingDaysForStock, self.CMOption.StopLossThreshold):
-                orderStatus = order_target(position.security, 0, MarketOrderStyle())
-                if orderStatus:
-                    SecurityHandler.RecordOrder('StopLoss', 'StopLoss', orderStatus)
+        sellOff = SecurityHandler.NeedSellOffMask(positions, context, self.ProfitHolder, \
+                                                  self.CMOption.MaSamplingDaysForStock, self.CMOption.StopLossThreshold,
+                                                  self.PortfolioIndex)
+        for i in np.nonzero(sellOff)[0]:
+            orderStatus = order_target(positions[i].security, 0, MarketOrderStyle(), pindex=self.PortfolioIndex)
+            if orderStatus:
+                self.RecordOrder('StopLoss', orderStatus)
 
     # 无条件清仓
     def OnActionSellOff(self, context):
         for position in context.portfolio.positions.values():
-            orderStatus = order_target(position.security, 0, MarketOrderStyle())
+            orderStatus = order_target(position.security, 0, MarketOrderStyle(), pindex=self.PortfolioIndex)
             if orderStatus:
-                SecurityHandler.RecordOrder('SellOff', 'SellOff', orderStatus)
+                self.RecordOrder('SellOff', orderStatus)
 
     # 卖掉所有盈利的个股
     def OnActionSellOffOverflowOnly(self, context):
@@ -830,9 +2010,9 @@ class CapitalManager:
         for position in positions:
             # 如果盈利，清掉
             if position.price - x.avg_cost > 0:
-                orderStatus = order_target(position.security, 0, MarketOrderStyle())
+                orderStatus = order_target(position.security, 0, MarketOrderStyle(), pindex=self.PortfolioIndex)
                 if orderStatus:
-                    SecurityHandler.RecordOrder('SellOffOverflowOnly', 'SellOffOverflowOnly', orderStatus)
+                    self.RecordOrder('SellOffOverflowOnly', orderStatus)
             else:
                 break
 
@@ -846,9 +2026,9 @@ class CapitalManager:
         for position in positions:
             # 如果不盈利，清掉
             if position.price - x.avg_cost < 0:
-                orderStatus = order_target(position.security, 0, MarketOrderStyle())
+                orderStatus = order_target(position.security, 0, MarketOrderStyle(), pindex=self.PortfolioIndex)
                 if orderStatus:
-                    SecurityHandler.RecordOrder('SellOffLossOnly', 'SellOffLossOnly', orderStatus)
+                    self.RecordOrder('SellOffLossOnly', orderStatus)
             else:
                 break
 
@@ -874,11 +2054,14 @@ class MarketInfoHandler:
             self._capitalManager = capitalManager
             self.PositionIfBreakoutLine1 = positionIfBreakoutLine1
             self.PositionIfBreakoutLine2 = positionIfBreakoutLine2
-            self.positionIfFallingdownLine1 = positionIfFallingdownLine1
+            self.PositionIfFallingdownLine1 = positionIfFallingdownLine1
             self.PositionIfFallingdownLine2 = positionIfFallingdownLine2
 
     # 根据策略处理市场信息
     def Execute(self, context, data):
+        # 本地账本与平台账户同步
+        self._capitalManager.SyncLedger(context)
+
         # 获取当前最新的市场价格
         currentMarketPrice = self._marketInfo.GetMarketPrice(context)
 
@@ -886,19 +2069,19 @@ class MarketInfoHandler:
 
         # 如果当前市场价格低于大盘第一条和第二条均线，无条件清仓
         if self.IsFallingDownMABoth(currentMarketPrice, self._marketInfo.Ma_1, self._marketInfo.Ma_2):
-            PD(1, 'Market price less than both MA line1 and line2')
+            MarketLog.Info('Market price less than both MA line1 and line2')
             return self._capitalManager.OnActionSellOff(context)
 
         # 检测是否有个股需要止损或者止盈
         self._capitalManager.StopLoss(context, data)
 
         if self.IsBreakOutMABoth(currentMarketPrice, self._marketInfo.Ma_1, self._marketInfo.Ma_2):
-            PD(1, 'Market prices bigger than both Ma line1 and line2')
+            MarketLog.Info('Market prices bigger than both Ma line1 and line2')
             return self._capitalManager.TryHoldingOnPosition(context, data, self.PositionIfBreakoutLine2)
 
         # 如果当前市场价格处于第一条和第二条均线之间，保持仓位在6成
         if self.IsMarketPriceBetweenMA(currentMarketPrice, self._marketInfo.Ma_1, self._marketInfo.Ma_2):
-            PD(1, 'Market prices between MA line1 and line2')
+            MarketLog.Info('Market prices between MA line1 and line2')
             return self._capitalManager.TryHoldingOnPosition(context, data, self.PositionIfBreakoutLine1)
 
     def IsMarketPriceBetweenMA(self, currentMarketPrice, ma1, ma2):
@@ -925,6 +2108,22 @@ def GetCurrentMarketCap(security, currrentDate):
         return cacheInfo
 
 
+# 批量获取多支个股的市值，返回与securities对齐的数组
+def GetCurrentMarketCaps(securities, currrentDate):
+    caps = CacheHolder.GetColumn(CacheType.MarketCap, CacheHolder.GetIndices(securities))
+    missing = np.nonzero(caps != caps)[0]
+    if len(missing) > 0:
+        # cache没有命中的个股，先批量查询一次
+        missingSecurities = [securities[i] for i in missing]
+        CacheHolder.CacheMarketCap(missingSecurities, currrentDate)
+        caps[missing] = CacheHolder.GetColumn(CacheType.MarketCap, CacheHolder.GetIndices(missingSecurities))
+
+        # cache容量不够时，仍然可能有没有写进cache的个股，逐个查询
+        for i in missing[caps[missing] != caps[missing]]:
+            caps[i] = GetCurrentMarketCapDir(securities[i], currrentDate)
+    return caps
+
+
 def GetCurrentMarketCapDir(security, currentDate):
     q = query(
         valuation.market_cap
@@ -947,8 +2146,8 @@ def GetCurrentPrice(security, currentData):
     # 如果cache没有命中
     if cacheInfo == None:
         # 查询
-        priceDF = get_price(security, end_date=currentData, frequency='1d', count=1)
-        price = priceDF.values[0][0]
+        priceDF = get_price(security, end_date=currentData, fields=['close'], frequency='1d', count=1)
+        price = priceDF['close'].values[-1]
         # 将该次查询结果写进cache中
         CacheHolder.AddCache(security, CacheType.Price, price)
         return price
@@ -956,38 +2155,364 @@ def GetCurrentPrice(security, currentData):
         return cacheInfo
 
 
-# 获取大盘的days均线
-def GetMarketMaIndexByDay(indexCode, days, field):
-    marketIndexHistory = attribute_history(indexCode, days, '1d', field)
-    return marketIndexHistory.mean().values[0]
+# 获取多支个股的当前市场价，先批量读取cache，没有命中的逐个查询
+def GetCurrentPrices(securities, currentDt):
+    prices = CacheHolder.GetColumn(CacheType.Price, CacheHolder.GetIndices(securities))
+    for i in np.nonzero(prices != prices)[0]:
+        price = GetCurrentPrice(securities[i], currentDt)
+        if price is not None: prices[i] = price
+    return prices
+
+
+# 获取多支个股当天的(涨停价, 跌停价)，先批量读取cache，没有命中的一次查询并写进cache，开盘前可以调用
+def GetHighLowLimits(securities):
+    indices = CacheHolder.GetIndices(securities)
+    highLimits = CacheHolder.GetColumn(CacheType.HighLimit, indices)
+    lowLimits = CacheHolder.GetColumn(CacheType.LowLimit, indices)
+
+    missing = np.nonzero((highLimits != highLimits) | (lowLimits != lowLimits))[0]
+    if len(missing) > 0:
+        highLimits[missing], lowLimits[missing] = CacheHolder.CacheLimitPrices([securities[i] for i in missing])
+    return highLimits, lowLimits
+
+
+# 获取多支个股当天的开盘价，只在盘中调用：开盘价在第一次读取时查询并缓存到当天结束
+def GetDayOpens(securities):
+    dayOpens = CacheHolder.GetColumn(CacheType.DayOpen, CacheHolder.GetIndices(securities))
+    missing = np.nonzero(dayOpens != dayOpens)[0]
+    if len(missing) > 0:
+        dayOpens[missing] = CacheHolder.CacheDayOpens([securities[i] for i in missing])
+    return dayOpens
+
+
+# 获取多支个股当天的(涨停价, 跌停价, 开盘价)，只在盘中调用
+def GetLimitPrices(securities):
+    highLimits, lowLimits = GetHighLowLimits(securities)
+    return highLimits, lowLimits, GetDayOpens(securities)
+
+
+# 建立当天的股票池属性索引：停牌、ST从get_current_data读取，市值批量查询（经过cache），都按批进行
+# 本地回测可以替换这个函数，直接读取与数据一起保存的索引，见DataStore.py
+def LoadUniverseIndex(securities, context):
+    start = time.time()
+    securities = list(securities)
+    count = len(securities)
+    currentDate = context.current_dt.strftime("%Y-%m-%d")
+    currentData = get_current_data()
+    paused = np.zeros(count, dtype=bool)
+    st = np.zeros(count, dtype=bool)
+    caps = np.zeros(count)
+    offset = 0
+    for chunk in Chunks(securities):
+        statuses = [currentData[security] for security in chunk]
+        end = offset + len(chunk)
+        paused[offset:end] = np.fromiter((status.paused for status in statuses), dtype=bool, count=len(chunk))
+        st[offset:end] = np.fromiter((status.is_st for status in statuses), dtype=bool, count=len(chunk))
+        caps[offset:end] = GetCurrentMarketCaps(chunk, currentDate)
+        offset = end
+    universe = UniverseIndex.Build(securities, paused, st, caps, context.current_dt.date())
+    Throughput.Record('universe_index', count, time.time() - start)
+    return universe
+
+
+# 设置策略监控的security：DEF_SECURITY_POOL指数在当天的成分股，或者当天市场所有的股票
+# 按日期查询，不会监控回测开始之后才上市的个股，也不会遗漏之后的新股和调入的成分股
+def SetupSecurityPool(currentDt=None):
+    date = currentDt.strftime("%Y-%m-%d") if currentDt is not None else None
+    if DEF_SECURITY_POOL == 'all':
+        securities = list(get_all_securities(types=['stock'], date=date).index)
+    else:
+        securities = get_index_stocks(DEF_SECURITY_POOL, date=date)
+    set_universe(securities)
+    return securities
+
+
+# 股票池：在initialize中设置，之后每隔RefreshDays个交易日按当天重新查询，个股有变化时才重新设置
+class SecurityPool:
+    RefreshDays = DEF_SECURITY_POOL_REFRESH_DAYS
+    Loaded = False  # 是否设置过股票池
+    Version = 0  # 股票池每变化一次加1
+
+    def __init__(self, refreshDays=DEF_SECURITY_POOL_REFRESH_DAYS):
+        self.RefreshDays = refreshDays
+        self.Loaded = False
+        self.Version = 0
+        self._securities = frozenset()
+        self._days = 0  # 距离上次查询的交易日数
+
+    # initialize和每个交易日开盘前调用：没有设置过或者到了刷新的间隔时重新查询，返回股票池是否有变化
+    def Refresh(self, currentDt):
+        if self.Loaded:
+            self._days += 1
+            if self._days < self.RefreshDays: return False
+        self._days = 0
+        self.Loaded = True
+        securities = frozenset(SetupSecurityPool(currentDt))
+        if securities == self._securities: return False
+        self._securities = securities
+        self.Version += 1
+        FilterLog.Info('security pool version', self.Version, 'securities:', len(securities))
+        return True
 
 
-# 获取个股所属的行业
-def GetIndustryOrder(industryCode):
-    return True
+# 统计的数据和下单API
+PROFILED_APIS = ['get_price', 'get_fundamentals', 'attribute_history', 'history', 'get_current_data',
+                 'order_target', 'order_target_value']
 
 
-# 设置策略监控的security：市场所有股票
-def SetupSecurityPool():
-    securities = get_index_stocks('000300.XSHG')  # get_all_securities(types=['stock']).index
-    set_universe(securities)
+# API返回的行数：DataFrame、Series为行数，多支个股的Panel为(bar × 个股)数，下单返回的订单记为1
+def ReturnedRows(result):
+    if result is None:
+        return 0
+    if hasattr(result, 'major_axis'):  # Panel
+        return len(result.major_axis) * len(result.minor_axis)
+    if isinstance(result, dict) and result and isinstance(list(result.values())[0], pd.DataFrame):
+        frame = list(result.values())[0]  # 按字段分开的多支个股数据
+        return frame.shape[0] * frame.shape[1]
+    if hasattr(result, '__len__'):
+        return len(result)
+    return 1
+
+
+# API调用统计
+# 替换策略全局空间中的数据和下单API，按(调用位置, API)累计调用次数、耗时和返回的行数，每个bar结束时记录一次。
+# 调用位置是直接调用API的函数名，如GetCurrentPrice、GetCurrentMarketCapDir、FilterLimitStocks。
+# 两个bar之间的调用（如开盘前更新大盘均线）计入下一个bar
+class ApiProfiler:
+    def __init__(self):
+        self.Installed = False
+        self.Bars = []  # 每个bar每个(调用位置, API)一行
+        self.CacheBars = []  # 每个bar的cache命中情况
+        self._stats = {}  # (调用位置, API) -> [次数, 耗时, 行数]
+        self._cacheCount = (0, 0)  # 上一个bar结束时cache的命中、未命中次数
+
+    # 替换namespace（策略的全局空间）中的API
+    def Install(self, namespace, apis=PROFILED_APIS):
+        if self.Installed: return
+        for name in apis:
+            if name in namespace: namespace[name] = self._wrap(name, namespace[name])
+        self.Installed = True
+
+    def _wrap(self, name, func):
+        stats = self._stats
+
+        def Profiled(*args, **kwargs):
+            # 生成器表达式、lambda等匿名代码块归到外层的函数
+            frame = sys._getframe(1)
+            while frame.f_back is not None and frame.f_code.co_name.startswith('<'):
+                frame = frame.f_back
+            caller = frame.f_code.co_name
+            start = time.time()
+            result = func(*args, **kwargs)
+            elapsed = time.time() - start
+
+            stat = stats.get((caller, name))
+            if stat is None:
+                stat = stats[(caller, name)] = [0, 0.0, 0]
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] += ReturnedRows(result)
+            return result
+
+        return Profiled
+
+    # 每个bar结束时调用，记录这个bar的统计，cache的命中率为这个bar中的命中次数/查询次数
+    def EndBar(self, currentDt, cache):
+        hits = cache.Hits - self._cacheCount[0]
+        misses = cache.Misses - self._cacheCount[1]
+        self._cacheCount = (cache.Hits, cache.Misses)
+        hitRatio = float(hits) / (hits + misses) if hits + misses > 0 else np.nan
+        self.CacheBars.append((currentDt, hits, misses, hitRatio))
+
+        for (caller, api), (calls, elapsed, rows) in self._stats.items():
+            self.Bars.append((currentDt, caller, api, calls, elapsed * 1000, rows, hitRatio))
+        self._stats.clear()
+
+    # 每个bar的明细
+    def BarReport(self):
+        return pd.DataFrame(self.Bars, columns=['time', 'caller', 'api', 'calls', 'total_ms', 'rows',
+                                               'cache_hit_ratio'])
+
+    # 整个回测的汇总，每个(调用位置, API)一行，按总耗时从高到低排序
+    def Report(self):
+        bars = self.BarReport()
+        if bars.empty: return bars
+
+        report = bars.groupby(['caller', 'api'])[['calls', 'total_ms', 'rows']].sum()
+        barCount = float(len(self.CacheBars))
+        report['bars'] = bars.groupby(['caller', 'api']).size()
+        report['calls_per_bar'] = report['calls'] / barCount
+        report['ms_per_bar'] = report['total_ms'] / barCount
+        report['rows_per_call'] = report['rows'] / report['calls'].astype(float)
+        return report.sort_values('total_ms', ascending=False).reset_index()
+
+    # 打印汇总
+    def PrintInfo(self):
+        report = self.Report()
+        for row in report.itertuples(index=False):
+            ProfileLog.Info(row.caller, row.api, 'calls/bar:', row.calls_per_bar, \
+               'ms/bar:', row.ms_per_bar, 'rows/call:', row.rows_per_call)
+
+        hits = sum(bar[1] for bar in self.CacheBars)
+        total = hits + sum(bar[2] for bar in self.CacheBars)
+        ProfileLog.Info('bars:', len(self.CacheBars), 'cache hit ratio:', float(hits) / total if total > 0 else 0.0)
+
+
+# 全局API调用统计
+ApiProfilerHolder = ApiProfiler()
+
 
+# 吞吐量统计：按阶段累计处理的个股数量和耗时，报告每秒处理的个股数量，
+# 用来比较不同大小的股票池（如沪深300和全部A股）每天、每个bar的耗时
+class ThroughputMeter:
+    def __init__(self):
+        self._stats = {}  # 阶段 -> [调用次数, 个股数量, 耗时]
+
+    def Record(self, stage, securities, seconds):
+        stat = self._stats.get(stage)
+        if stat is None:
+            stat = self._stats[stage] = [0, 0, 0.0]
+        stat[0] += 1
+        stat[1] += securities
+        stat[2] += seconds
+
+    # 每个阶段一行：调用次数、每次的个股数量和耗时、每秒处理的个股数量
+    def Report(self):
+        rows = [(stage, calls, count, seconds * 1000) for stage, (calls, count, seconds) in sorted(self._stats.items())]
+        report = pd.DataFrame(rows, columns=['stage', 'calls', 'securities', 'total_ms'])
+        report['securities_per_call'] = report['securities'] / report['calls'].astype(float)
+        report['ms_per_call'] = report['total_ms'] / report['calls'].astype(float)
+        report['securities_per_sec'] = report['securities'] * 1000.0 / report['total_ms'].where(report['total_ms'] > 0)
+        return report
+
+    def PrintInfo(self):
+        for row in self.Report().itertuples(index=False):
+            ProfileLog.Info(row.stage, 'securities/call:', row.securities_per_call, 'ms/call:', row.ms_per_call, \
+                            'securities/sec:', row.securities_per_sec)
+
+
+# 全局吞吐量统计：开盘前的预计算、股票池属性索引和每个bar
+Throughput = ThroughputMeter()
 
 # 全局Cache持有者
 CacheHolder = CacheHandler()
 
+# 个股的滚动均线：5、10、20、60日
+SecurityMaEngine = RollingMaEngine(FetchSecuritiesHistory, [DEF_MA_SAMPLING_DAYS_FOR_SECURITY,
+                                                            DEF_MA_SAMPLING_DAYS_FOR_SECURITY_BUY,
+                                                            DEF_MARKET_MA_SAMPLING_DAYS_1,
+                                                            DEF_MARKET_MA_SAMPLING_DAYS_2])
+
+# 个股指标的备忘表：均线按天，data的字段、涨跌幅按bar，持仓盈亏按bar（成交后重新计算）
+Indicators = IndicatorTable()
+Indicators.Declare('ma', ComputeMa, daily=True)
+Indicators.Declare('bar', ComputeBarField)
+Indicators.Declare('change_pct', ComputeChangePercent)
+Indicators.Declare('flow', ComputeFlow, positional=True)
+
+# 行业索引：有策略实例按行业筛选或者限制行业持仓时，在initialize中加载
+IndustryHolder = IndustryIndex()
+
+# 股票池：在initialize中设置，开盘前按间隔刷新
+SecurityPoolHolder = SecurityPool()
+
 # 大盘：上证指数
 XSHG_info = MarketInfo(DEF_MARKET_INDEX)
 
-# 设置过滤选项
-selectorFilterOption = SecuritiesSelectionFilterOption()
-orderInOption = SecuritiesOrderInFilterOption()
-capitalManagerOption = CapitalManagerOption()
 
-# 定义全局过滤规则
-SecFilter = SecuritiesFilter(selectorFilterOption, orderInOption)
-# 定义全局资金管理
-CapitalMgr = CapitalManager(capitalManagerOption, SecFilter)
+# 子账户的适配：聚宽的SubPortfolio只提供available_cash、total_value、positions_value、inout_cash和long_positions，
+# 策略实例按总账户的字段名（cash、capital_used、starting_cash、positions）读取，都从这里换成子账户的字段
+class SubPortfolioAccount:
+    def __init__(self, subportfolio):
+        self._subportfolio = subportfolio
+
+    positions = property(lambda self: self._subportfolio.long_positions)
+    cash = property(lambda self: self._subportfolio.available_cash)
+    starting_cash = property(lambda self: self._subportfolio.inout_cash)
+    positions_value = property(lambda self: self._subportfolio.positions_value)
+    total_value = property(lambda self: self._subportfolio.total_value)
+    portfolio_value = total_value
+
+    # 持仓占用的资金，按持仓成本计算，子账户没有这个字段，由持仓计算
+    @property
+    def capital_used(self):
+        return sum(position.avg_cost * position.total_amount for position in self.positions.values())
+
+
+# 策略实例看到的context：portfolio为实例自己的子账户（SubPortfolioAccount），其他属性与平台的context相同
+class InstanceContext:
+    def __init__(self, context, portfolio):
+        self._context = context
+        self.portfolio = portfolio
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+
+# 策略实例：一组过滤规则、资金管理和市场信息处理，在自己的子账户（pindex）中下单
+# 所有实例共用cache、个股均线和大盘信息，每个bar只预取一次行情，增加一个实例只增加它自己的选股和下单
+class StrategyInstance:
+    Name = ''
+    Weight = 1.0  # 分配的初始资金份数
+
+    def __init__(self, name, selectFilterOption, orderInFilterOption, managerOption, portfolioIndex=0, weight=1.0,
+                 **marketHandlerOptions):
+        self.Name = name
+        self.Weight = weight
+        self.SelectOption = selectFilterOption
+        self.ManagerOption = managerOption
+        self.Filter = SecuritiesFilter(selectFilterOption, orderInFilterOption)
+        self.CapitalMgr = CapitalManager(managerOption, self.Filter, portfolioIndex)
+        self.MarketHandler = MarketInfoHandler(XSHG_info, self.CapitalMgr, **marketHandlerOptions)
+
+    # 实例使用的context，只有一个实例时直接使用平台的账户
+    def Bind(self, context):
+        if len(StrategyInstances) <= 1: return context
+        return InstanceContext(context, SubPortfolioAccount(context.subportfolios[self.CapitalMgr.PortfolioIndex]))
+
+    # 是否按行业筛选，或者限制每个行业的持仓
+    def UsesIndustries(self):
+        option = self.SelectOption
+        return bool(option.Industries or option.ExcludeIndustries or self.ManagerOption.StocksPerIndustry > 0)
+
+
+# 所有策略实例，第一个为SetupStrategy创建的默认实例
+StrategyInstances = []
+
+
+# 根据选项创建全局的过滤规则、资金管理和市场信息处理，作为唯一的策略实例
+# @marketHandlerOptions：MarketInfoHandler的仓位水平，如positionIfBreakoutLine1=0.6
+# 本地参数扫描（ParamSweep.py）也通过它替换选项
+def SetupStrategy(selectFilterOption, orderInFilterOption, managerOption, **marketHandlerOptions):
+    global selectorFilterOption, orderInOption, capitalManagerOption, SecFilter, CapitalMgr, MarketHandler
+    selectorFilterOption = selectFilterOption
+    orderInOption = orderInFilterOption
+    capitalManagerOption = managerOption
+
+    instance = StrategyInstance('default', selectFilterOption, orderInFilterOption, managerOption,
+                                **marketHandlerOptions)
+    del StrategyInstances[:]
+    StrategyInstances.append(instance)
+
+    # 全局过滤规则
+    SecFilter = instance.Filter
+    # 全局资金管理
+    CapitalMgr = instance.CapitalMgr
+    # 全局市场信息处理
+    MarketHandler = instance.MarketHandler
+
+
+# 在同一次回测中增加一个策略实例，使用新的子账户，初始资金按weight与其他实例分配
+# 必须在initialize之前调用（聚宽只能在initialize中设置子账户）
+def AddStrategy(name, selectFilterOption, orderInFilterOption, managerOption, weight=1.0, **marketHandlerOptions):
+    instance = StrategyInstance(name, selectFilterOption, orderInFilterOption, managerOption,
+                                len(StrategyInstances), weight, **marketHandlerOptions)
+    StrategyInstances.append(instance)
+    return instance
+
+
+# 设置过滤选项
+SetupStrategy(SecuritiesSelectionFilterOption(), SecuritiesOrderInFilterOption(), CapitalManagerOption())
 
 
 # 更新大盘MA均线
@@ -995,33 +2520,105 @@ def RefreshMarketInfo(context):
     XSHG_info.RefreshMa()
 
 
+# 开盘前的每日预计算：一个交易日内不变的工作每天只做一次
+def PrepareDay(context):
+    start = time.time()
+    # 按新的交易日刷新cache的有效期，市值、涨跌停价在这里批量读取
+    CacheHolder.Refresh(context.current_dt)
+    # 股票池按间隔重新查询，个股有变化时更新context.universe，之后的均线和索引按新的股票池同步
+    SecurityPoolHolder.Refresh(context.current_dt)
+    # 个股的滚动均线，均线的备忘表随交易日一起清空
+    SecurityMaEngine.Sync(context.universe, context.current_dt.date())
+    Indicators.BeginBar(context.current_dt)
+    # 当天的股票池属性索引，每个策略实例在上面选出当天的候选股
+    universe = LoadUniverseIndex(context.universe, context)
+    # 行业索引按间隔重新查询，成分股没有变化时不重建
+    if any(instance.UsesIndustries() for instance in StrategyInstances):
+        IndustryHolder.Refresh(context.current_dt)
+        universe.SetIndustries(IndustryHolder.Ids(universe.Securities))
+    for instance in StrategyInstances:
+        instance.Filter.PrepareDay(universe, context)
+    Throughput.Record('prepare_day', len(universe.Securities), time.time() - start)
+
+
+# 每个bar需要当前价的个股：所有策略实例当天的候选股、持仓和大盘指数
+# @boundContexts：每个实例的context，与candidates一一对应
+def GetPricedSecurities(boundContexts, candidates):
+    securities = []
+    seen = set()
+    for context, securityList in zip(boundContexts, candidates):
+        for security in list(securityList) + list(context.portfolio.positions.keys()):
+            if security not in seen:
+                seen.add(security)
+                securities.append(security)
+    securities.append(XSHG_info.GetMarketIndex())
+    return securities
+
+
 def initialize(context):
-    # 监控所有的股票
-    SetupSecurityPool()
+    # 替换数据和下单API，统计每个调用位置的调用次数和耗时
+    if Enable_ApiProfile: ApiProfilerHolder.Install(globals())
+
+    # 监控股票池中的股票，按回测开始当天查询
+    SecurityPoolHolder.Refresh(context.current_dt)
+
+    # 有策略实例按行业筛选或者限制行业持仓时，加载行业索引
+    if any(instance.UsesIndustries() for instance in StrategyInstances):
+        IndustryHolder.Refresh(context.current_dt)
 
     # 每天开盘前，按天更新大盘MA均线信息
     run_daily(RefreshMarketInfo, time='before_open')
+    # 每天开盘前，选出当天的候选股，同步个股均线
+    run_daily(PrepareDay, time='before_open')
+
+    # 多个策略实例时，按权重把初始资金分到各自的子账户
+    totalWeight = float(sum(instance.Weight for instance in StrategyInstances))
+    if len(StrategyInstances) > 1:
+        set_subportfolios([SubPortfolioConfig(cash=context.portfolio.starting_cash * instance.Weight / totalWeight,
+                                              type='stock') for instance in StrategyInstances])
 
-    cashofOneHandPerSecuirty = context.portfolio.starting_cash / capitalManagerOption.TotalShare * capitalManagerOption.SharesPerStock
-    # 为了使得资金的仓位水平保持良好，要求每手（100一手）买入个股的资金大于500*100
-    if cashofOneHandPerSecuirty < 500 * 100:
-        log.warn('starting cash less then 100*10000!')
+    for instance in StrategyInstances:
+        option = instance.ManagerOption
+        cashofOneHandPerSecuirty = context.portfolio.starting_cash * instance.Weight / totalWeight / option.TotalShare * option.SharesPerStock
+        # 为了使得资金的仓位水平保持良好，要求每手（100一手）买入个股的资金大于500*100
+        if cashofOneHandPerSecuirty < 500 * 100:
+            CapitalLog.Warn('starting cash less then 100*10000!', instance.Name)
 
 
 # # 每个单位时间调用一次(如果按天回测,则每天调用一次,如果按分钟,则每分钟调用一次)
 def handle_data(context, data):
-    # 每次运行，都必须要清空cache，防止数据过时
-    CacheHolder.Cache = {}
-    # CacheHolder.CacheMarketCap(context.universe, context.current_dt)
-    # CacheHolder.CacheCurrentPrice(context.universe, context.current_dt)
-
-    # 过滤掉不符合策略的个股
-    context.target_securities = SecFilter.OnFilterSelect(context.universe, context, data)
+    start = time.time()
+    # 新的bar，清空按bar有效的指标
+    Indicators.BeginBar(context.current_dt)
+    boundContexts = [instance.Bind(context) for instance in StrategyInstances]
+    candidates = [instance.Filter.GetDayCandidates(context.current_dt) for instance in StrategyInstances]
+    if any(securities is None for securities in candidates):
+        # 没有开盘前的预计算时（如盘中修改了策略），对整个股票池筛选
+        # 按当前时间刷新cache的有效期，并批量预取已经过期的市场价和市值
+        CacheHolder.Prefetch(context.universe, context.current_dt)
+        # 个股的滚动均线每个交易日同步一次
+        SecurityMaEngine.Sync(context.universe, context.current_dt.date())
+
+        # 过滤掉不符合策略的个股
+        for instance, bound in zip(StrategyInstances, boundContexts):
+            bound.target_securities = instance.Filter.OnFilterSelect(context.universe, bound, data)
+        processed = len(context.universe)
+    else:
+        # 只为所有实例当天的候选股、持仓和大盘指数预取一次当前价，按当前价过滤涨跌停
+        priced = GetPricedSecurities(boundContexts, candidates)
+        CacheHolder.Prefetch(priced, context.current_dt)
+        processed = len(priced) - 1  # 吞吐量按实际处理的候选股和持仓计，不计大盘指数
+        for instance, bound in zip(StrategyInstances, boundContexts):
+            bound.target_securities = instance.Filter.OnFilterSelectIntraday(bound, data)
 
     # 调试信息，显示符合个股策略的股票
-    # PD(0, 'Monitor securities:', context.target_securities)
+    # FilterLog.Debug('Monitor securities:', context.target_securities)
+
+    # 执行市场信息处理
+    for instance, bound in zip(StrategyInstances, boundContexts):
+        instance.MarketHandler.Execute(bound, data)
 
-    # 初始化市场信息
-    marketHandler = MarketInfoHandler(XSHG_info, CapitalMgr)
-    # 执行处理
-    marketHandler.Execute(context, data)
\ No newline at end of file
+    Throughput.Record('handle_data', processed, time.time() - start)
+    if Enable_ApiProfile: ApiProfilerHolder.EndBar(context.current_dt, CacheHolder)
+    # 批量输出本bar的日志
+    LogHub.EndBar()
\ No newline at end of file
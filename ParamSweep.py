@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# 策略参数扫描：按网格或随机组合策略选项，用进程池在所有CPU核上并行回测，汇总到一张结果表
+#
+# 参数名的格式：
+#   SecuritiesSelectionFilterOption.marketCapitalMax   选股策略（构造函数的参数名）
+#   SecuritiesOrderInFilterOption.changePercentDesire  买入策略
+#   CapitalManagerOption.stopLossThreshold             资金管理策略
+#   MarketInfoHandler.positionIfBreakoutLine1          大盘仓位水平
+#   DEF_NOISE_AVOID                                    策略中的全局常量（DEF_*、POSITION_TOLERANCE等）
+#
+# 行情数据只在主进程加载一次：子进程通过fork共享主进程的数据；
+# 使用--store时，所有进程映射同一份文件，由操作系统的页缓存共享。
+# 使用--shared时，同一个进程中的多组参数作为多个策略实例（AddStrategy）在一次回测中运行，各自使用一个子账户，
+# 共用行情预取和均线计算；全局常量对所有实例生效，常量不同的参数组合分在不同的回测中。
+# 使用--universe-index时，股票池属性索引只在主进程建立一次（有--store时保存在存储目录中），所有回测共用，见DataStore.py。
+#
+# 用法：
+#   python ParamSweep.py --store STORE --param CapitalManagerOption.stopLossThreshold=3,5,8 \
+#       --param MarketInfoHandler.positionIfBreakoutLine2=0.6,0.8 --out sweep.csv
+#   python ParamSweep.py --synthetic 300 --param DEF_NOISE_AVOID=0,1,2 --random 10
+import time
+import random
+import argparse
+import itertools
+import multiprocessing
+
+import pandas as pd
+
+from LocalBacktest import Backtest, MakeSyntheticData, LoadCsvData, DEF_STARTING_CASH
+
+OPTION_CLASSES = ['SecuritiesSelectionFilterOption', 'SecuritiesOrderInFilterOption', 'CapitalManagerOption']
+MARKET_HANDLER = 'MarketInfoHandler'
+
+# 子进程共享的行情数据，在创建进程池之前设置
+_SharedData = {}
+
+
+# 网格搜索：所有参数取值的笛卡尔积
+def GridSearch(grid):
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+# 随机搜索：从每个参数的取值中随机抽取count组，不重复
+def RandomSearch(grid, count, seed=0):
+    combinations = GridSearch(grid)
+    random.Random(seed).shuffle(combinations)
+    return combinations[:count]
+
+
+# 把一组参数按类型分开：选项类的构造参数、大盘仓位水平、全局常量
+def SplitParams(params):
+    options = dict((name, {}) for name in OPTION_CLASSES + [MARKET_HANDLER])
+    constants = {}
+    for key, value in params.items():
+        if '.' in key:
+            owner, name = key.split('.', 1)
+            if owner not in options: raise KeyError('unknown option class: %s' % owner)
+            options[owner][name] = value
+        else:
+            constants[key] = value
+    return options, constants
+
+
+# 按选项创建策略的过滤规则和资金管理选项：(选股, 买入, 资金管理)
+def MakeOptions(strategy, options):
+    return (strategy['SecuritiesSelectionFilterOption'](**options['SecuritiesSelectionFilterOption']),
+            strategy['SecuritiesOrderInFilterOption'](**options['SecuritiesOrderInFilterOption']),
+            strategy['CapitalManagerOption'](**options['CapitalManagerOption']))
+
+
+def _InstallUniverseIndex(backtest, universeIndex=None):
+    if universeIndex is not None:
+        from DataStore import InstallUniverseIndex
+        InstallUniverseIndex(backtest, universeIndex)
+
+
+# 用一组参数回测一次，返回结果表的一行
+# @universeIndex：DataStore.GetUniverseIndex返回的股票池属性索引
+def RunOne(params, data, startDate=None, endDate=None, frequency='day', universeIndex=None):
+    options, constants = SplitParams(params)
+    begin = time.time()
+    backtest = Backtest(data, startDate, endDate, frequency, constants=constants)
+    _InstallUniverseIndex(backtest, universeIndex)
+
+    strategy = backtest.Strategy
+    strategy['SetupStrategy'](*MakeOptions(strategy, options), **options[MARKET_HANDLER])
+    result = backtest.Run()
+
+    row = dict(params)
+    row.update(result.Summary)
+    row['elapsed'] = time.time() - begin
+    return row
+
+
+# 在一次回测中运行多组参数：每组参数一个策略实例和子账户，初始资金都是DEF_STARTING_CASH，返回每组参数一行
+# 所有参数组合的全局常量必须相同；elapsed为平均到每组参数的耗时
+def RunShared(combinations, data, startDate=None, endDate=None, frequency='day', universeIndex=None):
+    splits = [SplitParams(params) for params in combinations]
+    constants = splits[0][1]
+    if any(split[1] != constants for split in splits):
+        raise ValueError('combinations in one shared run must use the same constants')
+
+    begin = time.time()
+    backtest = Backtest(data, startDate, endDate, frequency, DEF_STARTING_CASH * len(combinations),
+                        constants=constants)
+    _InstallUniverseIndex(backtest, universeIndex)
+
+    strategy = backtest.Strategy
+    for i, (options, _) in enumerate(splits):
+        if i == 0:
+            strategy['SetupStrategy'](*MakeOptions(strategy, options), **options[MARKET_HANDLER])
+        else:
+            strategy['AddStrategy']('variant%d' % i, *MakeOptions(strategy, options), **options[MARKET_HANDLER])
+    result = backtest.Run()
+
+    elapsed = (time.time() - begin) / len(combinations)
+    rows = []
+    for params, subResult in zip(combinations, result.Subportfolios or [result]):
+        row = dict(params)
+        row.update(subResult.Summary)
+        row['elapsed'] = elapsed
+        rows.append(row)
+    return rows
+
+
+# 按全局常量分组，每组再平均分成count份，每份在一次共享的回测中运行
+def SplitShared(combinations, count):
+    groups = {}
+    for params in combinations:
+        groups.setdefault(repr(sorted(SplitParams(params)[1].items())), []).append(params)
+    chunks = []
+    for group in groups.values():
+        size = max(1, -(-len(group) // count))
+        chunks.extend(group[i:i + size] for i in range(0, len(group), size))
+    return chunks
+
+
+# 任务的params为一组参数，共享回测时为参数组合的列表；返回结果表的行的列表
+def _Worker(task):
+    params, startDate, endDate, frequency = task
+    universeIndex = _SharedData.get('universe')
+    try:
+        if isinstance(params, list):
+            return RunShared(params, _SharedData['data'], startDate, endDate, frequency, universeIndex)
+        return [RunOne(params, _SharedData['data'], startDate, endDate, frequency, universeIndex)]
+    except Exception as e:
+        rows = []
+        for combination in (params if isinstance(params, list) else [params]):
+            row = dict(combination)
+            row['error'] = repr(e)
+            rows.append(row)
+        return rows
+
+
+def _InitWorker(storePath, universeIndex):
+    if storePath and 'data' not in _SharedData:
+        from DataStore import OpenStore, OpenUniverseIndex
+        _SharedData['data'] = OpenStore(storePath)
+        if universeIndex: _SharedData['universe'] = OpenUniverseIndex(storePath, _SharedData['data'])
+
+
+# 并行回测所有参数组合，返回结果表，按夏普比率从高到低排序
+# @storePath：数据来自DataStore时传入，不能fork的平台上子进程各自映射同一份文件
+# @shared：每个进程把分到的参数组合放在一次回测中运行，见RunShared
+# @universeIndex：所有回测共用股票池属性索引，在创建进程池之前建立（有storePath时保存在存储目录中）
+def RunSweep(combinations, data, startDate=None, endDate=None, frequency='day', processes=None, storePath=None,
+             shared=False, universeIndex=False):
+    _SharedData['data'] = data
+    _SharedData.pop('universe', None)
+    if universeIndex:
+        from DataStore import GetUniverseIndex
+        _SharedData['universe'] = GetUniverseIndex(data, storePath)
+    processes = processes or multiprocessing.cpu_count()
+    if shared: combinations = SplitShared(combinations, processes)
+    tasks = [(params, startDate, endDate, frequency) for params in combinations]
+    pool = multiprocessing.Pool(processes, _InitWorker, (storePath, universeIndex))
+    try:
+        rows = [row for taskRows in pool.map(_Worker, tasks, chunksize=1) for row in taskRows]
+    finally:
+        pool.close()
+        pool.join()
+
+    table = pd.DataFrame(rows)
+    if 'sharpe' in table: table = table.sort_values('sharpe', ascending=False).reset_index(drop=True)
+    return table
+
+
+# 解析--param name=v1,v2,...，取值按数字解析，True/False为布尔值
+def ParseParam(text):
+    name, values = text.split('=', 1)
+
+    def Parse(value):
+        if value in ('True', 'False'): return value == 'True'
+        for convert in (int, float):
+            try:
+                return convert(value)
+            except ValueError:
+                pass
+        return value
+
+    return name.strip(), [Parse(value.strip()) for value in values.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel parameter sweep over the strategy options.')
+    parser.add_argument('--store', help='memory-mapped store written by DataStore.py')
+    parser.add_argument('--data', help='CSV data directory')
+    parser.add_argument('--synthetic', type=int, help='use a synthetic universe of this many securities')
+    parser.add_argument('--days', type=int, default=120, help='trading days of synthetic data')
+    parser.add_argument('--param', action='append', default=[], help='name=v1,v2,... (repeatable)')
+    parser.add_argument('--random', type=int, help='sample this many combinations instead of the full grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start', help='start date')
+    parser.add_argument('--end', help='end date')
+    parser.add_argument('--frequency', default='day', choices=['day', 'minute'])
+    parser.add_argument('--processes', type=int, help='worker processes, defaults to all cores')
+    parser.add_argument('--shared', action='store_true',
+                        help='run the combinations of each process as strategy instances of one backtest')
+    parser.add_argument('--universe-index', action='store_true',
+                        help='share the daily universe index across all backtests, see DataStore.py')
+    parser.add_argument('--out', help='write the results table to this CSV file')
+    args = parser.parse_args()
+
+    if args.store:
+        from DataStore import OpenStore
+        data = OpenStore(args.store)
+    elif args.data:
+        data = LoadCsvData(args.data)
+    else:
+        data = MakeSyntheticData(args.synthetic or 300, args.days, withMinute=args.frequency == 'minute')
+
+    grid = dict(ParseParam(text) for text in args.param)
+    combinations = RandomSearch(grid, args.random, args.seed) if args.random else GridSearch(grid)
+    table = RunSweep(combinations, data, args.start, args.end, args.frequency, args.processes, args.store,
+                     args.shared, args.universe_index)
+    if args.out: table.to_csv(args.out, index=False)
+    print(table.to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# MaBaseResearch.py中向量化实现的参考实现：逐个个股、逐个持仓处理，保留原来的逻辑，
+# 只由Benchmark.py用来校验向量化实现的结果和对比性能，不随策略上传到聚宽。
+# 策略按聚宽的方式加载到一个全局空间中（Benchmark.LoadStrategy），每个参考实现的第一个参数是这个全局空间，
+# 从中读取数据API和策略的全局对象
+
+
+# 逐个筛选目标个股，SecuritiesFilter.OnFilterSelect的参考实现
+# @secFilter：策略的SecuritiesFilter，读取其中的选股选项
+def OnFilterSelectByLoop(strategy, secFilter, securities, context, data):
+    option = secFilter._selectFilterOpt
+    currrentDate = context.current_dt.strftime("%Y-%m-%d")
+    target_securities = []
+
+    currentData = strategy['get_current_data']()
+    for security in securities:
+        securityStatus = currentData[security]
+
+        # 过滤掉停牌的个股
+        if securityStatus.paused: continue
+
+        # 如果是ST牌，过滤掉
+        if option.Filter_ST and securityStatus.is_st: continue
+
+        # 如果市值低于marketCapMin，过滤掉
+        # 如果市值高于marketCapMax，过滤掉
+        currentMarketCap = strategy['GetCurrentMarketCap'](security, currrentDate)
+        if currentMarketCap < option.MarketCapitalMin or currentMarketCap > option.MarketCapitalMax: continue
+
+        # 如果不属于选定的行业，或者属于去掉的行业，过滤掉
+        industry = strategy['IndustryHolder'].IndustryOf(security)
+        if option.Industries and industry not in option.Industries: continue
+        if option.ExcludeIndustries and industry in option.ExcludeIndustries: continue
+
+        target_securities.append(security)
+
+    # 根据策略决定是否去掉涨停、跌停的个股
+    return strategy['SecurityHandler'].FilterLimitStocks(target_securities, option, context)
+
+
+# 逐个筛选符合买入策略的个股，SecuritiesFilter.OnFilterOrderIn的参考实现
+def OnFilterOrderInByLoop(strategy, secFilter, securities, holdingSecurities, context, data):
+    option = secFilter._orderInFilterOpt
+    target_securities = []
+
+    for security in securities:
+        securityData = data[security]
+        currentPrice = securityData.close
+        prePrice = securityData.pre_close
+
+        # 涨跌幅
+        changePercentage = (currentPrice - prePrice) / prePrice * 100
+
+        # 均线
+        ma = securityData.mavg(option.MaSamplingDays, 'close')
+
+        # 如果当前价格低于MA日均线或高于均线过多，过滤掉
+        if currentPrice < ma or currentPrice > ma * 1.1: continue
+
+        # 如果涨幅低于或者高于ChangePercentLow/High， 过滤掉
+        if changePercentage < option.ChangePercentLow or changePercentage > option.ChangePercentHigh: continue
+
+        target_securities.append(security)
+
+    if option.FilterHoldingSecurities:
+        target_securities = strategy['SecurityHandler'].FilterHoldingStocks(target_securities, holdingSecurities)
+    return target_securities
+
+
+# 水位,一般用来设置个股的上涨或下跌的警告线，TrailingStopEngine中WaterLineArray的参考实现
+class WaterLine:
+    Line = 0  # 设置的目标水位
+    IsReverse = False  # 是否反转，默认为False，表示高于设置的水位时，IsHit状态为True，否则低于水位时，才设置IsHit状态
+
+    Active = False  # 激活状态
+    IsHit = False  # 水位是否超过设置的Line
+    HighestHit = Line  # 历史最高水位，辅助信息，用来跟踪某段时间内最高或最低的水位
+
+    def __init__(self, strategy, line, isReverse, active):
+        self._strategy = strategy
+        self.Line = line
+        self.IsReverse = isReverse
+        self.IsHit = False
+        self.Active = active
+        self.HighestHit = self.Line
+
+    def Reset(self, active=False):  # 重置水位
+        self.IsHit = False
+        self.Active = active
+        self.HighestHit = self.Line
+
+    def Update(self, security, newLine):  # 更新水位
+        if self.Active:
+            self.IsHit = self.__isHitWithLine(newLine)
+            if self.IsHit or self.IsReverse:
+                self._strategy['ProfitLog'].Debug(security, 'WaterLine Hit:', self.Line, 'LowlineReverseFlag',
+                                                  self.IsReverse)
+                self.__updateHighestHitLine(newLine)
+
+    def __isHitWithLine(self, line):  # 私有函数，测试水位是否溢出
+        if self.IsReverse:
+            return line < self.Line
+        else:
+            return line > self.Line
+
+    def __updateHighestHitLine(self, line):  # 私有函数，测试历史最高水位是否需要更新
+        moveStep = self._strategy['DEF_WATER_LINE_MOVE_STEP']
+        if self.IsReverse:
+            if line < self.HighestHit and line > (self.Line + moveStep):
+                self.HighestHit = line
+                self.Line = line - moveStep
+        else:
+            if line > self.HighestHit:
+                self.HighestHit = line
+                self.Line = line
+
+
+# 个股盈利状态跟踪，TrailingStopEngine的参考实现
+class SecurityProfitStatus:
+    Security = ''  # 个股ID
+
+    # 当个股盈利到达最高水位后，如果盈利下跌到设置的最低值，发出该信号。
+    _signalRaised = False
+
+    # @highLine：个股盈利最高水位，默认开启
+    # @lowLine：个股盈利最低水位，默认关闭
+    def __init__(self, strategy, security, highLine, lowLine):
+        self._strategy = strategy
+        self.Security = security
+        self.HighLimitLine = highLine
+        self.LowLimitLine = lowLine
+
+    # 更新盈利状态
+    # @clearStatusIfRaised：是否清除报警信号当触发设置的水位线时
+    def Update(self, profit, clearStatusIfRaised=False):
+        self.HighLimitLine.Update(self.Security, profit)  # 更新最高水位状态
+        if self.HighLimitLine.IsHit:  # 如果最高水位触发
+            self.LowLimitLine.Active = True  # 开启最低水位的监视
+
+        self.LowLimitLine.Update(self.Security, profit)  # 更新最低水位（前提：开启）
+
+        # 当盈利值突破最高水位之后，再次下跌至最低水位之间之下，触发该信号
+        self._signalRaised = not self.HighLimitLine.IsHit and self.LowLimitLine.IsHit
+        raised = self._signalRaised
+        if self._signalRaised:
+            self._strategy['ProfitLog'].Info('Security Profit signal raised:', self.Security)
+            if clearStatusIfRaised: self.ClearStatus()
+        return raised
+
+    def IsSignalRaisedUp(self, isClear):
+        raised = self._signalRaised
+        if isClear: self.ClearStatus()
+        return raised
+
+    def ClearStatus(self):
+        self.HighLimitLine.Reset(True)  # 默认开启最高水位
+        self.LowLimitLine.Reset(False)  # 默认关闭最低水位
+
+
+# 逐个过滤涨停、跌停的个股，SecurityHandler.FilterLimitStocks的参考实现
+def FilterLimitStocksByLoop(strategy, targetSecurities, filterOption, context):
+    if not filterOption.FilterLimitUp and not filterOption.FilterLimitDown: return targetSecurities
+
+    filterResults = []
+    cd = strategy['get_current_data']()
+
+    for stock in targetSecurities:
+        currentPrice = strategy['GetCurrentPrice'](stock, context.current_dt)
+        high_limit = cd[stock].high_limit
+        low_limit = cd[stock].low_limit
+
+        # 设置涨停（跌停）与当前价格之间的允许波动阀值，为当天开盘价的0.01
+        tolerance = cd[stock].day_open * filterOption.LimitToleranceInPercentage
+
+        # 高于涨停或接近涨停容忍度，过滤掉
+        if filterOption.FilterLimitUp:
+            if currentPrice >= high_limit or high_limit - currentPrice < tolerance: continue
+
+        # 低于跌停或接近跌停容忍度，过滤掉
+        if filterOption.FilterLimitDown:
+            if currentPrice <= low_limit or currentPrice - low_limit < tolerance: continue
+
+        filterResults.append(stock)
+    return filterResults
+
+
+# 对所有候选股完整排序，SecuritiesFilter.OnRankByOrderInOption的参考实现，返回OrderRankInfo的列表
+def OnRankByOrderInOptionByLoop(strategy, secFilter, securities, data, measure=None):
+    if securities and len(securities) > 0:
+        option = secFilter._orderInFilterOpt
+        if measure == None: measure = option.ChangePercentDesire
+
+        flowList = []
+        lossList = []
+        flows = strategy['Indicators'].Get(option.RankIndicator, list(securities), data, option.RankParam)
+        for i, security in enumerate(securities):
+            flow = flows[i]
+            if flow >= measure:
+                flowList.append(strategy['OrderRankInfo'](flow, security))
+            else:
+                lossList.append(strategy['OrderRankInfo'](flow, security))
+
+        # 高于测量值：从低到高排序(如：0, 1，2...)
+        flowList.sort(lambda x, y: cmp(x.Flow, y.Flow), reverse=False)
+        # 低于测量值：从高到低(如：-1, -2, -3...)
+        lossList.sort(lambda x, y: cmp(x.Flow, y.Flow), reverse=True)
+        flowList.extend(lossList)
+
+        return flowList
+
+
+# 获取大盘的days均线，每次查询一遍历史数据，RollingMaEngine的参考实现
+def GetMarketMaIndexByDay(strategy, indexCode, days, field):
+    marketIndexHistory = strategy['attribute_history'](indexCode, days, '1d', field)
+    return marketIndexHistory.mean().values[0]
+
+
+# 逐个判断持仓是否符合卖出条件，SecurityHandler.NeedSellOffMask的参考实现
+# @profitHolder：持仓的盈利状态跟踪（TrailingStopEngine），没有触发破均线、止损的持仓逐个更新盈利状态
+def IsNeedSellOffByLoop(strategy, position, context, data, profitHolder, MaSamplingDays, stopLossThreshold):
+    current_price = strategy['GetCurrentPrice'](position.security, context.current_dt)
+    if not current_price: current_price = position.price
+    Ma = strategy['SecurityHandler'].GetMovingAverages([position.security], MaSamplingDays)[0]
+    flow = (position.price - position.avg_cost) / position.avg_cost * 100  # ？？为什么不用current_price来算？
+
+    # 破均线并且过滤均线太近造成今天买明天卖的噪声干扰
+    if current_price < Ma and flow > strategy['DEF_NOISE_AVOID']: return True
+
+    if flow < 0 and -flow >= stopLossThreshold: return True
+
+    row = profitHolder.Rows([position.security])
+    if row[0] >= 0:
+        return bool(profitHolder.Update(row, [flow], True)[0])  # 更新盈利状态
+
+    return False